@@ -0,0 +1,566 @@
+from __future__ import division
+import os
+import sys
+import multiprocessing
+import resource
+from contextlib import contextmanager
+from math import ceil, pi
+import numpy as np
+from cctbx import sgtbx
+from cctbx import uctbx
+from compute_delta_cchalf import PerImageCChalfStatistics
+from compute_delta_cchalf import StreamingPerImageCChalfStatistics
+
+
+# The synthetic dataset of the regression fixture
+REGRESSION_PARAMETERS = {
+  'num_observations' : 20000,
+  'num_batches'      : 40,
+  'num_unique'       : 2000,
+  'seed'             : 2018,
+}
+
+
+def generate_dataset(num_observations,
+                     num_batches,
+                     num_unique,
+                     seed=0,
+                     cell=(78.08, 78.08, 78.08, 90, 90, 90),
+                     bad_batch_fraction=0.05,
+                     misfit_fraction=0.02):
+  '''
+  Generate a synthetic unmerged dataset in P1.
+
+  The unique reflections are the num_unique lowest resolution reflections of
+  one half of reciprocal space so that no two of them are Friedel mates. The
+  true intensities follow Wilson statistics with a resolution fall off and
+  each observation is the true intensity times a scale factor for its batch
+  plus counting noise. A fraction of the batches have inflated noise and
+  sigmas so that their Delta CC 1/2 stands out, and a fraction of the
+  observations are flagged as misfits with a negative variance.
+
+  :param num_observations: The number of observations
+  :param num_batches: The number of batches
+  :param num_unique: The number of unique reflections
+  :param seed: The random seed
+  :param cell: The unit cell parameters
+  :param bad_batch_fraction: The fraction of batches with inflated noise
+  :param misfit_fraction: The fraction of observations with negative variance
+  :returns: The miller_index, batch, intensity, variance, unit_cell and
+            space_group
+
+  '''
+  random = np.random.RandomState(seed)
+  unit_cell = uctbx.unit_cell(cell)
+  space_group = sgtbx.space_group_info(number=1).group()
+
+  # Enumerate the reflections in a half sphere large enough to hold the
+  # unique reflections and keep the lowest resolution ones
+  aa, bb, cc, ab, ac, bc = unit_cell.reciprocal_metrical_matrix()
+  hmax = int(ceil((1.5 * num_unique / pi)**(1/3))) + 2
+  while True:
+    r = np.arange(-hmax, hmax+1)
+    h, k, l = [x.ravel() for x in np.meshgrid(r, r, r, indexing='ij')]
+    selection = (l > 0) | ((l == 0) & ((k > 0) | ((k == 0) & (h > 0))))
+    h, k, l = h[selection], k[selection], l[selection]
+    d_star_sq = (h*h*aa + k*k*bb + l*l*cc + 2*(h*k*ab + h*l*ac + k*l*bc))
+    radius_sq = d_star_sq <= d_star_sq.max() / 3
+    if np.count_nonzero(radius_sq) >= num_unique:
+      break
+    hmax *= 2
+  order = np.argsort(d_star_sq, kind='mergesort')[:num_unique]
+  unique_index = np.column_stack((h, k, l))[order]
+  d_star_sq = d_star_sq[order]
+
+  # The true intensities
+  truth = random.exponential(1000, num_unique) * np.exp(-10 * d_star_sq)
+
+  # The observations, ordered by batch as for rotation data
+  reflection = random.randint(0, num_unique, num_observations)
+  batch = np.sort(random.randint(1, num_batches+1, num_observations))
+  scale = random.uniform(0.8, 1.2, num_batches+1)
+  noise = np.ones(num_batches+1)
+  bad = random.rand(num_batches+1) < bad_batch_fraction
+  noise[bad] = 5
+  sigma = np.sqrt(truth[reflection] + 10)
+  intensity = (scale[batch] * truth[reflection] +
+               noise[batch] * sigma * random.randn(num_observations))
+  variance = (noise[batch] * sigma)**2
+  misfit = random.rand(num_observations) < misfit_fraction
+  variance[misfit] *= -1
+  return (unique_index[reflection], batch, intensity, variance, unit_cell,
+          space_group)
+
+
+def peak_memory():
+  '''
+  :returns: The peak resident set size of this process and any children that
+            have finished in MB
+
+  '''
+  usage = max(
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  if sys.platform == 'darwin':
+    return usage / 1024**2
+  return usage / 1024
+
+
+@contextmanager
+def quiet():
+  '''
+  Suppress the output printed while computing the statistics
+
+  '''
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+  try:
+    yield
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+
+def _run_case(queue, dataset_parameters, engine, nproc, nbins):
+  '''
+  Generate a dataset and compute the statistics in a child process so that the
+  peak memory is that of a single case
+
+  '''
+  try:
+    dataset = generate_dataset(**dataset_parameters)
+    baseline = peak_memory()
+    with quiet():
+      statistics = PerImageCChalfStatistics(
+        *dataset, nbins=nbins, engine=engine, nproc=nproc)
+    result = statistics.timing()
+    result['peak_memory'] = peak_memory()
+    result['memory'] = result['peak_memory'] - baseline
+    result['mean_cchalf'] = statistics.mean_cchalf()
+    result['delta_cchalf_i'] = statistics.delta_cchalf_i()
+    queue.put(result)
+  except Exception as e:
+    queue.put(e)
+    raise
+
+
+def run_case(dataset_parameters, engine, nproc=1, nbins=10):
+  '''
+  Time the construction, the CC 1/2 of all the data and the CC 1/2 with each
+  batch excluded for one dataset and engine
+
+  :param dataset_parameters: The keyword arguments to generate_dataset
+  :param engine: The PerImageCChalfStatistics engine
+  :param nproc: The number of processes
+  :param nbins: The number of resolution bins
+  :returns: A dictionary with the time of each stage in seconds, the peak
+            and increase in memory in MB and the results
+
+  '''
+  queue = multiprocessing.Queue()
+  process = multiprocessing.Process(
+    target=_run_case,
+    args=(queue, dataset_parameters, engine, nproc, nbins))
+  process.start()
+  result = queue.get()
+  process.join()
+  if isinstance(result, Exception):
+    raise result
+  return result
+
+
+def read_xdscc12_log(filename):
+  '''
+  Read the per frame CC 1/2 from the lines starting with 'a' in an xdscc12 log
+
+  The values are for the reflections of all frames, in %. Note that xdscc12
+  computes Delta CC 1/2 as CC 1/2 with the frame minus CC 1/2 without it,
+  which is the opposite sign to compute_delta_cchalf.py.
+
+  :param filename: The log file
+  :returns: The <CC1/2> and a dictionary of (nref, with, without, delta) by
+            frame
+
+  '''
+  mean_cchalf = None
+  frames = {}
+  with open(filename) as infile:
+    for line in infile:
+      tokens = line.split()
+      if len(tokens) == 0:
+        continue
+      if tokens[0] == "<CC1/2>:":
+        mean_cchalf = float(tokens[1])
+      elif tokens[0] == "a" and len(tokens) == 10 and tokens[1].isdigit():
+        frames[int(tokens[1])] = (
+          int(tokens[6]), float(tokens[7]), float(tokens[8]), float(tokens[9]))
+  return mean_cchalf, frames
+
+
+def compare(name, values, reference, tolerance):
+  '''
+  Compare two dictionaries of values by key and print the differences
+
+  :returns: True/False if the values agree within the tolerance
+
+  '''
+  keys = sorted(set(values) & set(reference))
+  missing = sorted(set(values) ^ set(reference))
+  if len(keys) == 0:
+    print "%-36s no values in common" % name
+    return False
+  x = np.array([values[k] for k in keys])
+  y = np.array([reference[k] for k in keys])
+  difference = np.abs(x - y).max()
+  if len(keys) > 1 and x.std() > 0 and y.std() > 0:
+    correlation = np.corrcoef(x, y)[0,1]
+  else:
+    correlation = float("nan")
+  passed = difference <= tolerance and len(missing) == 0
+  print "%-36s n=%-6d max|diff|=%-10.3g corr=%-8.5f missing=%-4d %s" % (
+    name, len(keys), difference, correlation, len(missing),
+    "OK" if passed else "FAIL")
+  return passed
+
+
+def check_reference_logs(log_w, log_wz, xds_ascii=None, tolerance=0.01,
+                         fisher_tolerance=0.1):
+  '''
+  Check the results against the xdscc12 logs for the insulin data.
+
+  The two logs are always checked against each other. If the XDS_ASCII.HKL
+  file they were computed from is given, the unweighted CC 1/2 is computed
+  and compared to them: the <CC1/2>, the CC 1/2 with each frame excluded and
+  the Delta CC 1/2 (options -w -z) and the Fisher transformed Delta CC 1/2
+  (option -w), all in %.
+
+  :param log_w: The xdscc12 log with the options -w
+  :param log_wz: The xdscc12 log with the options -w -z
+  :param xds_ascii: The XDS_ASCII.HKL file
+  :param tolerance: The tolerance on the CC 1/2 and Delta CC 1/2 in %
+  :param fisher_tolerance: The tolerance on the Fisher transformed Delta
+                           CC 1/2
+  :returns: True/False if all the checks passed, or None if they were skipped
+            because the XDS_ASCII.HKL file was not given
+
+  '''
+  print ""
+  print "Reference: %s, %s" % (os.path.basename(log_w), os.path.basename(log_wz))
+  mean_w, frames_w = read_xdscc12_log(log_w)
+  mean_wz, frames_wz = read_xdscc12_log(log_wz)
+  passed = [
+    mean_w == mean_wz,
+    compare("log -w vs -wz: CC 1/2 without",
+            dict((k, v[2]) for k, v in frames_w.iteritems()),
+            dict((k, v[2]) for k, v in frames_wz.iteritems()),
+            0),
+  ]
+  if xds_ascii is None:
+    print "SKIPPED: comparison with the xdscc12 logs (no --xds_ascii given)"
+    return None
+
+  from xds_ascii import XdsAsciiReader
+  reader = XdsAsciiReader(xds_ascii)
+  with quiet():
+    statistics = PerImageCChalfStatistics(
+      *reader.read(),
+      unit_cell=reader.unit_cell(),
+      space_group=reader.space_group(),
+      engine='incremental')
+  mean_cchalf = 100 * statistics.mean_cchalf()
+  print "%-36s %.3f, xdscc12: %.3f" % ("<CC1/2>", mean_cchalf, mean_wz)
+  passed.append(abs(mean_cchalf - mean_wz) <= tolerance)
+  cchalf_i = statistics.cchalf_i()
+  delta_cchalf_i = statistics.delta_cchalf_i()
+  fisher_i = statistics.delta_cchalf_i(fisher=True)
+  passed.append(compare(
+    "CC 1/2 without frame",
+    dict((k, 100*v) for k, v in cchalf_i.iteritems()),
+    dict((k, v[2]) for k, v in frames_wz.iteritems()),
+    tolerance))
+  passed.append(compare(
+    "Delta CC 1/2 (-w -z)",
+    dict((k, -100*v) for k, v in delta_cchalf_i.iteritems()),
+    dict((k, v[3]) for k, v in frames_wz.iteritems()),
+    tolerance))
+  passed.append(compare(
+    "Fisher Delta CC 1/2 (-w)",
+    dict((k, -100*v) for k, v in fisher_i.iteritems()),
+    dict((k, v[3]) for k, v in frames_w.iteritems()),
+    fisher_tolerance))
+  return all(passed)
+
+
+def compute_regression_values(parameters, engine, nbins=10, weighted=False,
+                              order=None, chunk_size=1000):
+  '''
+  Compute the CC 1/2 of the regression dataset
+
+  :param parameters: The keyword arguments to generate_dataset
+  :param engine: The PerImageCChalfStatistics engine, or 'streaming' for
+                 StreamingPerImageCChalfStatistics
+  :param nbins: The number of resolution bins
+  :param weighted: Compute the CC 1/2 of the sigma weighted means instead
+  :param order: The order in which the streaming engine reads the
+                observations, 'batch' or 'miller_index'
+  :param chunk_size: The chunk size of the streaming engine
+  :returns: The mean CC 1/2 and a dictionary of the CC 1/2 excluding each
+            batch
+
+  '''
+  miller_index, batch, intensity, variance, unit_cell, space_group = \
+    generate_dataset(**parameters)
+  with quiet():
+    if engine == 'streaming':
+      if order == 'miller_index':
+        index = np.lexsort(miller_index.T[::-1])
+      else:
+        index = np.arange(len(batch))
+      def chunks():
+        for i in range(0, len(index), chunk_size):
+          j = index[i:i+chunk_size]
+          yield miller_index[j], batch[j], intensity[j], variance[j]
+      statistics = StreamingPerImageCChalfStatistics(
+        chunks, unit_cell, space_group, nbins=nbins, weighted=weighted)
+    else:
+      statistics = PerImageCChalfStatistics(
+        miller_index, batch, intensity, variance, unit_cell, space_group,
+        nbins=nbins, engine=engine, weighted=weighted)
+  if weighted:
+    return statistics._cchalf_mean_weighted, statistics._cchalf_weighted
+  return statistics.mean_cchalf(), statistics.cchalf_i()
+
+
+def write_regression_fixture(filename, nbins=10):
+  '''
+  Write the regression fixture: the CC 1/2 of the synthetic regression
+  dataset with each batch excluded, unweighted from the dict reference
+  engine and weighted from the incremental engine
+
+  :param filename: The fixture file
+  :param nbins: The number of resolution bins
+
+  '''
+  mean, cchalf = compute_regression_values(
+    REGRESSION_PARAMETERS, 'dict', nbins)
+  mean_w, cchalf_w = compute_regression_values(
+    REGRESSION_PARAMETERS, 'incremental', nbins, weighted=True)
+  with open(filename, "w") as outfile:
+    outfile.write(
+      "# CC 1/2 of generate_dataset(%s), nbins=%d\n" % (", ".join(
+        "%s=%d" % item for item in sorted(REGRESSION_PARAMETERS.items())),
+        nbins))
+    outfile.write("# batch cchalf cchalf_weighted ('mean' for all data)\n")
+    outfile.write("mean %.15f %.15f\n" % (mean, mean_w))
+    for b in sorted(cchalf):
+      outfile.write("%d %.15f %.15f\n" % (b, cchalf[b], cchalf_w[b]))
+
+
+def read_regression_fixture(filename):
+  '''
+  Read the regression fixture
+
+  :param filename: The fixture file
+  :returns: The mean CC 1/2 and dictionary of the CC 1/2 excluding each batch,
+            unweighted and weighted
+
+  '''
+  cchalf, cchalf_w = {}, {}
+  with open(filename) as infile:
+    for line in infile:
+      tokens = line.split()
+      if len(tokens) == 0 or tokens[0].startswith("#"):
+        continue
+      if tokens[0] == "mean":
+        mean, mean_w = float(tokens[1]), float(tokens[2])
+      else:
+        cchalf[int(tokens[0])] = float(tokens[1])
+        cchalf_w[int(tokens[0])] = float(tokens[2])
+  return mean, cchalf, mean_w, cchalf_w
+
+
+def check_regression_fixture(filename, engines, nbins=10, tolerance=1e-10):
+  '''
+  Check the CC 1/2 of every engine, and of the streaming engine reading the
+  observations ordered by batch and by miller index, against the regression
+  fixture
+
+  :param filename: The fixture file
+  :param engines: A list of engines
+  :param nbins: The number of resolution bins
+  :param tolerance: The tolerance on the CC 1/2
+  :returns: True/False if all the checks passed, or None if the fixture is
+            missing
+
+  '''
+  print ""
+  print "Regression fixture: %s" % os.path.basename(filename)
+  if not os.path.exists(filename):
+    print "SKIPPED: %s not found" % filename
+    return None
+  mean, cchalf, mean_w, cchalf_w = read_regression_fixture(filename)
+  cases = [(engine, None, False) for engine in engines]
+  cases += [
+    ('incremental', None, True),
+    ('streaming', 'batch', False),
+    ('streaming', 'batch', True),
+    ('streaming', 'miller_index', True),
+  ]
+  passed = []
+  for engine, order, weighted in cases:
+    name = engine
+    if order is not None:
+      name += " by " + order
+    if weighted:
+      name += " weighted"
+      reference = dict(cchalf_w, mean=mean_w)
+    else:
+      reference = dict(cchalf, mean=mean)
+    values = compute_regression_values(
+      REGRESSION_PARAMETERS, engine, nbins, weighted=weighted, order=order)
+    passed.append(compare(name, dict(values[1], mean=values[0]), reference,
+                          tolerance))
+  return all(passed)
+
+
+def run_benchmarks(sizes, engines, nproc, nbins=10, seed=0,
+                   dict_max_observations=20000, tolerance=1e-10):
+  '''
+  Run the benchmarks for each dataset size and engine and check that all the
+  engines give the same results as the first one
+
+  :param sizes: A list of (observations, batches, unique) tuples
+  :param engines: A list of engines
+  :param nproc: A list of numbers of processes
+  :param nbins: The number of resolution bins
+  :param seed: The random seed
+  :param dict_max_observations: The largest dataset to run the dict engine on
+  :param tolerance: The tolerance on the CC 1/2 between engines
+  :returns: True/False if all the engines agree
+
+  '''
+  print "%8s %7s %7s %-12s %5s %12s %8s %13s %9s %9s %12s" % (
+    "obs", "batches", "unique", "engine", "nproc", "construction", "full",
+    "leave_one_out", "total", "peak_MB", "max|diff|")
+  passed = True
+  for num_observations, num_batches, num_unique in sizes:
+    dataset_parameters = {
+      'num_observations' : num_observations,
+      'num_batches'      : num_batches,
+      'num_unique'       : num_unique,
+      'seed'             : seed,
+    }
+    reference = None
+    for engine in engines:
+      if engine == 'dict' and num_observations > dict_max_observations:
+        continue
+      for n in nproc:
+        if engine == 'dict' and n > 1:
+          continue
+        result = run_case(dataset_parameters, engine, n, nbins)
+        if reference is None:
+          reference = result
+        difference = max(
+          [abs(result['mean_cchalf'] - reference['mean_cchalf'])] +
+          [abs(v - reference['delta_cchalf_i'][k])
+           for k, v in result['delta_cchalf_i'].iteritems()])
+        if (difference > tolerance or
+            sorted(result['delta_cchalf_i']) !=
+            sorted(reference['delta_cchalf_i'])):
+          passed = False
+        total = (result['construction'] + result['full'] +
+                 result['leave_one_out'])
+        print "%8d %7d %7d %-12s %5d %12.3f %8.3f %13.3f %9.3f %9.1f %12.3g" % (
+          num_observations, num_batches, num_unique, engine, n,
+          result['construction'], result['full'], result['leave_one_out'],
+          total, result['peak_memory'], difference)
+        sys.stdout.flush()
+  return passed
+
+
+if __name__ == '__main__':
+  from argparse import ArgumentParser
+
+  directory = os.path.dirname(os.path.abspath(__file__))
+  parser = ArgumentParser(
+    description="Benchmark compute_delta_cchalf.py on synthetic data and "
+                "check it against the xdscc12 logs")
+  parser.add_argument("--observations", type=int, nargs="+",
+                      default=[10000, 100000, 1000000],
+                      help="The number of observations of each dataset")
+  parser.add_argument("--batches", type=int, nargs="+", default=[180],
+                      help="The number of batches of each dataset")
+  parser.add_argument("--unique", type=int, nargs="+", default=[11643],
+                      help="The number of unique reflections of each dataset")
+  parser.add_argument("--engines", nargs="+",
+                      default=["array", "incremental", "dict"],
+                      choices=["array", "incremental", "dict"],
+                      help="The engines to benchmark")
+  parser.add_argument("--nproc", type=int, nargs="+", default=[1],
+                      help="The numbers of processes to benchmark")
+  parser.add_argument("--nbins", type=int, default=10,
+                      help="The number of resolution bins")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="The random seed")
+  parser.add_argument("--dict_max_observations", type=int, default=20000,
+                      help="Skip the dict engine for larger datasets")
+  parser.add_argument("--xds_ascii", default=None,
+                      help="The insulin XDS_ASCII.HKL file the xdscc12 logs "
+                           "were computed from")
+  parser.add_argument("--log_w", default=os.path.join(
+                        directory, "xdscc12_insulin_XDS_ASCII-options_w.log"),
+                      help="The xdscc12 log with the options -w")
+  parser.add_argument("--log_wz", default=os.path.join(
+                        directory, "xdscc12_insulin_XDS_ASCII-options_wz.log"),
+                      help="The xdscc12 log with the options -w -z")
+  parser.add_argument("--tolerance", type=float, default=0.01,
+                      help="The tolerance in %% against the xdscc12 logs")
+  parser.add_argument("--fisher_tolerance", type=float, default=0.1,
+                      help="The tolerance on the Fisher transformed Delta "
+                           "CC 1/2 against the xdscc12 logs")
+  parser.add_argument("--regression", default=os.path.join(
+                        directory, "regression_delta_cchalf.txt"),
+                      help="The regression fixture")
+  parser.add_argument("--write_regression", action="store_true",
+                      help="Write the regression fixture and exit")
+  args = parser.parse_args()
+
+  if args.write_regression:
+    write_regression_fixture(args.regression, nbins=args.nbins)
+    print "Wrote %s" % args.regression
+    sys.exit(0)
+
+  # Every combination of the dataset sizes
+  sizes = [
+    (o, b, u)
+    for o in args.observations
+    for b in args.batches
+    for u in args.unique]
+
+  passed = run_benchmarks(
+    sizes,
+    args.engines,
+    args.nproc,
+    nbins=args.nbins,
+    seed=args.seed,
+    dict_max_observations=args.dict_max_observations)
+  checks = {
+    'regression fixture' : check_regression_fixture(
+      args.regression, args.engines, nbins=args.nbins),
+    'xdscc12 logs' : check_reference_logs(
+      args.log_w,
+      args.log_wz,
+      xds_ascii=args.xds_ascii,
+      tolerance=args.tolerance,
+      fisher_tolerance=args.fisher_tolerance),
+  }
+  skipped = sorted(name for name, result in checks.items() if result is None)
+  passed = passed and False not in checks.values()
+  print ""
+  if not passed:
+    print "Some checks FAILED"
+  elif len(skipped) > 0:
+    print "The checks run passed; SKIPPED: %s" % ", ".join(skipped)
+  else:
+    print "All checks passed"
+  sys.exit(0 if passed else 1)
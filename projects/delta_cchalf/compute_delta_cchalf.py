@@ -7,7 +7,29 @@ from matplotlib import cm
 from math import sqrt, floor
 from cctbx import miller
 from cctbx import crystal
+from cctbx.array_family import flex
 from collections import defaultdict
+import ctypes
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np
+import tempfile
+import time
+
+
+def compute_d_star_sq(unit_cell, miller_index):
+  '''
+  Compute 1/d**2 for an array of miller indices using the reciprocal metrical
+  matrix of the unit cell
+
+  :param unit_cell: A unit cell object
+  :param miller_index: The (N, 3) array of miller indices
+  :returns: The array of 1/d**2
+
+  '''
+  aa, bb, cc, ab, ac, bc = unit_cell.reciprocal_metrical_matrix()
+  h, k, l = as_numpy_array(miller_index, np.float64).reshape(-1, 3).T
+  return (h*h*aa + k*k*bb + l*l*cc + 2*(h*k*ab + h*l*ac + k*l*bc))
 
 
 class ResolutionBinner(object):
@@ -16,7 +38,7 @@ class ResolutionBinner(object):
 
   '''
 
-  def __init__(self, unit_cell, dmin, dmax, nbins):
+  def __init__(self, unit_cell, dmin, dmax, nbins, verbose=True):
     '''
     Initialise the binner
 
@@ -24,9 +46,11 @@ class ResolutionBinner(object):
     :param dmin: The maximum resolution
     :param dmax: The minimum resolution
     :param nbins: The number of bins
+    :param verbose: Print the resolution bins
 
     '''
-    print "Resolution bins"
+    if verbose:
+      print "Resolution bins"
     assert dmin < dmax
     dmin_inv_sq = 1.0 / dmin**2
     dmax_inv_sq = 1.0 / dmax**2
@@ -38,9 +62,11 @@ class ResolutionBinner(object):
     self._bin_range = self._xmax - self._xmin
     self._bin_size = self._bin_range / self._nbins
     self._bins = []
+    self._index_cache = {}
     for i in range(self._nbins):
       b0, b1 = self._xmin + i * self._bin_size, self._xmin + (i+1)*self._bin_size
-      print "%d: %.3f, %.3f" % (i, sqrt(1/b0**2), sqrt(1/b1**2))
+      if verbose:
+        print "%d: %.3f, %.3f" % (i, sqrt(1/b0**2), sqrt(1/b1**2))
       self._bins.append((b0,b1))
 
   def nbins(self):
@@ -58,6 +84,10 @@ class ResolutionBinner(object):
     :returns: The bin index
 
     '''
+    try:
+      return self._index_cache[h]
+    except KeyError:
+      pass
     d = self._unit_cell.d(h)
     d2 = 1/d**2
     bin_index = int(floor((d2 - self._xmin) / self._bin_size))
@@ -65,8 +95,35 @@ class ResolutionBinner(object):
       bin_index = self._nbins-1
     if bin_index < 0:
       bin_index = 0
+    self._index_cache[h] = bin_index
     return bin_index
 
+  def indices(self, miller_index):
+    '''
+    Get the bin indices from an array of miller indices using vectorized
+    d-spacings
+
+    :param miller_index: The (N, 3) array of miller indices
+    :returns: The array of bin indices
+
+    '''
+    d2 = compute_d_star_sq(self._unit_cell, miller_index)
+    bin_index = np.floor((d2 - self._xmin) / self._bin_size).astype(np.int64)
+    return np.clip(bin_index, 0, self._nbins-1)
+
+  def precompute(self, miller_index):
+    '''
+    Compute the bin indices of a set of miller indices in bulk and memoize
+    them so that later calls to index() do not recompute the d-spacings
+
+    :param miller_index: The list of miller index tuples
+
+    '''
+    miller_index = list(miller_index)
+    if len(miller_index) > 0:
+      bin_index = self.indices(np.array(miller_index, dtype=np.int64))
+      self._index_cache.update(zip(miller_index, bin_index.tolist()))
+
 
 class ReflectionSum(object):
   '''
@@ -129,6 +186,629 @@ def compute_mean_cchalf_in_bins(bin_data):
   return mean_cchalf
 
 
+def compute_mean_cchalf_from_arrays(mean, var, bin_index, nbins):
+  '''
+  Compute the mean cchalf averaged across resolution bins using group-by
+  reductions over arrays rather than lists of values in each bin
+
+  :param mean: The array of mean intensities
+  :param var: The array of variances on the half set of mean intensities
+  :param bin_index: The resolution bin of each mean intensity
+  :param nbins: The number of bins
+  :returns: The mean CC 1/2
+
+  '''
+  count = np.bincount(bin_index, minlength=nbins)
+  mean_of_means = np.bincount(bin_index, weights=mean, minlength=nbins)
+  sigma_e = np.bincount(bin_index, weights=var, minlength=nbins)
+  selection = count > 1
+  mean_of_means[selection] /= count[selection]
+  sigma_e[selection] /= count[selection]
+  deviation = mean - mean_of_means[bin_index]
+  sigma_y = np.bincount(bin_index, weights=deviation**2, minlength=nbins)
+  sigma_y[selection] /= count[selection] - 1
+  sigma_e = sigma_e[selection]
+  sigma_y = sigma_y[selection]
+  cchalf = (sigma_y - sigma_e) / (sigma_y + sigma_e)
+  count = count[selection]
+  return float(np.dot(count, cchalf)) / int(count.sum())
+
+
+# Offset added to each component of a miller index before packing
+_MILLER_INDEX_OFFSET = 1 << 20
+
+
+def pack_miller_index(miller_index):
+  '''
+  Pack an (N, 3) array of miller indices into a single int64 code per index
+
+  :param miller_index: The array of miller indices
+  :returns: The array of codes
+
+  '''
+  h = miller_index.astype(np.int64) + _MILLER_INDEX_OFFSET
+  return (h[:,0] << 42) | (h[:,1] << 21) | h[:,2]
+
+
+def unpack_miller_index(code):
+  '''
+  Unpack an array of codes created by pack_miller_index
+
+  :param code: The array of codes
+  :returns: The (N, 3) array of miller indices
+
+  '''
+  mask = (1 << 21) - 1
+  h = np.empty((len(code), 3), dtype=np.int64)
+  h[:,0] = (code >> 42) & mask
+  h[:,1] = (code >> 21) & mask
+  h[:,2] = code & mask
+  return h - _MILLER_INDEX_OFFSET
+
+
+def as_numpy_array(data, dtype):
+  '''
+  Convert a flex array, list or numpy array to a numpy array
+
+  '''
+  if hasattr(data, 'as_vec3_double'):
+    data = data.as_vec3_double()
+  if hasattr(data, 'as_numpy_array'):
+    data = data.as_numpy_array()
+  return np.asarray(data, dtype=dtype)
+
+
+def map_to_asu(code, crystal_symmetry):
+  '''
+  Map packed miller index codes to the codes of their ASU equivalents. Only
+  the distinct codes are mapped with cctbx.
+
+  :param code: The array of packed miller indices
+  :param crystal_symmetry: The crystal symmetry
+  :returns: The array of packed ASU miller indices
+
+  '''
+  unique_code, inverse = np.unique(code, return_inverse=True)
+  indices = flex.miller_index(
+    [tuple(h) for h in unpack_miller_index(unique_code).tolist()])
+  indices = miller.set(crystal_symmetry, indices).map_to_asu().indices()
+  asu_code = pack_miller_index(as_numpy_array(indices, np.int64).reshape(-1, 3))
+  return asu_code[inverse]
+
+
+class ReflectionSumAccumulator(object):
+  '''
+  A helper class to accumulate Sum(X), Sum(X**2) and n for every unique
+  reflection from chunks of observations, and Sum(w), Sum(w*X) and
+  Sum(w*X**2) if weighted.
+
+  The unique reflections are kept as a sorted array of packed miller indices
+  so that the memory scales with the number of unique reflections and not with
+  the number of observations. Each chunk only updates the entries of its own
+  reflections, and the table is only grown, by a sorted merge, when a chunk
+  has new reflections.
+
+  '''
+  def __init__(self, weighted=False):
+    self.code = np.zeros(0, dtype=np.int64)
+    self.sum_x = np.zeros(0)
+    self.sum_x2 = np.zeros(0)
+    self.n = np.zeros(0, dtype=np.int64)
+    self.weighted = weighted
+    self._names = ('sum_x', 'sum_x2', 'n')
+    if weighted:
+      self.sum_w = np.zeros(0)
+      self.sum_wx = np.zeros(0)
+      self.sum_wx2 = np.zeros(0)
+      self._names += ('sum_w', 'sum_wx', 'sum_wx2')
+
+  def add(self, code, intensity, weight=None):
+    '''
+    Add a chunk of observations
+
+    :param code: The packed ASU miller index of each observation
+    :param intensity: The intensity of each observation
+    :param weight: The weight of each observation if weighted
+
+    '''
+    # Reduce the chunk to sums for each of its unique reflections, so that
+    # only those entries of the table are touched
+    code, index = np.unique(code, return_inverse=True)
+    position = np.searchsorted(self.code, code)
+    found = position < len(self.code)
+    found[found] = self.code[position[found]] == code[found]
+    if not found.all():
+      # Merge the new reflections into the sorted table
+      new_position = position[~found]
+      for name in self._names:
+        setattr(self, name, np.insert(getattr(self, name), new_position, 0))
+      self.code = np.insert(self.code, new_position, code[~found])
+      position = np.searchsorted(self.code, code)
+    def reduce_by_reflection(weights=None):
+      return np.bincount(index, weights=weights)
+    self.sum_x[position] += reduce_by_reflection(intensity)
+    self.sum_x2[position] += reduce_by_reflection(intensity**2)
+    self.n[position] += reduce_by_reflection()
+    if self.weighted:
+      self.sum_w[position] += reduce_by_reflection(weight)
+      self.sum_wx[position] += reduce_by_reflection(weight*intensity)
+      self.sum_wx2[position] += reduce_by_reflection(weight*intensity**2)
+
+  def reflection_id(self, code):
+    '''
+    :param code: The packed ASU miller indices
+    :returns: The unique reflection ids
+
+    '''
+    return np.searchsorted(self.code, code)
+
+  @property
+  def miller_index(self):
+    return unpack_miller_index(self.code)
+
+  def __len__(self):
+    return len(self.n)
+
+
+class ReflectionSumArrays(object):
+  '''
+  A helper class to store Sum(X), Sum(X**2) and n for every unique
+  reflection as arrays.
+
+  Each observation is integer coded by its unique reflection once so that the
+  sums are group-by reductions with numpy.bincount.
+
+  '''
+  def __init__(self, miller_index, intensity, weight=None):
+    '''
+    Initialise
+
+    :param miller_index: The (N, 3) array of ASU miller indices
+    :param intensity: The array of intensities
+    :param weight: The optional array of weights. If given, Sum(w), Sum(w*X)
+                   and Sum(w*X**2) are also computed
+
+    '''
+    code = pack_miller_index(miller_index)
+    unique_code, self.reflection_id = np.unique(code, return_inverse=True)
+    self.miller_index = unpack_miller_index(unique_code)
+    num_unique = len(unique_code)
+    self.sum_x = np.bincount(
+      self.reflection_id, weights=intensity, minlength=num_unique)
+    self.sum_x2 = np.bincount(
+      self.reflection_id, weights=intensity**2, minlength=num_unique)
+    self.n = np.bincount(self.reflection_id, minlength=num_unique)
+    self.weighted = weight is not None
+    if self.weighted:
+      self.sum_w = np.bincount(
+        self.reflection_id, weights=weight, minlength=num_unique)
+      self.sum_wx = np.bincount(
+        self.reflection_id, weights=weight*intensity, minlength=num_unique)
+      self.sum_wx2 = np.bincount(
+        self.reflection_id, weights=weight*intensity**2, minlength=num_unique)
+
+  def __len__(self):
+    return len(self.n)
+
+
+def compute_cchalf_from_sum_arrays(sum_x, sum_x2, n, bin_index, nbins):
+  '''
+  Compute the mean CC 1/2 from arrays of Sum(X), Sum(X**2) and n
+
+  :param sum_x: The Sum(X) for each unique reflection
+  :param sum_x2: The Sum(X**2) for each unique reflection
+  :param n: The number of observations of each unique reflection
+  :param bin_index: The resolution bin of each unique reflection
+  :param nbins: The number of bins
+  :returns: The mean CC 1/2
+
+  '''
+  selection = n > 1
+  sum_x = sum_x[selection]
+  sum_x2 = sum_x2[selection]
+  n = n[selection]
+  mean = sum_x / n
+  var = (sum_x2 - sum_x**2 / n) / (n-1)
+  var = var / n
+  return compute_mean_cchalf_from_arrays(
+    mean, var, bin_index[selection], nbins)
+
+
+def bin_contributions(sum_x, sum_x2, n):
+  '''
+  Compute the contribution of each reflection to the running totals of its
+  resolution bin. Reflections with fewer than two observations contribute
+  nothing.
+
+  :param sum_x: The Sum(X) for each reflection
+  :param sum_x2: The Sum(X**2) for each reflection
+  :param n: The number of observations of each reflection
+  :returns: A (4, N) array of mean, mean**2, variance and count
+
+  '''
+  count = (n > 1).astype(np.float64)
+  n = np.where(n > 1, n, 2)
+  mean = count * sum_x / n
+  var = count * (sum_x2 - sum_x**2 / n) / (n-1) / n
+  return np.array([mean, mean**2, var, count])
+
+
+def weighted_bin_contributions(sum_w, sum_wx, sum_wx2, n):
+  '''
+  Compute the contribution of each reflection to the running totals of its
+  resolution bin using the sigma weighted mean and its variance. With unit
+  weights this is the same as bin_contributions.
+
+  :param sum_w: The Sum(w) for each reflection
+  :param sum_wx: The Sum(w*X) for each reflection
+  :param sum_wx2: The Sum(w*X**2) for each reflection
+  :param n: The number of observations of each reflection
+  :returns: A (4, N) array of mean, mean**2, variance and count
+
+  '''
+  count = (n > 1).astype(np.float64)
+  sum_w = np.where(n > 1, sum_w, 1)
+  n = np.where(n > 1, n, 2)
+  mean = count * sum_wx / sum_w
+  var = count * (sum_wx2 - sum_wx**2 / sum_w) / sum_w / (n-1)
+  return np.array([mean, mean**2, var, count])
+
+
+def compute_mean_cchalf_from_bin_totals(totals):
+  '''
+  Compute the mean cchalf averaged across resolution bins from the running
+  totals of Sum(mean), Sum(mean**2), Sum(var) and count in each bin
+
+  :param totals: A (4, nbins) array of totals
+  :returns: The mean CC 1/2
+
+  '''
+  sum_mean, sum_mean2, sum_var, count = totals
+  selection = count > 1.5
+  sum_mean = sum_mean[selection]
+  sum_mean2 = sum_mean2[selection]
+  sum_var = sum_var[selection]
+  count = count[selection]
+  sigma_e = sum_var / count
+  sigma_y = (sum_mean2 - sum_mean**2 / count) / (count-1)
+  cchalf = (sigma_y - sigma_e) / (sigma_y + sigma_e)
+  return float(np.dot(count, cchalf)) / int(round(count.sum()))
+
+
+class ResolutionBinTotals(object):
+  '''
+  A helper class to store the running totals of Sum(mean), Sum(mean**2),
+  Sum(var) and count in each resolution bin.
+
+  Changing the sums of a set of reflections only needs the contributions of
+  those reflections to be updated, so the cost is proportional to the number
+  of reflections changed rather than the number of unique reflections.
+
+  If the weighted sums are given, the totals for the sigma weighted means are
+  kept in rows 4 to 7 and are updated in the same pass as the unweighted ones.
+
+  '''
+  def __init__(self, sum_x, sum_x2, n, bin_index, nbins, weighted_sums=None):
+    '''
+    Initialise
+
+    :param sum_x: The Sum(X) for each unique reflection
+    :param sum_x2: The Sum(X**2) for each unique reflection
+    :param n: The number of observations of each unique reflection
+    :param bin_index: The resolution bin of each unique reflection
+    :param nbins: The number of bins
+    :param weighted_sums: The optional (sum_w, sum_wx, sum_wx2) for each
+                          unique reflection
+
+    '''
+    self.bin_index = bin_index
+    self.nbins = nbins
+    sums = (sum_x, sum_x2, n)
+    if weighted_sums is not None:
+      sums = sums + tuple(weighted_sums)
+    self.totals = self._reduce(bin_index, self._contributions(sums))
+
+  def _contributions(self, sums):
+    sum_x, sum_x2, n = sums[:3]
+    contributions = bin_contributions(sum_x, sum_x2, n)
+    if len(sums) > 3:
+      contributions = np.concatenate((
+        contributions, weighted_bin_contributions(*(sums[3:] + (n,)))))
+    return contributions
+
+  def _reduce(self, bin_index, contributions):
+    return np.array([
+      np.bincount(bin_index, weights=c, minlength=self.nbins)
+      for c in contributions])
+
+  def difference(self, reflection_id, old_sums, new_sums):
+    '''
+    Compute the change in the totals when the sums of some reflections change
+
+    :param reflection_id: The ids of the reflections which change
+    :param old_sums: The (sum_x, sum_x2, n) of the reflections before, followed
+                     by (sum_w, sum_wx, sum_wx2) if weighted
+    :param new_sums: The sums of the reflections after
+    :returns: A (4, nbins) or (8, nbins) array of differences
+
+    '''
+    contributions = self._contributions(new_sums) - self._contributions(old_sums)
+    return self._reduce(self.bin_index[reflection_id], contributions)
+
+  def mean_cchalf(self, difference=None):
+    '''
+    Compute the mean CC 1/2 from the totals
+
+    :param difference: An optional change to apply to the totals
+    :returns: The mean CC 1/2
+
+    '''
+    if difference is None:
+      return compute_mean_cchalf_from_bin_totals(self.totals[:4])
+    return compute_mean_cchalf_from_bin_totals(
+      self.totals[:4] + difference[:4])
+
+  def mean_cchalf_weighted(self, difference=None):
+    '''
+    Compute the mean CC 1/2 of the sigma weighted means from the totals
+
+    :param difference: An optional change to apply to the totals
+    :returns: The mean CC 1/2
+
+    '''
+    if difference is None:
+      return compute_mean_cchalf_from_bin_totals(self.totals[4:])
+    return compute_mean_cchalf_from_bin_totals(
+      self.totals[4:] + difference[4:])
+
+
+class BatchExclusion(object):
+  '''
+  A class to compute the CC 1/2 with ranges of observations excluded.
+
+  The observations must be sorted so that each batch is a contiguous range of
+  the reflection_id and intensity arrays.
+
+  '''
+  def __init__(self, arrays, nbins, incremental):
+    '''
+    Initialise
+
+    :param arrays: A dictionary of the reflection_id and intensity of each
+                   observation and the sum_x, sum_x2, n and bin_index of each
+                   unique reflection. If it also has the weight of each
+                   observation and the sum_w, sum_wx and sum_wx2 of each unique
+                   reflection then the CC 1/2 of the sigma weighted means is
+                   computed as well (incremental only)
+    :param nbins: The number of bins
+    :param incremental: Update running totals in resolution bins
+
+    '''
+    self._arrays = arrays
+    self._nbins = nbins
+    self._bin_totals = None
+    self._weighted = 'sum_w' in arrays
+    assert incremental or not self._weighted
+    if incremental:
+      self._make_bin_totals()
+
+  def _make_bin_totals(self):
+    '''
+    Compute the running totals in each resolution bin from the sums
+
+    '''
+    arrays = self._arrays
+    weighted_sums = None
+    if self._weighted:
+      weighted_sums = (arrays['sum_w'], arrays['sum_wx'], arrays['sum_wx2'])
+    self._bin_totals = ResolutionBinTotals(
+      arrays['sum_x'],
+      arrays['sum_x2'],
+      arrays['n'],
+      arrays['bin_index'],
+      self._nbins,
+      weighted_sums=weighted_sums)
+
+  def remove(self, ranges):
+    '''
+    Remove ranges of observations from the sums of each unique reflection in
+    place, e.g. to reject batches. The running totals in each resolution bin
+    are then recomputed from the sums.
+
+    :param ranges: The list of (start, end) of each range
+
+    '''
+    arrays = self._arrays
+    selection = np.concatenate([np.arange(i0, i1) for i0, i1 in ranges])
+    reflection_id = arrays['reflection_id'][selection]
+    I = arrays['intensity'][selection]
+    num_unique = len(arrays['n'])
+    def reduce_by_reflection(weights=None):
+      return np.bincount(reflection_id, weights=weights, minlength=num_unique)
+    arrays['sum_x'] -= reduce_by_reflection(I)
+    arrays['sum_x2'] -= reduce_by_reflection(I**2)
+    arrays['n'] -= reduce_by_reflection()
+    if self._weighted:
+      weight = arrays['weight'][selection]
+      arrays['sum_w'] -= reduce_by_reflection(weight)
+      arrays['sum_wx'] -= reduce_by_reflection(weight*I)
+      arrays['sum_wx2'] -= reduce_by_reflection(weight*I**2)
+    if self._bin_totals is not None:
+      self._make_bin_totals()
+
+  def mean_cchalf(self):
+    '''
+    Compute the CC 1/2 with no observations excluded. If weighted, a tuple of
+    the unweighted and weighted CC 1/2 is returned.
+
+    '''
+    if self._weighted:
+      return (
+        self._bin_totals.mean_cchalf(),
+        self._bin_totals.mean_cchalf_weighted())
+    if self._bin_totals is not None:
+      return self._bin_totals.mean_cchalf()
+    arrays = self._arrays
+    return compute_cchalf_from_sum_arrays(
+      arrays['sum_x'], arrays['sum_x2'], arrays['n'], arrays['bin_index'],
+      self._nbins)
+
+  def compute(self, ranges):
+    '''
+    Compute the CC 1/2 with each range of observations excluded
+
+    :param ranges: The list of (start, end) of each range
+    :returns: The list of CC 1/2 values
+
+    '''
+    return [self.compute_one(i0, i1) for i0, i1 in ranges]
+
+  def compute_one(self, i0, i1):
+    '''
+    Compute the CC 1/2 with a single range of observations excluded.
+
+    '''
+    weight = None
+    if self._weighted:
+      weight = self._arrays['weight'][i0:i1]
+    return self.exclude(
+      self._arrays['reflection_id'][i0:i1],
+      self._arrays['intensity'][i0:i1],
+      weight)
+
+  def exclude(self, reflection_id, I, weight=None):
+    '''
+    Compute the CC 1/2 with a set of observations excluded.
+
+    The sums of the reflections in the set are reduced with a bincount. With
+    the incremental engine only the contributions of those reflections to the
+    bin totals are updated, otherwise they are subtracted from a copy of the
+    overall sums and the CC 1/2 is recomputed from scratch.
+
+    :param reflection_id: The unique reflection id of each observation
+    :param I: The intensity of each observation
+    :param weight: The weight of each observation if weighted
+    :returns: The CC 1/2, or the unweighted and weighted CC 1/2 if weighted
+
+    '''
+    arrays = self._arrays
+    reflection_id, index = np.unique(reflection_id, return_inverse=True)
+    sum_x = np.bincount(index, weights=I)
+    sum_x2 = np.bincount(index, weights=I**2)
+    n = np.bincount(index)
+    if self._bin_totals is not None:
+      names = ['sum_x', 'sum_x2', 'n']
+      sums = [sum_x, sum_x2, n]
+      if self._weighted:
+        names += ['sum_w', 'sum_wx', 'sum_wx2']
+        sums += [
+          np.bincount(index, weights=weight),
+          np.bincount(index, weights=weight*I),
+          np.bincount(index, weights=weight*I**2)]
+      old_sums = tuple(arrays[name][reflection_id] for name in names)
+      new_sums = tuple(old - s for old, s in zip(old_sums, sums))
+      difference = self._bin_totals.difference(
+        reflection_id, old_sums, new_sums)
+      if self._weighted:
+        return (
+          self._bin_totals.mean_cchalf(difference),
+          self._bin_totals.mean_cchalf_weighted(difference))
+      return self._bin_totals.mean_cchalf(difference)
+    new_sum_x = arrays['sum_x'].copy()
+    new_sum_x2 = arrays['sum_x2'].copy()
+    new_n = arrays['n'].copy()
+    new_sum_x[reflection_id] -= sum_x
+    new_sum_x2[reflection_id] -= sum_x2
+    new_n[reflection_id] -= n
+    return compute_cchalf_from_sum_arrays(
+      new_sum_x, new_sum_x2, new_n, arrays['bin_index'], self._nbins)
+
+
+def to_shared_memory(array):
+  '''
+  Copy a numpy array into a block of shared memory
+
+  :param array: The numpy array
+  :returns: The shared memory block and the dtype of the array
+
+  '''
+  shared = multiprocessing.sharedctypes.RawArray(ctypes.c_byte, array.nbytes)
+  np.frombuffer(shared, dtype=array.dtype)[:] = array
+  return shared, array.dtype
+
+
+def from_shared_memory(shared, dtype):
+  '''
+  Get a numpy array view of a block of shared memory
+
+  '''
+  return np.frombuffer(shared, dtype=dtype)
+
+
+# The batch exclusion object in each worker process
+_worker_batch_exclusion = None
+
+
+def _init_batch_exclusion_worker(shared_arrays, nbins, incremental):
+  global _worker_batch_exclusion
+  arrays = dict(
+    (name, from_shared_memory(*value))
+    for name, value in shared_arrays.iteritems())
+  _worker_batch_exclusion = BatchExclusion(arrays, nbins, incremental)
+
+
+def _compute_batch_exclusion_in_worker(ranges):
+  return _worker_batch_exclusion.compute(ranges)
+
+
+def compute_cchalf_excluding_ranges_in_parallel(arrays,
+                                                nbins,
+                                                incremental,
+                                                ranges,
+                                                nproc):
+  '''
+  Compute the CC 1/2 with each range of observations excluded on a pool of
+  processes.
+
+  The arrays are copied once into shared memory which the workers map
+  rather than receiving pickled copies. The ranges are split into contiguous
+  chunks and the results are returned in the same order as the ranges.
+
+  :param arrays: The dictionary of arrays (see BatchExclusion)
+  :param nbins: The number of bins
+  :param incremental: Update running totals in resolution bins
+  :param ranges: The list of (start, end) of each range
+  :param nproc: The number of processes
+  :returns: The list of CC 1/2 values
+
+  '''
+  shared_arrays = dict(
+    (name, to_shared_memory(array)) for name, array in arrays.iteritems())
+  num_chunks = min(len(ranges), 4 * nproc)
+  chunks = [
+    ranges[len(ranges) * i // num_chunks:len(ranges) * (i+1) // num_chunks]
+    for i in range(num_chunks)]
+  pool = multiprocessing.Pool(
+    nproc,
+    initializer=_init_batch_exclusion_worker,
+    initargs=(shared_arrays, nbins, incremental))
+  try:
+    results = pool.map(_compute_batch_exclusion_in_worker, chunks)
+  finally:
+    pool.close()
+    pool.join()
+  return [cchalf for chunk in results for cchalf in chunk]
+
+
+def fisher_transform(cchalf):
+  '''
+  Fisher transform a CC 1/2 value so that differences are comparable over a
+  range of CC 1/2 values
+
+  '''
+  return float(np.arctanh(cchalf))
+
+
 class PerImageCChalfStatistics(object):
   '''
   A class to compute per image CC 1/2 statistics
@@ -144,11 +824,15 @@ class PerImageCChalfStatistics(object):
                space_group,
                nbins=10, 
                dmin=None, 
-               dmax=None):
+               dmax=None,
+               engine='array',
+               nproc=1,
+               weighted=False,
+               group=None):
     '''
     Initialise
 
-    :param miller_index: The list of miller indices
+    :param miller_index: The list of miller indices (flex or (N, 3) array)
     :param batch: The list of batch numbers
     :param intensity: The list of intensities
     :param variance: The list of variances
@@ -157,21 +841,48 @@ class PerImageCChalfStatistics(object):
     :param nbins: The number of bins
     :param dmin: The maximum resolution
     :param dmax: The minimum resolution
+    :param engine: The engine used to compute the sums ('array',
+                   'incremental' or 'dict')
+    :param nproc: The number of processes used to compute the CC 1/2 excluding
+                  each batch with the array engines
+    :param weighted: Also compute the CC 1/2 of the sigma weighted means, in
+                     the same pass (incremental engine only)
+    :param group: A dictionary or function giving the group of each batch
+                  number, e.g. the dataset in a multi-crystal job. If set, the
+                  CC 1/2 is computed with each group excluded rather than each
+                  batch (array and incremental engines only)
       
     '''
     
+    if engine == 'dict' and nproc > 1:
+      raise ValueError("nproc > 1 requires the array or incremental engine")
+    if weighted and engine != 'incremental':
+      raise ValueError("weighted requires the incremental engine")
+    if group is not None and engine == 'dict':
+      raise ValueError("group requires the array or incremental engine")
+    self._nproc = nproc
+    self._weighted = weighted
+    self._arrays = None
+    self._start_time = time.time()
+    self._timing = {}
+
+    # The input may be flex arrays or numpy arrays
+    miller_index = as_numpy_array(miller_index, np.int64).reshape(-1, 3)
+    batch = as_numpy_array(batch, np.int64)
+    intensity = as_numpy_array(intensity, np.float64)
+    variance = as_numpy_array(variance, np.float64)
+
     # Reject reflections with negative variance
     selection = variance > 0
-    miller_index = miller_index.select(selection)
-    batch = batch.select(selection)
-    intensity = intensity.select(selection)
-    variance = variance.select(selection)
+    miller_index = miller_index[selection]
+    batch = batch[selection]
+    intensity = intensity[selection]
+    variance = variance[selection]
 
     # Map the miller indices to the ASU
     cs = crystal.symmetry(unit_cell, space_group=space_group)
-    ms = miller.set(cs, miller_index)
-    ms_asu = ms.map_to_asu()
-    miller_index = ms_asu.indices()
+    miller_index = unpack_miller_index(
+      map_to_asu(pack_miller_index(miller_index), cs))
 
     # Save the arrays
     self._miller_index = miller_index
@@ -180,16 +891,37 @@ class PerImageCChalfStatistics(object):
     self._variance = variance
 
     # Create the resolution bins
-    D = [unit_cell.d(h) for h in miller_index]
+    d_star_sq = compute_d_star_sq(unit_cell, miller_index)
     self._num_bins = nbins
     self._dmin = dmin
     self._dmax = dmax
     if dmin is None:
-      self._dmin = min(D)
+      self._dmin = 1 / sqrt(d_star_sq.max())
     if dmax is None:
-      self._dmax = max(D)
+      self._dmax = 1 / sqrt(d_star_sq.min())
     binner = ResolutionBinner(unit_cell, self._dmin, self._dmax, nbins)
 
+    if engine in ('array', 'incremental'):
+      self._compute_with_arrays(binner, miller_index, batch, intensity,
+                                variance,
+                                incremental=(engine == 'incremental'),
+                                weighted=weighted,
+                                group=group)
+    elif engine == 'dict':
+      self._compute_with_dicts(binner, miller_index, batch, intensity)
+    else:
+      raise ValueError("Unknown engine: %s" % engine)
+
+  def _compute_with_dicts(self, binner, miller_index, batch, intensity):
+    '''
+    Compute the statistics using dictionaries of sums keyed by miller index
+
+    '''
+    miller_index = [tuple(h) for h in miller_index.tolist()]
+    batch = batch.tolist()
+    intensity = intensity.tolist()
+    self._intensity = intensity
+
     # Create lookups for elements by miller index
     index_lookup = defaultdict(list)
     for i, h in enumerate(miller_index):
@@ -204,6 +936,9 @@ class PerImageCChalfStatistics(object):
       sum_x2 = sum(II**2 for II in I)
       reflection_sums[h] = ReflectionSum(sum_x, sum_x2, n)
 
+    # Compute the resolution bin of each unique reflection once
+    binner.precompute(reflection_sums.keys())
+
     # Compute some numbers
     self._num_batches = len(set(batch))
     self._num_reflections = len(miller_index)
@@ -214,13 +949,197 @@ class PerImageCChalfStatistics(object):
     print "# Reflections: ", self._num_reflections
     print "# Unique: ", self._num_unique
    
+    self._timing['construction'] = time.time() - self._start_time
+   
     # Compute the CC 1/2 for all the data
+    start_time = time.time()
     self._cchalf_mean = self._compute_cchalf(reflection_sums, binner)
     print "CC 1/2 mean: %.3f" % (100*self._cchalf_mean)
+    self._timing['full'] = time.time() - start_time
    
     # Compute the CC 1/2 excluding each batch in turn
+    start_time = time.time()
     self._cchalf = self._compute_cchalf_excluding_each_batch(
       reflection_sums, binner, miller_index, batch, intensity) 
+    self._timing['leave_one_out'] = time.time() - start_time
+
+  def _compute_with_arrays(self,
+                           binner,
+                           miller_index,
+                           batch,
+                           intensity,
+                           variance,
+                           incremental=False,
+                           weighted=False,
+                           group=None):
+    '''
+    Compute the statistics using arrays of sums indexed by an integer code for
+    each unique reflection. If incremental is set then the CC 1/2 is computed
+    from running totals in each resolution bin and only the reflections in
+    each batch are updated when that batch is excluded. If weighted is set then
+    the CC 1/2 of the sigma weighted means is computed in the same pass.
+
+    The arrays are kept so that groups can later be rejected by subtracting
+    them from the sums (see reject_iteratively).
+
+    '''
+    # Compute the Overall Sum(X) and Sum(X^2) for each unique reflection
+    weight = None
+    if weighted:
+      weight = 1 / variance
+    reflection_sums = ReflectionSumArrays(miller_index, intensity, weight)
+    bin_index = binner.indices(reflection_sums.miller_index)
+
+    # Compute some numbers
+    self._num_batches = len(np.unique(batch))
+    self._num_reflections = len(miller_index)
+    self._num_unique = len(reflection_sums)
+
+    print ""
+    print "# Batches: ", self._num_batches
+    print "# Reflections: ", self._num_reflections
+    print "# Unique: ", self._num_unique
+
+    # Assign each observation to a group, by default its batch
+    batch_numbers, batch_index = np.unique(batch, return_inverse=True)
+    if group is None:
+      self._group_name = "batch"
+      group_keys = [int(b) for b in batch_numbers]
+      group_index = batch_index
+      self._group_num_batches = dict((key, 1) for key in group_keys)
+    else:
+      if isinstance(group, dict):
+        group = group.__getitem__
+      self._group_name = "group"
+      batch_group = [group(int(b)) for b in batch_numbers]
+      group_keys = sorted(set(batch_group))
+      lookup = dict((key, i) for i, key in enumerate(group_keys))
+      group_index = np.array(
+        [lookup[key] for key in batch_group], dtype=np.int64)[batch_index]
+      self._group_num_batches = dict(
+        (key, batch_group.count(key)) for key in group_keys)
+
+    # Sort the observations by group so that each group is a contiguous range
+    order = np.argsort(group_index, kind='mergesort')
+    group_start = np.searchsorted(
+      group_index[order], np.arange(len(group_keys)))
+    group_end = np.append(group_start[1:], len(order))
+    self._group_ranges = dict(
+      zip(group_keys, zip(group_start.tolist(), group_end.tolist())))
+    self._group_keys = group_keys
+    self._arrays = {
+      'reflection_id' : reflection_sums.reflection_id[order],
+      'intensity'     : intensity[order],
+      'sum_x'         : reflection_sums.sum_x,
+      'sum_x2'        : reflection_sums.sum_x2,
+      'n'             : reflection_sums.n,
+      'bin_index'     : bin_index,
+    }
+    if weighted:
+      self._arrays.update({
+        'weight'  : weight[order],
+        'sum_w'   : reflection_sums.sum_w,
+        'sum_wx'  : reflection_sums.sum_wx,
+        'sum_wx2' : reflection_sums.sum_wx2,
+      })
+    self._nbins = binner.nbins()
+    self._batch_exclusion = BatchExclusion(
+      self._arrays, self._nbins, incremental)
+    self._incremental = incremental
+    self._timing['construction'] = time.time() - self._start_time
+    self._compute_cchalf_with_arrays()
+
+  def _compute_cchalf_with_arrays(self):
+    '''
+    Compute the CC 1/2 for all the data and with each group excluded in turn
+    from the current arrays
+
+    '''
+    # Compute the CC 1/2 for all the data
+    start_time = time.time()
+    cchalf_mean = self._batch_exclusion.mean_cchalf()
+    if self._weighted:
+      self._cchalf_mean, self._cchalf_mean_weighted = cchalf_mean
+      print "CC 1/2 mean (weighted): %.3f" % (100*self._cchalf_mean_weighted)
+    else:
+      self._cchalf_mean = cchalf_mean
+    print "CC 1/2 mean: %.3f" % (100*self._cchalf_mean)
+    self._timing['full'] = time.time() - start_time
+
+    # Compute the CC 1/2 excluding each group in turn
+    start_time = time.time()
+    group_keys = self._group_keys
+    cchalf = self._compute_cchalf_excluding_each_batch_with_arrays(
+      [self._group_ranges[key] for key in group_keys])
+    if self._weighted:
+      cchalf_weighted = [cc[1] for cc in cchalf]
+      cchalf = [cc[0] for cc in cchalf]
+      self._cchalf_weighted = dict(zip(group_keys, cchalf_weighted))
+    self._cchalf = {}
+    for key, cc in zip(group_keys, cchalf):
+      self._cchalf[key] = cc
+      print "CC 1/2 excluding %s %s: %.3f" % (self._group_name, key, 100*cc)
+    self._timing['leave_one_out'] = time.time() - start_time
+
+  def reject_iteratively(self, threshold, max_cycles=None, max_per_cycle=None):
+    '''
+    Iteratively reject the groups (or batches) whose Delta CC 1/2 is greater
+    than a threshold, until none are left. At least two groups are always
+    kept; if more would be rejected, only the worst are rejected, a warning is
+    printed and the rejection stops.
+
+    Delta CC 1/2 here is the CC 1/2 without the group minus the CC 1/2 with
+    it, so a positive value means the group makes the data worse. The rejected
+    groups are subtracted from the sums of each unique reflection between
+    rounds rather than recomputing everything from scratch.
+
+    :param threshold: The Delta CC 1/2 above which groups are rejected
+    :param max_cycles: The maximum number of rounds
+    :param max_per_cycle: The maximum number of groups to reject each round,
+                          starting with the worst
+    :returns: The list of groups rejected in each round
+
+    '''
+    if self._arrays is None:
+      raise RuntimeError(
+        "Iterative rejection requires the array or incremental engine")
+    rejected = []
+    while max_cycles is None or len(rejected) < max_cycles:
+      delta_cchalf_i = self.delta_cchalf_i()
+      reject = sorted(
+        [key for key, value in delta_cchalf_i.iteritems() if value > threshold],
+        key=lambda key: delta_cchalf_i[key],
+        reverse=True)
+      if max_per_cycle is not None:
+        reject = reject[:max_per_cycle]
+      max_reject = max(len(self._group_keys) - 2, 0)
+      stop = len(reject) > max_reject
+      if stop:
+        print ""
+        print "Warning: rejecting %d of %d %s(s) would leave fewer than two; " \
+              "rejecting only the worst %d" % (
+                len(reject), len(self._group_keys), self._group_name,
+                max_reject)
+        reject = reject[:max_reject]
+      if len(reject) == 0:
+        break
+      print ""
+      print "Rejecting %d %s(s): %s" % (
+        len(reject), self._group_name, ", ".join(str(key) for key in reject))
+
+      # Subtract the rejected groups from the sums
+      ranges = [self._group_ranges.pop(key) for key in reject]
+      self._batch_exclusion.remove(ranges)
+      self._group_keys = [
+        key for key in self._group_keys if key in self._group_ranges]
+      self._num_batches -= sum(self._group_num_batches[key] for key in reject)
+      self._num_reflections -= sum(i1 - i0 for i0, i1 in ranges)
+      self._num_unique = int(np.count_nonzero(self._arrays['n']))
+      self._compute_cchalf_with_arrays()
+      rejected.append(reject)
+      if stop:
+        break
+    return rejected
 
   def _compute_cchalf(self, reflection_sums, binner):
     '''
@@ -295,6 +1214,23 @@ class PerImageCChalfStatistics(object):
 
     return cchalf_i
 
+  def _compute_cchalf_excluding_each_batch_with_arrays(self, batch_ranges):
+    '''
+    Compute the CC 1/2 with each batch excluded using the array engines.
+
+    The serial computation reuses the resolution bin totals of
+    self._batch_exclusion. If nproc > 1 the batch ranges are split into
+    contiguous chunks and computed on a process pool with the arrays in shared
+    memory; the results are identical to, and in the same order as, the serial
+    ones.
+
+    '''
+    if self._nproc > 1:
+      return compute_cchalf_excluding_ranges_in_parallel(
+        self._arrays, self._nbins, self._incremental, batch_ranges,
+        self._nproc)
+    return self._batch_exclusion.compute(batch_ranges)
+
   def num_batches(self):
     '''
     Return the number of batches
@@ -330,18 +1266,580 @@ class PerImageCChalfStatistics(object):
     '''
     return self._cchalf
 
+  def timing(self):
+    '''
+    Return the time in seconds spent reading the input into sums for each
+    unique reflection ('construction'), computing the CC 1/2 of all the data
+    ('full') and computing the CC 1/2 with each batch excluded
+    ('leave_one_out')
+
+    '''
+    return dict(self._timing)
+
+  def delta_cchalf_i(self, weighted=False, fisher=False):
+    '''
+    Return the Delta CC 1/2 for each image excluded
+
+    :param weighted: Use the CC 1/2 of the sigma weighted means
+    :param fisher: Fisher transform the CC 1/2 values before the difference
+
+    '''
+    if weighted:
+      if not self._weighted:
+        raise RuntimeError("The weighted CC 1/2 has not been computed")
+      cchalf_mean, cchalf = self._cchalf_mean_weighted, self._cchalf_weighted
+    else:
+      cchalf_mean, cchalf = self._cchalf_mean, self._cchalf
+    if fisher:
+      z_mean = fisher_transform(cchalf_mean)
+      return dict((k, fisher_transform(v) - z_mean)
+                  for k, v in cchalf.iteritems())
+    return dict((k, v - cchalf_mean) for k, v in cchalf.iteritems())
+
+  def delta_cchalf_variants_i(self):
+    '''
+    Return the Delta CC 1/2 for each image excluded with and without sigma
+    weighting and the Fisher transform. These are all computed from the same
+    pass over the batches.
+
+    :returns: A dictionary of dictionaries of Delta CC 1/2 by batch, with keys
+              'unweighted', 'unweighted_fisher', 'weighted' and
+              'weighted_fisher'
+
+    '''
+    result = {}
+    for weighted in (False, True):
+      if weighted and not self._weighted:
+        continue
+      for fisher in (False, True):
+        name = 'weighted' if weighted else 'unweighted'
+        if fisher:
+          name += '_fisher'
+        result[name] = self.delta_cchalf_i(weighted=weighted, fisher=fisher)
+    return result
+
+
+def max_observations_buffered(batch_count, batch_chunks):
+  '''
+  Compute an upper bound on the number of observations of incomplete batches
+  held at the end of any chunk when reading through the chunks in order
+
+  :param batch_count: The number of observations on each batch
+  :param batch_chunks: The first and last chunk each batch is seen in
+  :returns: The maximum number of observations buffered
+
+  '''
+  if len(batch_chunks) == 0:
+    return 0
+  keys = list(batch_chunks.keys())
+  first, last = np.array([batch_chunks[b] for b in keys]).T
+  count = np.array([batch_count[b] for b in keys], dtype=np.int64)
+  change = np.zeros(last.max() + 1, dtype=np.int64)
+  np.add.at(change, first, count)
+  np.add.at(change, last, -count)
+  return int(np.cumsum(change).max())
+
+
+class BatchObservationBuffer(object):
+  '''
+  A helper class to collect the observations of each batch from chunks until
+  the batch is complete.
+
+  The observations are kept in memory, or if spill is set they are written to
+  a temporary file and only the location of each piece is kept in memory.
+
+  '''
+  def __init__(self, spill=False):
+    '''
+    Initialise
+
+    :param spill: Write the observations to a temporary file
+
+    '''
+    self._pieces = defaultdict(list)
+    self._count = defaultdict(int)
+    self._file = None
+    if spill:
+      self._file = tempfile.TemporaryFile()
+
+  def add(self, batch, columns):
+    '''
+    Add a piece of the observations of a batch
+
+    :param batch: The batch number
+    :param columns: The tuple of arrays of the observations, e.g. the
+                    reflection id and intensity
+
+    '''
+    self._count[batch] += len(columns[0])
+    if self._file is None:
+      self._pieces[batch].append(columns)
+      return
+    self._file.seek(0, 2)
+    piece = []
+    for column in columns:
+      piece.append((self._file.tell(), column.dtype, len(column)))
+      self._file.write(column.tobytes())
+    self._pieces[batch].append(piece)
+
+  def count(self, batch):
+    '''
+    :returns: The number of observations of the batch collected so far
+
+    '''
+    return self._count[batch]
+
+  def pop(self, batch):
+    '''
+    Remove the observations of a batch from the buffer
+
+    :param batch: The batch number
+    :returns: The tuple of arrays of all the observations of the batch
+
+    '''
+    pieces = self._pieces.pop(batch)
+    del self._count[batch]
+    if self._file is not None:
+      pieces = [[self._read(*location) for location in piece]
+                for piece in pieces]
+    return tuple(np.concatenate(column) for column in zip(*pieces))
+
+  def _read(self, offset, dtype, count):
+    self._file.seek(offset)
+    return np.frombuffer(
+      self._file.read(count * dtype.itemsize), dtype=dtype)
+
+  def close(self):
+    '''
+    Delete the temporary file
+
+    '''
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def __len__(self):
+    return len(self._pieces)
+
+
+class StreamingPerImageCChalfStatistics(PerImageCChalfStatistics):
+  '''
+  A class to compute per image CC 1/2 statistics from chunks of observations
+  without holding all the observations in memory.
+
+  The chunks are read twice. The first pass accumulates the Sum(X), Sum(X**2)
+  and n for each unique reflection and counts the observations on each batch.
+  The second pass buffers the observations of each batch until all of them
+  have been seen and then computes the CC 1/2 excluding that batch with the
+  incremental engine. The memory therefore scales with the number of unique
+  reflections plus the observations of the batches in progress, which is a
+  single batch when the file is ordered by batch.
+
+  Files from scaling programs are often sorted by miller index instead, so
+  that nearly every batch is in progress until the end of the file. This is
+  detected from the chunks each batch is seen in during the first pass, and
+  the observations are then spilled to a temporary file by batch rather than
+  kept in memory.
+
+  '''
+
+  def __init__(self,
+               chunks,
+               unit_cell,
+               space_group,
+               nbins=10,
+               dmin=None,
+               dmax=None,
+               max_buffered=None,
+               weighted=False):
+    '''
+    Initialise
+
+    :param chunks: A callable returning a new iterator over chunks of
+                   (miller_index, batch, intensity, variance) arrays
+    :param unit_cell: The unit cell
+    :param space_group: The space group
+    :param nbins: The number of bins
+    :param dmin: The maximum resolution
+    :param dmax: The minimum resolution
+    :param max_buffered: The maximum number of observations of incomplete
+                         batches to keep in memory. If the input needs more
+                         they are spilled to a temporary file. The default is
+                         the size of the largest chunk or batch
+    :param weighted: Also compute the CC 1/2 of the sigma weighted means, in
+                     the same pass
+
+    '''
+    self._nproc = 1
+    self._weighted = weighted
+    self._arrays = None
+    self._start_time = time.time()
+    self._timing = {}
+    self._crystal_symmetry = crystal.symmetry(
+      unit_cell, space_group=space_group)
+
+    # Accumulate the sums and count the observations on each batch
+    # and the first and last chunk each batch is seen in
+    reflection_sums = ReflectionSumAccumulator(weighted)
+    batch_count = defaultdict(int)
+    batch_chunks = {}
+    max_chunk = 0
+    for i, (code, batch, intensity, weight) in enumerate(
+        self._iter_chunks(chunks)):
+      reflection_sums.add(code, intensity, weight)
+      max_chunk = max(max_chunk, len(batch))
+      for b, n in zip(*np.unique(batch, return_counts=True)):
+        b = int(b)
+        batch_count[b] += int(n)
+        batch_chunks[b] = (batch_chunks.get(b, (i, i))[0], i)
+
+    # Create the resolution bins
+    d_star_sq = compute_d_star_sq(unit_cell, reflection_sums.miller_index)
+    self._num_bins = nbins
+    self._dmin = dmin
+    self._dmax = dmax
+    if dmin is None:
+      self._dmin = 1 / sqrt(d_star_sq.max())
+    if dmax is None:
+      self._dmax = 1 / sqrt(d_star_sq.min())
+    binner = ResolutionBinner(unit_cell, self._dmin, self._dmax, nbins)
+    bin_index = binner.indices(reflection_sums.miller_index)
+
+    # Compute some numbers
+    self._num_batches = len(batch_count)
+    self._num_reflections = sum(batch_count.values())
+    self._num_unique = len(reflection_sums)
+
+    print ""
+    print "# Batches: ", self._num_batches
+    print "# Reflections: ", self._num_reflections
+    print "# Unique: ", self._num_unique
+
+    self._timing['construction'] = time.time() - self._start_time
+
+    # Compute the CC 1/2 for all the data
+    start_time = time.time()
+    arrays = {
+      'sum_x'     : reflection_sums.sum_x,
+      'sum_x2'    : reflection_sums.sum_x2,
+      'n'         : reflection_sums.n,
+      'bin_index' : bin_index,
+    }
+    if weighted:
+      arrays.update({
+        'sum_w'   : reflection_sums.sum_w,
+        'sum_wx'  : reflection_sums.sum_wx,
+        'sum_wx2' : reflection_sums.sum_wx2,
+      })
+    batch_exclusion = BatchExclusion(arrays, nbins, incremental=True)
+    cchalf_mean = batch_exclusion.mean_cchalf()
+    if weighted:
+      self._cchalf_mean, self._cchalf_mean_weighted = cchalf_mean
+      print "CC 1/2 mean (weighted): %.3f" % (100*self._cchalf_mean_weighted)
+    else:
+      self._cchalf_mean = cchalf_mean
+    print "CC 1/2 mean: %.3f" % (100*self._cchalf_mean)
+    self._timing['full'] = time.time() - start_time
+
+    # Spill the observations to disk if the incomplete batches would not fit
+    # in the buffer, e.g. when the file is sorted by miller index
+    if max_buffered is None:
+      max_buffered = max([max_chunk] + list(batch_count.values()))
+    num_buffered = max_observations_buffered(batch_count, batch_chunks)
+    spill = num_buffered > max_buffered
+    if spill:
+      print "The input is not ordered by batch: up to %d observations of " \
+            "incomplete batches are spilled to a temporary file" % num_buffered
+
+    # Compute the CC 1/2 excluding each batch as soon as it is complete
+    start_time = time.time()
+    self._cchalf = {}
+    self._cchalf_weighted = {}
+    pending = BatchObservationBuffer(spill=spill)
+    for code, batch, intensity, weight in self._iter_chunks(chunks):
+      columns = (reflection_sums.reflection_id(code), intensity)
+      if weighted:
+        columns += (weight,)
+      order = np.argsort(batch, kind='mergesort')
+      batch_numbers, batch_start = np.unique(batch[order], return_index=True)
+      batch_end = np.append(batch_start[1:], len(order))
+      for b, i0, i1 in zip(batch_numbers, batch_start, batch_end):
+        b = int(b)
+        selection = order[i0:i1]
+        pending.add(b, tuple(column[selection] for column in columns))
+        if pending.count(b) == batch_count[b]:
+          cchalf = batch_exclusion.exclude(*pending.pop(b))
+          if weighted:
+            cchalf, self._cchalf_weighted[b] = cchalf
+          self._cchalf[b] = cchalf
+          print "CC 1/2 excluding batch %d: %.3f" % (b, 100*cchalf)
+    assert len(pending) == 0
+    pending.close()
+    self._timing['leave_one_out'] = time.time() - start_time
+
+  def _iter_chunks(self, chunks):
+    '''
+    Iterate through the chunks, rejecting observations with negative variance
+    and mapping the miller indices to the ASU
+
+    :returns: An iterator over (code, batch, intensity, weight), where the
+              weight is 1 / variance
+
+    '''
+    for miller_index, batch, intensity, variance in chunks():
+      variance = as_numpy_array(variance, np.float64)
+      selection = variance > 0
+      if not selection.any():
+        continue
+      miller_index = as_numpy_array(miller_index, np.int64).reshape(-1, 3)
+      code = map_to_asu(
+        pack_miller_index(miller_index[selection]),
+        self._crystal_symmetry)
+      yield (
+        code,
+        as_numpy_array(batch, np.int64)[selection],
+        as_numpy_array(intensity, np.float64)[selection],
+        1 / variance[selection])
+
+
+class OnlinePerImageCChalfStatistics(object):
+  '''
+  A class to compute per image CC 1/2 statistics as batches arrive.
+
+  The Sum(X), Sum(X**2) and n of each unique reflection and the running totals
+  in each resolution bin are updated in place by add_batch. The cost of adding
+  a batch, and of computing the Delta CC 1/2 of one batch, is proportional to
+  the number of observations on that batch, apart from a copy of the sorted
+  table of reflection codes when the batch has new reflections, which is done
+  in C. The resolution bins must be fixed
+  in advance so dmin and dmax are required. The statistics are NaN until there
+  is enough data to compute them.
+
+  The update method takes a single (miller_index, intensity, variance) tuple so
+  the object can be used as a node in a streamz pipeline, e.g.
+
+    source.map(statistics.update).sink(print)
+
+  '''
+
+  def __init__(self, unit_cell, space_group, dmin, dmax, nbins=10):
+    '''
+    Initialise
+
+    :param unit_cell: The unit cell
+    :param space_group: The space group
+    :param dmin: The maximum resolution
+    :param dmax: The minimum resolution
+    :param nbins: The number of bins
+
+    '''
+    self._crystal_symmetry = crystal.symmetry(
+      unit_cell, space_group=space_group)
+    self._binner = ResolutionBinner(unit_cell, dmin, dmax, nbins, verbose=False)
+    # The packed codes of the reflections seen so far in sorted order and the
+    # reflection id of each
+    self._code = np.zeros(0, dtype=np.int64)
+    self._code_id = np.zeros(0, dtype=np.int64)
+    self._num_unique = 0
+    self._num_reflections = 0
+    self._sum_x = np.zeros(1024)
+    self._sum_x2 = np.zeros(1024)
+    self._n = np.zeros(1024, dtype=np.int64)
+    self._bin_index = np.zeros(1024, dtype=np.int64)
+    self._bin_totals = ResolutionBinTotals(
+      self._sum_x, self._sum_x2, self._n, self._bin_index, nbins)
+    self._batches = {}
+    self._last_batch = 0
+
+  def add_batch(self, miller_index, intensity, variance, batch=None):
+    '''
+    Add the observations on a batch
+
+    :param miller_index: The (N, 3) array of miller indices
+    :param intensity: The array of intensities
+    :param variance: The array of variances
+    :param batch: The batch number (defaults to one more than the largest)
+    :returns: The batch number
+
+    '''
+    if batch is None:
+      batch = self._last_batch + 1
+    if batch in self._batches:
+      raise ValueError("Batch %d has already been added" % batch)
+    self._last_batch = max(self._last_batch, batch)
+    miller_index = as_numpy_array(miller_index, np.int64).reshape(-1, 3)
+    intensity = as_numpy_array(intensity, np.float64)
+    variance = as_numpy_array(variance, np.float64)
+
+    # Reject reflections with negative variance and map to the ASU
+    selection = variance > 0
+    code = map_to_asu(
+      pack_miller_index(miller_index[selection]),
+      self._crystal_symmetry)
+    intensity = intensity[selection]
+
+    # Reduce the batch to sums for each unique reflection
+    unique_code, index = np.unique(code, return_inverse=True)
+    reflection_id = self._get_reflection_id(unique_code)
+    batch_sums = (
+      np.bincount(index, weights=intensity),
+      np.bincount(index, weights=intensity**2),
+      np.bincount(index))
+
+    # Update the reflection sums and the totals in each bin
+    old_sums = (
+      self._sum_x[reflection_id],
+      self._sum_x2[reflection_id],
+      self._n[reflection_id])
+    new_sums = tuple(old + new for old, new in zip(old_sums, batch_sums))
+    self._bin_totals.totals += self._bin_totals.difference(
+      reflection_id, old_sums, new_sums)
+    self._sum_x[reflection_id] = new_sums[0]
+    self._sum_x2[reflection_id] = new_sums[1]
+    self._n[reflection_id] = new_sums[2]
+    self._batches[batch] = (reflection_id,) + batch_sums
+    self._num_reflections += len(intensity)
+    return batch
+
+  def _get_reflection_id(self, code):
+    '''
+    Get the reflection ids of the sorted unique packed miller indices, adding
+    any new reflections and growing the arrays as needed
+
+    '''
+    index = np.searchsorted(self._code, code)
+    found = index < len(self._code)
+    found[found] = self._code[index[found]] == code[found]
+    new_code = code[~found]
+    if len(new_code) > 0:
+      first = self._num_unique
+      self._num_unique += len(new_code)
+      if self._num_unique > len(self._n):
+        size = max(self._num_unique, 2 * len(self._n))
+        for name in ('_sum_x', '_sum_x2', '_n', '_bin_index'):
+          old = getattr(self, name)
+          new = np.zeros(size, dtype=old.dtype)
+          new[:len(old)] = old
+          setattr(self, name, new)
+        self._bin_totals.bin_index = self._bin_index
+      self._bin_index[first:self._num_unique] = self._binner.indices(
+        unpack_miller_index(new_code))
+      self._code = np.insert(self._code, index[~found], new_code)
+      self._code_id = np.insert(
+        self._code_id, index[~found], np.arange(first, self._num_unique))
+    return self._code_id[np.searchsorted(self._code, code)]
+
+  def update(self, data):
+    '''
+    Add a batch and return the current statistics
+
+    :param data: The (miller_index, intensity, variance) of the batch
+    :returns: A dictionary with the batch number, the mean CC 1/2 and the
+              Delta CC 1/2 of the batch
+
+    '''
+    batch = self.add_batch(*data)
+    return {
+      'batch'        : batch,
+      'mean_cchalf'  : self.mean_cchalf(),
+      'delta_cchalf' : self.delta_cchalf(batch),
+    }
+
+  def num_batches(self):
+    '''
+    Return the number of batches
+
+    '''
+    return len(self._batches)
+
+  def num_reflections(self):
+    '''
+    Return the number of reflections
+
+    '''
+    return self._num_reflections
+
+  def num_unique(self):
+    '''
+    Return the number of unique reflections
+
+    '''
+    return self._num_unique
+
+  def _mean_cchalf(self, difference=None):
+    '''
+    Compute the mean CC 1/2 or NaN if there is not yet enough data
+
+    '''
+    try:
+      return self._bin_totals.mean_cchalf(difference)
+    except ZeroDivisionError:
+      return float('nan')
+
+  def mean_cchalf(self):
+    '''
+    Return the current mean CC 1/2
+
+    '''
+    return self._mean_cchalf()
+
+  def cchalf(self, batch):
+    '''
+    Return the current CC 1/2 with a batch excluded
+
+    '''
+    reflection_id, sum_x, sum_x2, n = self._batches[batch]
+    old_sums = (
+      self._sum_x[reflection_id],
+      self._sum_x2[reflection_id],
+      self._n[reflection_id])
+    new_sums = (old_sums[0] - sum_x, old_sums[1] - sum_x2, old_sums[2] - n)
+    return self._mean_cchalf(
+      self._bin_totals.difference(reflection_id, old_sums, new_sums))
+
+  def delta_cchalf(self, batch):
+    '''
+    Return the current Delta CC 1/2 of a batch
+
+    '''
+    return self.cchalf(batch) - self.mean_cchalf()
+
+  def cchalf_i(self):
+    '''
+    Return the CC 1/2 for each image excluded
+
+    '''
+    return dict((b, self.cchalf(b)) for b in self._batches)
+
   def delta_cchalf_i(self):
     '''
     Return the Delta CC 1/2 for each image excluded
 
     '''
-    return dict((k, v - self._cchalf_mean) for k, v in self._cchalf.iteritems())
+    cchalf_mean = self.mean_cchalf()
+    return dict((k, v - cchalf_mean) for k, v in self.cchalf_i().iteritems())
 
 
-if __name__ == '__main__':
+def group_batches(group_size):
+  '''
+  Get a function giving the group of consecutive batches each batch is in
+
+  :param group_size: The number of batches in each group, or None
+  :returns: The group function, or None
 
-  # Read the mtz file
-  reader = any_reflection_file(sys.argv[1])
+  '''
+  if group_size is None:
+    return None
+  return lambda batch: (batch - 1) // group_size
+
+
+def read_and_compute_statistics(args):
+  '''
+  Read all the miller arrays from the reflection file and compute the
+  statistics
+
+  '''
+  reader = any_reflection_file(args.filename)
 
   # Get the columns as miller arrays
   miller_arrays = reader.as_miller_arrays(merge_equivalents=False)
@@ -368,14 +1866,116 @@ if __name__ == '__main__':
     intensities.data(),
     intensities.sigmas()**2,
     unit_cell,
-    intensities.crystal_symmetry().space_group())
+    intensities.crystal_symmetry().space_group(),
+    engine=args.engine,
+    nproc=args.nproc,
+    weighted=args.weighted,
+    group=group_batches(args.group_size))
+  return statistics
+
+
+if __name__ == '__main__':
+  from argparse import ArgumentParser
+
+  parser = ArgumentParser(description="Compute the Delta CC 1/2 per batch")
+  parser.add_argument("filename",
+                      help="The unmerged MTZ file or XDS_ASCII.HKL file")
+  parser.add_argument("--engine", default=None,
+                      choices=["array", "incremental", "dict"],
+                      help="The engine used to compute the statistics "
+                           "(default array, or incremental with --weighted)")
+  parser.add_argument("--nproc", type=int, default=1,
+                      help="The number of processes to use")
+  parser.add_argument("--chunk_size", type=int, default=None,
+                      help="Read the I, SIGI and BATCH columns in chunks of "
+                           "this many rows rather than loading the file")
+  parser.add_argument("--weighted", action="store_true",
+                      help="Also compute the sigma weighted and Fisher "
+                           "transformed Delta CC 1/2 (selects the "
+                           "incremental engine)")
+  parser.add_argument("--group_size", type=int, default=None,
+                      help="Exclude groups of this many consecutive batches "
+                           "rather than single batches")
+  parser.add_argument("--reject_threshold", type=float, default=None,
+                      help="Iteratively reject the batches or groups with a "
+                           "Delta CC 1/2 (in %%) above this threshold")
+  args = parser.parse_args()
+
+  # Check the options before reading the file
+  if args.chunk_size is not None:
+    if args.engine not in (None, "incremental"):
+      parser.error("--chunk_size always uses the incremental engine")
+    if args.nproc != 1:
+      parser.error("--nproc is not supported with --chunk_size")
+    if args.group_size is not None:
+      parser.error("--group_size is not supported with --chunk_size")
+    if args.reject_threshold is not None:
+      parser.error("--reject_threshold is not supported with --chunk_size")
+  if args.engine is None:
+    args.engine = "incremental" if args.weighted else "array"
+  elif args.weighted and args.engine != "incremental":
+    parser.error("--weighted requires --engine=incremental")
+
+  from xds_ascii import is_xds_ascii, XdsAsciiReader
+  if is_xds_ascii(args.filename):
+
+    # Parse the XDS_ASCII file directly
+    reader = XdsAsciiReader(args.filename)
+    if args.chunk_size is not None:
+      statistics = StreamingPerImageCChalfStatistics(
+        lambda: reader.iter_observations(args.chunk_size),
+        reader.unit_cell(),
+        reader.space_group(),
+        weighted=args.weighted)
+    else:
+      miller_index, batch, intensity, variance = reader.read()
+      statistics = PerImageCChalfStatistics(
+        miller_index,
+        batch,
+        intensity,
+        variance,
+        reader.unit_cell(),
+        reader.space_group(),
+        engine=args.engine,
+        nproc=args.nproc,
+        weighted=args.weighted,
+        group=group_batches(args.group_size))
+  elif args.chunk_size is not None:
+    from unmerged_mtz import UnmergedMtzReader
+
+    # Stream the columns from the mtz file
+    reader = UnmergedMtzReader(args.filename, chunk_size=args.chunk_size)
+    statistics = StreamingPerImageCChalfStatistics(
+      reader.iter_observations,
+      reader.unit_cell(),
+      reader.space_group(),
+      weighted=args.weighted)
+  else:
+    statistics = read_and_compute_statistics(args)
+
+  # Iteratively reject the worst batches or groups
+  if args.reject_threshold is not None:
+    rejected = statistics.reject_iteratively(args.reject_threshold / 100)
+    print ""
+    for cycle, keys in enumerate(rejected):
+      print "Cycle %d rejected: %s" % (cycle+1, ", ".join(map(str, keys)))
 
   # Print out the Batches in order of delta cc 1/2
   delta_cchalf_i = statistics.delta_cchalf_i()
   batches = list(delta_cchalf_i.keys())
   sorted_index = sorted(range(len(batches)), key=lambda x: delta_cchalf_i[batches[x]])
   for i in sorted_index:
-    print "Batch: %d, Delta CC 1/2: %.3f" % (batches[i], 100*delta_cchalf_i[batches[i]])
+    print "Batch: %s, Delta CC 1/2: %.3f" % (batches[i], 100*delta_cchalf_i[batches[i]])
+
+  # Print out all the variants of delta cc 1/2 computed in the same pass
+  if args.weighted:
+    variants = statistics.delta_cchalf_variants_i()
+    names = ['unweighted', 'unweighted_fisher', 'weighted', 'weighted_fisher']
+    print ""
+    print "Batch " + " ".join("%18s" % name for name in names)
+    for b in sorted(batches):
+      print "%5s " % b + " ".join(
+        "%18.3f" % (100*variants[name][b]) for name in names)
 
   # Make a plot of delta cc 1/2
   from matplotlib import pylab
@@ -0,0 +1,141 @@
+from __future__ import division
+import struct
+import numpy as np
+from cctbx import sgtbx
+from cctbx import uctbx
+
+
+class UnmergedMtzReader(object):
+  '''
+  A class to read selected columns of an MTZ file in chunks of rows.
+
+  Only the header is parsed up front. The reflection records are read from
+  the file one chunk at a time and only the requested columns are kept, so the
+  full set of columns is never held in memory.
+
+  '''
+
+  def __init__(self, filename, chunk_size=100000):
+    '''
+    Initialise the reader and parse the header
+
+    :param filename: The MTZ file
+    :param chunk_size: The number of reflection records in each chunk
+
+    '''
+    self._filename = filename
+    self._chunk_size = chunk_size
+    with open(filename, "rb") as infile:
+      stamp = infile.read(20)
+      if stamp[0:4] != b"MTZ ":
+        raise RuntimeError("%s is not an MTZ file" % filename)
+
+      # The real number format is in the high nibble of the first byte of the
+      # machine stamp: 1 for big endian and 4 for little endian IEEE
+      if (bytearray(stamp[8:9])[0] >> 4) == 1:
+        endian = ">"
+      else:
+        endian = "<"
+      self._dtype = np.dtype(endian + "f4")
+
+      # The header location is in words from the start of the file. If it does
+      # not fit in 32 bits it is stored as a 64 bit integer after the stamp
+      header_location = struct.unpack(endian + "i", stamp[4:8])[0]
+      if header_location == -1:
+        header_location = struct.unpack(endian + "q", stamp[12:20])[0]
+      infile.seek((header_location - 1) * 4)
+      header = infile.read().decode("ascii", "replace")
+
+    self._columns = []
+    self._missing = float("nan")
+    self._cell = None
+    self._space_group_number = None
+    for i in range(0, len(header), 80):
+      record = header[i:i+80]
+      tokens = record.split()
+      if len(tokens) == 0:
+        continue
+      key = tokens[0].upper()
+      if key == "END":
+        break
+      elif key == "NCOL":
+        self._ncol, self._nref = int(tokens[1]), int(tokens[2])
+      elif key == "CELL":
+        self._cell = tuple(map(float, tokens[1:7]))
+      elif key == "SYMINF":
+        self._space_group_number = int(tokens[4])
+      elif key == "VALM":
+        if tokens[1].upper() != "NAN":
+          self._missing = float(tokens[1])
+      elif key == "COLUMN":
+        self._columns.append(tokens[1])
+    assert len(self._columns) == self._ncol
+
+  def column_labels(self):
+    '''
+    :returns: The list of column labels
+
+    '''
+    return list(self._columns)
+
+  def num_reflections(self):
+    '''
+    :returns: The number of reflection records
+
+    '''
+    return self._nref
+
+  def unit_cell(self):
+    '''
+    :returns: The unit cell
+
+    '''
+    return uctbx.unit_cell(self._cell)
+
+  def space_group(self):
+    '''
+    :returns: The space group
+
+    '''
+    return sgtbx.space_group_info(number=self._space_group_number).group()
+
+  def iter_columns(self, labels):
+    '''
+    Iterate through chunks of the selected columns
+
+    :param labels: The list of column labels
+    :returns: An iterator over lists of column arrays for each chunk
+
+    '''
+    index = [self._columns.index(label) for label in labels]
+    row_size = self._ncol * self._dtype.itemsize
+    with open(self._filename, "rb") as infile:
+      for i0 in range(0, self._nref, self._chunk_size):
+        n = min(self._chunk_size, self._nref - i0)
+        infile.seek(80 + i0 * row_size)
+        data = np.fromfile(infile, dtype=self._dtype, count=n * self._ncol)
+        data = data.reshape(n, self._ncol)[:,index].astype(np.float64)
+        if self._missing == self._missing:
+          data[data == self._missing] = np.nan
+        yield [data[:,j] for j in range(len(index))]
+
+  def iter_observations(self, intensity="I", sigma="SIGI", batch="BATCH"):
+    '''
+    Iterate through chunks of unmerged observations. Records with missing
+    intensities or sigmas are skipped.
+
+    :param intensity: The intensity column label
+    :param sigma: The sigma column label
+    :param batch: The batch column label
+    :returns: An iterator over (miller_index, batch, intensity, variance)
+
+    '''
+    labels = ["H", "K", "L", batch, intensity, sigma]
+    for h, k, l, b, i, s in self.iter_columns(labels):
+      selection = ~(np.isnan(i) | np.isnan(s))
+      miller_index = np.column_stack((h, k, l))[selection]
+      yield (
+        np.rint(miller_index).astype(np.int64),
+        np.rint(b[selection]).astype(np.int64),
+        i[selection],
+        s[selection]**2)
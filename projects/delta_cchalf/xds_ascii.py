@@ -0,0 +1,163 @@
+from __future__ import division
+import mmap
+import numpy as np
+from cctbx import sgtbx
+from cctbx import uctbx
+
+
+def is_xds_ascii(filename):
+  '''
+  Check if a file is an XDS_ASCII reflection file
+
+  :param filename: The file name
+  :returns: True/False
+
+  '''
+  with open(filename, "rb") as infile:
+    return infile.read(17) == b"!FORMAT=XDS_ASCII"
+
+
+class XdsAsciiReader(object):
+  '''
+  A class to read the unmerged reflections in an XDS_ASCII.HKL file.
+
+  The file is memory mapped and the fixed format records between the end of
+  the header and the end of the data are parsed in bulk into numpy arrays,
+  rather than line by line.
+
+  '''
+
+  def __init__(self, filename):
+    '''
+    Initialise the reader and parse the header
+
+    :param filename: The XDS_ASCII file
+
+    '''
+    self._filename = filename
+    with open(filename, "rb") as infile:
+      data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        header_end = data.find(b"!END_OF_HEADER")
+        if header_end < 0:
+          raise RuntimeError("%s has no !END_OF_HEADER record" % filename)
+        header = data[:header_end].decode("ascii", "replace")
+        self._data_start = data.find(b"\n", header_end) + 1
+        self._data_end = data.find(b"!END_OF_DATA", self._data_start)
+        if self._data_end < 0:
+          self._data_end = len(data)
+      finally:
+        data.close()
+
+    self._items = {}
+    self._cell = None
+    self._space_group_number = None
+    self._num_items = None
+    for line in header.splitlines():
+      for record in line.lstrip("!").split("!"):
+        if "=" not in record:
+          continue
+        key, value = record.split("=", 1)
+        key = key.strip()
+        if key.startswith("ITEM_"):
+          self._items[key[5:]] = int(value) - 1
+        elif key == "NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD":
+          self._num_items = int(value)
+        elif key == "UNIT_CELL_CONSTANTS":
+          self._cell = tuple(map(float, value.split()[:6]))
+        elif key == "SPACE_GROUP_NUMBER":
+          self._space_group_number = int(value)
+    for item in ("H", "K", "L", "IOBS", "SIGMA(IOBS)", "ZD"):
+      if item not in self._items:
+        raise RuntimeError("%s has no ITEM_%s column" % (filename, item))
+
+  def unit_cell(self):
+    '''
+    :returns: The unit cell
+
+    '''
+    return uctbx.unit_cell(self._cell)
+
+  def space_group(self):
+    '''
+    :returns: The space group
+
+    '''
+    return sgtbx.space_group_info(number=self._space_group_number).group()
+
+  def read(self):
+    '''
+    Read all the observations.
+
+    The batch is the frame number computed from ZD. Misfits, which XDS flags
+    with a negative sigma, are given a negative variance so that they are
+    rejected by PerImageCChalfStatistics.
+
+    :returns: The miller_index, batch, intensity and variance arrays
+
+    '''
+    chunks = list(self.iter_observations(chunk_size=None))
+    if len(chunks) == 0:
+      return (
+        np.zeros((0, 3), dtype=np.int64),
+        np.zeros(0, dtype=np.int64),
+        np.zeros(0),
+        np.zeros(0))
+    return tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+
+  def iter_observations(self, chunk_size=100000):
+    '''
+    Iterate through chunks of observations
+
+    :param chunk_size: The approximate number of records parsed in each chunk,
+                       or None to parse everything at once
+    :returns: An iterator over (miller_index, batch, intensity, variance)
+
+    '''
+    with open(self._filename, "rb") as infile:
+      data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        start = self._data_start
+        if chunk_size is not None:
+          record_length = data.find(b"\n", start) - start + 1
+          chunk_bytes = max(1, chunk_size * record_length)
+        while start < self._data_end:
+          if chunk_size is None:
+            end = self._data_end
+          else:
+            end = data.find(b"\n", min(start + chunk_bytes, self._data_end))
+            if end < 0 or end > self._data_end:
+              end = self._data_end
+          records = self._parse(data[start:end])
+          start = end + 1
+          if len(records) > 0:
+            yield self._observations(records)
+      finally:
+        data.close()
+
+  def _parse(self, text):
+    '''
+    Parse a block of complete records into an (N, number of items) array
+
+    '''
+    # The text mode of np.fromstring (with sep) is not deprecated, only the
+    # binary mode, and it parses the block in C without a token per value
+    values = np.fromstring(text, dtype=np.float64, sep=" ")
+    if len(values) % self._num_items != 0:
+      raise RuntimeError("Records in %s do not have %d items" % (
+        self._filename, self._num_items))
+    return values.reshape(-1, self._num_items)
+
+  def _observations(self, records):
+    '''
+    Get the miller_index, batch, intensity and variance from the records
+
+    '''
+    items = self._items
+    miller_index = np.rint(
+      records[:,[items["H"], items["K"], items["L"]]]).astype(np.int64)
+    intensity = records[:,items["IOBS"]]
+    sigma = records[:,items["SIGMA(IOBS)"]]
+    variance = np.copysign(sigma**2, sigma)
+    batch = np.floor(records[:,items["ZD"]]).astype(np.int64) + 1
+    return miller_index, batch, intensity, variance
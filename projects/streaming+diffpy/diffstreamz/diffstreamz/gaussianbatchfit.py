@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+This defines the class BatchGaussianFit for fitting a Gaussian curve to each
+of many spectra at once.  It fits the same function as GaussianFit in
+gaussianfitlib, but instead of building a diffpy FitRecipe for every curve it
+runs a Levenberg-Marquardt refinement on all the spectra together with
+vectorized residuals and an analytic Jacobian.
+
+Example usage is:
+
+import numpy as np
+x = np.arange(-10, 10, 0.1)
+x0 = np.random.uniform(-5, 5, size=100)
+sig = 1.5
+noise = 0.2 * np.ones_like(x)
+y = np.exp(-0.5*(x-x0[:,None])**2/sig**2) + noise * np.random.randn(100, len(x))
+bfit = BatchGaussianFit(x, y, noise)
+bfit.refine()
+print(bfit.x0, bfit.dx0)
+
+x is the array of x values shared by all the spectra, or one row of x values
+for each spectrum.  y is the (n_spectra, n_points) array of spectra and dy
+their estimated standard deviations (dy may be omitted).  A, sig, and x0 are
+initial values, as scalars or one for each spectrum.  If omitted the program
+will estimate their starting values.
+
+"""
+
+from __future__ import print_function
+import numpy as np
+
+
+def gaussian(x, A, sig, x0):
+    '''Evaluate the Gauss function of GaussianFit for arrays of parameters.
+
+    x        -- the x values, broadcast against the parameters
+    A, sig, x0 -- the parameters, as arrays of shape (n_spectra, 1)
+
+    Return the Gauss function and the Jacobian with respect to A, sig and x0
+    as an array with a last axis of length 3.
+    '''
+    dx = x - x0
+    u = dx / sig
+    shape = np.broadcast(dx, A).shape
+    # The columns of the Jacobian are written straight into one array
+    jac = np.empty(shape + (3,))
+    np.multiply(np.exp(-0.5 * u**2), 1 / np.sqrt(2 * np.pi * sig**2),
+                out=jac[...,0])
+    yg = A * jac[...,0]
+    np.multiply(yg, (u**2 - 1) / sig, out=jac[...,1])
+    np.multiply(yg, u / sig, out=jac[...,2])
+    return yg, jac
+
+
+def starting_values(x, y):
+    '''Estimate starting values for A, sig, and x0 of each spectrum in the
+    same way as GaussianFit.
+
+    x, y -- arrays of shape (n_spectra, n_points)
+
+    Return the arrays of A, sig and x0.
+    '''
+    rows = np.arange(len(y))
+    peakIndex = y.argmax(axis=1)
+    peakValue = y[rows, peakIndex]
+    x0 = x[rows, peakIndex]
+    below = y < peakValue[:,None] / 2
+    halfmaxlo = below & (x < x0[:,None])
+    halfmaxhi = below & (x > x0[:,None])
+    n = y.shape[1]
+    ilo = n - 1 - halfmaxlo[:,::-1].argmax(axis=1)
+    ihi = halfmaxhi.argmax(axis=1)
+    xhalflo = np.where(halfmaxlo.any(axis=1), x[rows, ilo], x.min(axis=1))
+    xhalfhi = np.where(halfmaxhi.any(axis=1), x[rows, ihi], x.max(axis=1))
+    fwhm = xhalfhi - xhalflo
+    sig = fwhm / (2 * np.sqrt(2 * np.log(2)))
+    A = peakValue * np.sqrt(2 * np.pi) * sig
+    return A, sig, x0
+
+
+def _solve(a, b):
+    '''Solve a stack of linear systems, falling back to the pseudo-inverse
+    when one of them is singular.
+    '''
+    try:
+        return np.linalg.solve(a, b[...,None])[...,0]
+    except np.linalg.LinAlgError:
+        return np.einsum('...ij,...j->...i', np.linalg.pinv(a), b)
+
+
+class BatchGaussianFit(object):
+    '''Least-squares fit of a Gauss function to each of a stack of spectra.
+
+    Input and simulated data (read-only):
+
+    x    --  input x values, one row for each spectrum
+    y    --  input y values, one row for each spectrum
+    dy   --  estimated standard deviations for the y-values
+    yg   --  Gauss functions calculated for the current A, sig, x0
+
+    Parameters of the Gauss functions, one for each spectrum:
+
+    A    --  integrated area of the fitted peak
+    sig  --  width of curve (parameter sigma in the Gauss distribution
+             function)
+    x0   --  x-position of the peak center
+
+    Fit results, one for each spectrum:
+
+    dA, dsig, dx0 -- estimated standard deviations of A, sig and x0 from
+             the same covariance matrix as diffpy FitResults
+    chi2 --  the sum of the squared weighted residuals
+    converged -- True where the refinement converged, False where it
+             stalled or ran out of iterations
+    '''
+
+    def __init__(self, x, y, dy=None, A=None, sig=None, x0=None):
+        '''Create new BatchGaussianFit object
+
+        x    -- the x values of all the spectra or of each spectrum
+        y    -- the (n_spectra, n_points) array of spectra
+        dy   -- estimated standard deviations for the y-values
+                (may be omitted).
+        A, sig, x0   -- optional initial parameters for the Gauss functions.
+                Omitted parameters will be estimated from the input data.
+        '''
+        y = np.atleast_2d(np.asarray(y, dtype=float))
+        self.y = y
+        # x and dy are kept as given too, so that a shared x-grid is not
+        # copied for the spectra being refined
+        self._x = np.asarray(x, dtype=float)
+        self.x = np.broadcast_to(self._x, y.shape)
+        if dy is None:
+            dy = 1.0
+        self._dy = np.asarray(dy, dtype=float)
+        self.dy = np.broadcast_to(self._dy, y.shape)
+        n = len(y)
+        self.params = np.empty((n, 3))
+        if None in (A, sig, x0):
+            self.params[:] = np.transpose(starting_values(self.x, self.y))
+        for i, value in enumerate((A, sig, x0)):
+            if value is not None:
+                self.params[:,i] = value
+        self.dparams = np.full((n, 3), np.nan)
+        self.chi2 = np.full(n, np.nan)
+        self.converged = np.zeros(n, dtype=bool)
+        self.iterations = 0
+        return
+
+    @property
+    def A(self):
+        return self.params[:,0]
+
+    @property
+    def sig(self):
+        return self.params[:,1]
+
+    @property
+    def x0(self):
+        return self.params[:,2]
+
+    @property
+    def dA(self):
+        return self.dparams[:,0]
+
+    @property
+    def dsig(self):
+        return self.dparams[:,1]
+
+    @property
+    def dx0(self):
+        return self.dparams[:,2]
+
+    @property
+    def yg(self):
+        return self._evaluate(self.params, np.arange(len(self.y)))[0]
+
+    def _evaluate(self, params, rows):
+        '''Compute the Gauss functions, the weighted residuals and the
+        weighted Jacobian of the given spectra.
+        '''
+        A, sig, x0 = (params[:,i,None] for i in range(3))
+        allrows = len(rows) == len(self.y)
+        x, y, dy = (v if v.ndim < 2 or len(v) == 1 or allrows else v[rows]
+                    for v in (self._x, self.y, self._dy))
+        # Trial steps may overflow; their chi2 is not finite and they are
+        # rejected
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            yg, jac = gaussian(x, A, sig, x0)
+        weight = np.broadcast_to(1 / dy, yg.shape)
+        residual = (yg - y) * weight
+        jac *= weight[...,None]
+        return yg, residual, jac
+
+    def _normalEquations(self, params, rows):
+        '''Compute chi2, J^T J and J^T r of the weighted residuals of the
+        given spectra.
+        '''
+        _, residual, jac = self._evaluate(params, rows)
+        jt = jac.transpose(0, 2, 1)
+        return ((residual**2).sum(axis=1), jt @ jac,
+                (jt @ residual[...,None])[...,0])
+
+    def refine(self, maxiter=100, ftol=1.49012e-8, xtol=1.49012e-8):
+        '''Optimize all the spectra with a batched Levenberg-Marquardt
+        refinement.
+
+        Each spectrum has its own damping factor and stops when the actual
+        and predicted relative reductions of chi2 are smaller than ftol or
+        the relative step is smaller than xtol, as in scipy.optimize.leastsq.
+        Only the spectra that have not converged are evaluated in each
+        iteration, and only their J^T J and J^T r are kept between
+        iterations.
+
+        maxiter -- the maximum number of iterations
+        ftol, xtol -- the convergence tolerances
+        '''
+        n = len(self.y)
+        rows = np.arange(n)
+        params = self.params[rows]
+        chi2, jtj, jtr = self._normalEquations(params, rows)
+        lam = np.full(n, 1e-3)
+        converged = np.zeros(n, dtype=bool)
+        self.iterations = 0
+        for self.iterations in range(1, maxiter + 1):
+            # The damped normal equations of the active spectra
+            diag = np.einsum('nii->ni', jtj)
+            damped = jtj.copy()
+            damped[:,[0, 1, 2],[0, 1, 2]] += lam[:,None] * np.maximum(
+                diag, 1e-12 * diag.max(axis=1, keepdims=True) + 1e-300)
+            step = -_solve(damped, jtr)
+            trial = params + step
+            trialChi2, trialJtj, trialJtr = self._normalEquations(trial, rows)
+
+            # Accept the steps that reduce chi2 and reduce their damping.
+            # As in leastsq, chi2 has converged when both the actual and
+            # the predicted reductions are small.
+            predicted = -(2 * np.einsum('ni,ni->n', step, jtr) +
+                          np.einsum('ni,nij,nj->n', step, jtj, step))
+            better = np.isfinite(trialChi2) & (trialChi2 <= chi2)
+            small = np.abs(step) <= xtol * (np.abs(params) + xtol)
+            done = better & (
+                ((chi2 - trialChi2 <= ftol * chi2) &
+                 (predicted <= ftol * chi2)) | small.all(axis=1))
+            # Spectra whose damping has blown up without an accepted step
+            # have stalled; they stop but are not converged
+            stalled = ~better & (lam > 1e10)
+            params[better] = trial[better]
+            chi2[better] = trialChi2[better]
+            jtj[better] = trialJtj[better]
+            jtr[better] = trialJtr[better]
+            lam = np.where(better, lam / 10, lam * 10)
+            converged[rows[done]] = True
+            done |= stalled
+
+            # Write back the spectra that have finished
+            self.params[rows[done]] = params[done]
+            self.chi2[rows[done]] = chi2[done]
+            keep = ~done
+            rows, params, chi2, jtj, jtr, lam = (
+                rows[keep], params[keep], chi2[keep], jtj[keep], jtr[keep],
+                lam[keep])
+            if len(rows) == 0:
+                break
+        self.params[rows] = params
+        self.chi2[rows] = chi2
+        self.converged = converged
+        self._getUncertainties()
+        return
+
+    def _getUncertainties(self):
+        '''Estimate the standard deviations of the parameters from the
+        inverse of J^T J of the weighted residuals, as FitResults does.
+        '''
+        jtj = self._normalEquations(self.params, np.arange(len(self.y)))[1]
+        # A stalled spectrum may have no finite J^T J; its standard
+        # deviations are left NaN
+        finite = np.isfinite(jtj).all(axis=(1, 2))
+        cov = np.linalg.pinv(jtj[finite])
+        self.dparams = np.full((len(self.y), 3), np.nan)
+        self.dparams[finite] = np.sqrt(np.abs(np.einsum('nii->ni', cov)))
+        return
+
+# end of class BatchGaussianFit
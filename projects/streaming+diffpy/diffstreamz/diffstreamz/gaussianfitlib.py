@@ -18,12 +18,22 @@ x, y, dy are the data to be fitted with Gaussian peak (dy may be omitted)
 A, sig, and x0 are initial values.  If omitted the program will estimate
 their starting values.
 
+To fit many curves on the same x-grid, GaussianFitter keeps one GaussianFit
+for each x-grid and only swaps in the new y values for each curve.  It
+returns a FitSnapshot of each fit:
+
+fitter = GaussianFitter()
+for y in curves:
+    fit = fitter(x, y)
+
 """
 
 from __future__ import print_function
+from collections import OrderedDict
+import threading
+import time
 from diffpy.srfit.fitbase import FitContribution, FitRecipe, Profile, FitResults
 import numpy as np
-import matplotlib.pyplot as plt
 
 class GaussianFit(object):
     '''Least-squares fit of Gauss function to the specified data.
@@ -46,10 +56,12 @@ class GaussianFit(object):
 
     results -- result report from the last refinement, refined values,
              and their estimated errors, parameter correlations, etc.
+    nfev -- number of residual evaluations in the last refinement
     recipe -- FitRecipe from SrFit that manages this refinement
     '''
 
-    def __init__(self, x, y, dy=None, A=None, sig=None, x0=None):
+    def __init__(self, x, y, dy=None, A=None, sig=None, x0=None,
+                 quiet=False):
         '''Create new GaussianFit object
 
         x, y -- curve to be fitted with Gaussian peak.
@@ -57,16 +69,19 @@ class GaussianFit(object):
                 (may be omitted).
         A, sig, x0   -- optional initial parameters for the Gauss function.
                 Omitted parameters will be estimated from the input data.
+        quiet -- do not print the initial parameter values.
         '''
         self.results = None
+        self.nfev = 0
         self._makeRecipe(x, y, dy)
         if None in (A, sig, x0):
             self._getStartingValues()
         if A is not None:  self.A = A
         if sig is not None:  self.sig = sig
         if x0 is not None:  self.x0 = x0
-        print('Initial parameter values:')
-        self.printValues()
+        if not quiet:
+            print('Initial parameter values:')
+            self.printValues()
         return
 
     @property
@@ -114,22 +129,53 @@ class GaussianFit(object):
 
     def _getStartingValues(self):
         '''Estimate starting values for A, sig, and x0
+
+        The half maximum points either side of the peak are found from a
+        single pass over the data for the points below half maximum, with
+        x in ascending order.
         '''
         from numpy import sqrt, log, pi
         x, y = self.x, self.y
         peakIndex = y.argmax()
         peakValue = y[peakIndex]
         self.x0 = x[peakIndex]
-        halfmaxlo = (y < peakValue/2) & (x < self.x0)
-        xhalflo = x[halfmaxlo][-1] if halfmaxlo.any() else x.min()
-        halfmaxhi = (y < peakValue/2) & (x > self.x0)
-        xhalfhi = x[halfmaxhi][0] if halfmaxhi.any() else x.max()
+        below = np.flatnonzero(y < peakValue/2)
+        k = below.searchsorted(peakIndex)
+        xhalflo = x[below[k-1]] if k > 0 else x.min()
+        xhalfhi = x[below[k]] if k < len(below) else x.max()
         fwhm = xhalfhi - xhalflo
         self.sig = fwhm / (2 * sqrt(2 * log(2)))
         self.A = peakValue * sqrt(2 * pi) * self.sig
         return
 
 
+    @property
+    def chi2(self):
+        '''Sum of the squared weighted residuals for the current A, sig, x0
+        '''
+        return np.sum(self.recipe.residual()**2)
+
+    def update(self, y, dy=None, A=None, sig=None, x0=None):
+        '''Replace the y values to be fitted, keeping the x values and the
+        recipe, and reset the starting values.
+
+        y    -- new y values on the same x-grid.
+        dy   -- estimated standard deviations for the y-values
+                (may be omitted).
+        A, sig, x0   -- optional initial parameters for the Gauss function.
+                Omitted parameters will be estimated from the input data.
+        '''
+        profile = self.recipe.g1.profile
+        profile.setObservedProfile(profile.xobs, y, dy)
+        self.results = None
+        if None in (A, sig, x0):
+            self._getStartingValues()
+        if A is not None:  self.A = A
+        if sig is not None:  self.sig = sig
+        if x0 is not None:  self.x0 = x0
+        return
+
+
     def _makeRecipe(self, x, y, dy):
         '''Make a FitRecipe for fitting a Gaussian curve to data.
         '''
@@ -171,53 +217,224 @@ class GaussianFit(object):
         return ax
 
 
-    def refine(self):
+    def refine(self, quiet=False):
         '''Optimize the recipe created above using scipy.
+
+        quiet -- do not print the report of the fit results.
         '''
         from scipy.optimize.minpack import leastsq
-        leastsq(self.recipe.residual, self.recipe.values)
+        output = leastsq(self.recipe.residual, self.recipe.values,
+                         full_output=True)
+        self.nfev = output[2]['nfev']
         self.results = FitResults(self.recipe)
-        print("Fit results:\n")
-        print(self.results)
+        if not quiet:
+            print("Fit results:\n")
+            print(self.results)
         return
 
 # end of class GaussianFit
 
-# Define functions that are used in the gaussian fitting pipeline
-plt.ion()
-fig = plt.figure()
-ax1 = fig.add_subplot(211)
-ax2 = fig.add_subplot(212)
- 
-def generate_data(x0):
+
+class GaussianFitter(object):
+    '''Fit Gaussian curves to a series of data sets.
+
+    The diffpy recipe is built and its equation parsed once for each x-grid.
+    Later data sets on the same x-grid reuse it, so each fit only swaps in
+    the new y values and resets the starting values.  Only the max_grids
+    most recently used x-grids are kept.  Each fit is returned as a
+    FitSnapshot, which later fits on the same x-grid do not change.
+
+    With warm_start each fit starts from the refined parameters of the
+    previous fit on the same x-grid, which suits a peak that drifts slowly
+    from frame to frame.  The starting values are estimated from the data
+    instead when the peak estimated from the data has jumped too far from
+    the previous one, or when the previous parameters fit the new data much
+    worse than they fitted the previous data.  Either way the choice is
+    made before the fit, so each data set is refined once.
+    '''
+
+    def __init__(self, warm_start=False, max_chi2_ratio=4.0, max_jump=1.0,
+                 quiet=True, max_grids=4):
+        '''Create new GaussianFitter object
+
+        warm_start -- seed each fit from the previous refined parameters.
+        max_chi2_ratio -- estimate the starting values when chi2 of the
+                previous parameters on the new data is larger than this
+                times chi2 of the previous fit.
+        max_jump -- use the estimated starting values when their x0 is
+                further than this times the previous sig from the
+                previous x0.
+        quiet -- do not print the starting values and the fit report of
+                each fit.
+        max_grids -- the number of x-grids whose GaussianFit and previous
+                parameters are kept; the least recently used is dropped.
+        '''
+        self.warm_start = warm_start
+        self.max_chi2_ratio = max_chi2_ratio
+        self.max_jump = max_jump
+        self.quiet = quiet
+        self.max_grids = max_grids
+        # The GaussianFit and the previous parameters of each x-grid, least
+        # recently used first
+        self._fits = OrderedDict()
+        return
+
+    def __call__(self, x, y, dy=None):
+        '''Fit a Gaussian curve to the data and return a FitSnapshot of
+        the fit.
+        '''
+        x = np.asarray(x, dtype=float)
+        key = (x.shape, x.tobytes())
+        gfit, previous = self._fits.pop(key, (None, None))
+        if gfit is None:
+            gfit = GaussianFit(x, y, dy, quiet=self.quiet)
+        else:
+            gfit.update(y, dy)
+        if not self.warm_start:
+            previous = None
+        if previous is not None:
+            A, sig, x0, chi2 = previous
+            start = (gfit.A, gfit.sig, gfit.x0)
+            if abs(gfit.x0 - x0) <= self.max_jump * abs(sig):
+                gfit.A, gfit.sig, gfit.x0 = A, sig, x0
+                if gfit.chi2 > self.max_chi2_ratio * chi2:
+                    gfit.A, gfit.sig, gfit.x0 = start
+        gfit.refine(quiet=self.quiet)
+        self._fits[key] = (
+            gfit, (gfit.A, gfit.sig, gfit.x0, gfit.results.chi2))
+        while len(self._fits) > self.max_grids:
+            self._fits.popitem(last=False)
+        return FitSnapshot(gfit)
+
+# end of class GaussianFitter
+
+# Define functions that are used in the gaussian fitting pipeline.  The
+# figure is only created when something is first plotted, so importing this
+# module opens no GUI and the fitting functions run without matplotlib.
+_figure = None
+
+def get_figure():
+    '''Return the figure and the axes for the data and the fit, creating
+    them on first use.
+    '''
+    global _figure
+    if _figure is None:
+        import matplotlib.pyplot as plt
+        plt.ion()
+        fig = plt.figure()
+        _figure = (fig, fig.add_subplot(211), fig.add_subplot(212))
+    return _figure
+
+def _redraw(fig):
+    '''Draw the figure and process GUI events without sleeping.
+    '''
+    fig.canvas.draw_idle()
+    fig.canvas.flush_events()
+
+def generate_data(x0, interval=0):
+    '''Simulate a frame with a peak at x0, waiting interval seconds to
+    mimic the frame rate of a detector.
+    '''
     x = np.arange(-20, 20, 0.1)
     sig = 1.5
     noise = 0.2 * np.ones_like(x)
     y = np.exp(-0.5*(x-x0)**2/sig**2) + noise * np.random.randn(*x.shape)
-    plt.pause(1)
+    if interval > 0:
+        time.sleep(interval)
     dat = (x, y)
     return dat
 
 def plot_data(dat):
     x, y = dat[0], dat[1]
-    #f1 = plt.figure(1)
-    #plt.ion(); plt.clf()
+    fig, ax1, ax2 = get_figure()
     ax1.cla()
     line1 = ax1.plot(x, y, 'x')
-    fig.canvas.draw()
-    plt.pause(0.1)
+    _redraw(fig)
+
+# Each thread has its own fitters, so that fits in different threads do not
+# share a recipe
+_local = threading.local()
 
-def fit_data(dat):
+def get_fitter(warm_start=True):
+    '''Return the GaussianFitter of this thread with or without warm start.
+    '''
+    if not hasattr(_local, 'fitters'):
+        _local.fitters = {}
+    if warm_start not in _local.fitters:
+        _local.fitters[warm_start] = GaussianFitter(warm_start=warm_start)
+    return _local.fitters[warm_start]
+
+def fit_data(dat, warm_start=True):
+    '''Fit the data and return a FitSnapshot, which can be kept after the
+    next frame is fitted and sent back from a worker process.
+
+    warm_start -- start from the previous fit of this thread, which only
+                  helps when the thread sees consecutive frames
+    '''
     x, y = dat[0], dat[1]
-    gfit = GaussianFit(x,y)
-    gfit.refine()
-    plt.pause(1)
-    return gfit
+    fit = get_fitter(warm_start)(x, y)
+    return fit
 
 def plot_fit(gfit):
+    fig, ax1, ax2 = get_figure()
     ax2.cla()
     l2a = ax2.plot(gfit.x, gfit.y, 'b.', label="observed Gaussian")
     l2b = ax2.plot(gfit.x, gfit.yg, 'g-', label="calculated Gaussian")
     ax2.legend()
-    fig.canvas.draw()
-    plt.pause(0.1)
+    _redraw(fig)
+
+
+class FitSnapshot(object):
+    '''A copy of the data and the refined parameters of a GaussianFit.
+
+    Unlike the GaussianFit of a GaussianFitter it is not changed by later
+    fits, and it can be pickled.  It has the x, y, dy, yg, A, sig and x0 of
+    the GaussianFit, the estimated standard deviations dA, dsig and dx0,
+    and chi2.  Its arrays are read-only.
+    '''
+
+    def __init__(self, gfit):
+        self.x, self.y, self.dy, self.yg = (
+            np.array(v) for v in (gfit.x, gfit.y, gfit.dy, gfit.yg))
+        for v in (self.x, self.y, self.dy, self.yg):
+            v.flags.writeable = False
+        self.A, self.sig, self.x0 = gfit.A, gfit.sig, gfit.x0
+        unc = dict(zip(gfit.results.varnames, gfit.results.varunc))
+        self.dA, self.dsig, self.dx0 = unc['A'], unc['sig'], unc['x0']
+        self.chi2 = gfit.results.chi2
+        return
+
+# end of class FitSnapshot
+
+
+class RateLimitedSink(object):
+    '''Call a function, such as a plotting function, at most once per
+    interval.
+
+    Frames that arrive less than interval seconds after the last one that
+    was passed on are dropped rather than queued, so a slow sink never holds
+    up the rest of the pipeline.
+
+    func -- the function to call with each frame that is kept
+    interval -- the minimum time in seconds between calls
+    dropped -- the number of frames dropped so far
+    '''
+
+    def __init__(self, func, interval=0.5):
+        self.func = func
+        self.interval = interval
+        self.dropped = 0
+        self._last = None
+        return
+
+    def __call__(self, frame):
+        now = time.time()
+        if self._last is not None and now - self._last < self.interval:
+            self.dropped += 1
+            return
+        self.func(frame)
+        # Measure from the end of the call so that a slow sink drops more
+        self._last = time.time()
+        return
+
+# end of class RateLimitedSink
@@ -1,16 +1,188 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import multiprocessing
+import queue
+import threading
+
 from streamz_ext import Stream
-from streamz_ext.graph import node_style, run_vis
-import matplotlib.pyplot as plt
 
 from diffstreamz.gaussianfitlib import generate_data, plot_data, fit_data, plot_fit
+from diffstreamz.gaussianfitlib import RateLimitedSink
 
 #Define the pipeline for gaussian fitting
-def pipeline():
-    pipeline = Stream()
+def pipeline(headless=False, plot_interval=0.5, frame_interval=0, results=None):
+    '''Build the gaussian fitting pipeline and return its source node.
 
-    b = pipeline.map(generate_data)
-    b.sink(plot_data)
+    headless -- fit without plotting, e.g. on a cluster node
+    plot_interval -- the minimum time in seconds between plots; frames that
+                     arrive sooner are not plotted
+    frame_interval -- the time in seconds generate_data waits for each frame
+    results -- a function called with the FitSnapshot of each frame
+    '''
+    pipeline = Stream()
 
+    b = pipeline.map(generate_data, interval=frame_interval)
     c = b.map(fit_data)
-    c.sink(plot_fit)
+    if not headless:
+        b.sink(RateLimitedSink(plot_data, plot_interval))
+        c.sink(RateLimitedSink(plot_fit, plot_interval))
+    # A node without a sink downstream is not kept, so the fits always end
+    # in a sink
+    if results is not None or headless:
+        c.sink(results or (lambda fit: None))
     return pipeline
+
+
+class ordered_pool_map(Stream):
+    '''Apply a function to each element on a pool of workers and emit the
+    results in the order of the input.
+
+    Each result is emitted as soon as it and the results before it are
+    done, without waiting for the next element.  The results are emitted
+    one at a time on a thread of this node, so the nodes downstream run on
+    that thread; put a caller_buffer in front of those that must run on the
+    thread feeding the stream, such as plots.  At most max_in_flight
+    elements are submitted to the pool and not yet emitted.  When the
+    window is full, update waits for room, which holds up the upstream
+    nodes.  Call close after the last element to wait for the results
+    still in flight.
+    '''
+
+    def __init__(self, upstream, func, executor, max_in_flight, **kwargs):
+        self.func = func
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self._pending = deque()
+        self._emitted = threading.Condition()
+        self._emitter = ThreadPoolExecutor(1)
+        self._error = None
+        Stream.__init__(self, upstream, **kwargs)
+
+    def update(self, x, who=None, **kwargs):
+        future = self.executor.submit(self.func, x)
+        with self._emitted:
+            self._pending.append(future)
+        future.add_done_callback(
+            lambda future: self._emitter.submit(self._emit_ready))
+        self._wait_for(self.max_in_flight - 1)
+
+    def _emit_ready(self):
+        '''Emit the finished results at the head of the window.  Only the
+        emitter thread calls this, so the results are emitted in order.
+        '''
+        while self._pending and self._pending[0].done():
+            future = self._pending[0]
+            try:
+                self._emit(future.result())
+            except Exception as e:
+                # Keep emitting the later results; flush raises the first
+                # error
+                self._error = self._error or e
+            with self._emitted:
+                self._pending.popleft()
+                self._emitted.notify_all()
+
+    def _wait_for(self, n):
+        '''Wait until at most n elements are in flight.
+        '''
+        with self._emitted:
+            while len(self._pending) > n:
+                self._emitted.wait()
+
+    def flush(self):
+        '''Wait until all the results in flight are emitted, pass on the
+        elements held by the caller_buffer nodes downstream, and raise the
+        first error, if any.
+        '''
+        self._wait_for(0)
+        for downstream in self.downstreams:
+            if isinstance(downstream, caller_buffer):
+                downstream.drain()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        '''Wait for the results in flight and shut down the pool.
+        '''
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+            self._emitter.shutdown()
+
+
+class caller_buffer(Stream):
+    '''Hold the elements emitted on other threads until drain is called.
+
+    drain emits the held elements in order on the calling thread, e.g. to
+    plot the results of an ordered_pool_map on the main thread.
+    '''
+
+    def __init__(self, upstream, **kwargs):
+        self._queue = queue.Queue()
+        Stream.__init__(self, upstream, **kwargs)
+
+    def update(self, x, who=None, **kwargs):
+        self._queue.put(x)
+
+    def drain(self):
+        '''Emit the elements held so far on this thread.
+        '''
+        while True:
+            try:
+                x = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._emit(x)
+
+
+#Define the pipeline for gaussian fitting with the fits on a pool of workers
+def parallel_pipeline(nworkers=None, max_in_flight=None, processes=True,
+                      headless=False, plot_interval=0.5, frame_interval=0,
+                      results=None):
+    '''Build the gaussian fitting pipeline with the fit stage on a pool of
+    workers and return its source node and the fit node.
+
+    The fits are FitSnapshot objects, emitted in the order of the frames
+    as soon as they are done, so results is called on a thread of the fit
+    node.  The frames are generated and all the plots drawn on the thread
+    that emits into the source node; the fits done so far are plotted
+    with each new frame.  Call close on the fit node after the last frame
+    to wait for the fits still in flight and shut down the pool.
+
+    The workers fit without warm start: each worker sees an arbitrary
+    subset of the frames, so the last fit of a worker is no better a
+    start than the estimate from the data.
+
+    nworkers -- the number of workers (default the number of CPUs)
+    max_in_flight -- the maximum number of frames being fitted or waiting
+                     to be emitted (default twice the number of workers)
+    processes -- use worker processes rather than threads; the fits are
+                 mostly Python code, which threads cannot run in parallel
+    The other options are as for pipeline.
+    '''
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * nworkers
+    if processes:
+        executor = ProcessPoolExecutor(nworkers)
+    else:
+        executor = ThreadPoolExecutor(nworkers)
+
+    pipeline = Stream()
+
+    b = pipeline.map(generate_data, interval=frame_interval)
+    c = ordered_pool_map(b, partial(fit_data, warm_start=False), executor,
+                         max_in_flight)
+    if not headless:
+        # GUI backends only draw on the main thread
+        fits = caller_buffer(c)
+        b.sink(RateLimitedSink(plot_data, plot_interval))
+        b.sink(lambda dat: fits.drain())
+        fits.sink(RateLimitedSink(plot_fit, plot_interval))
+    if results is not None or headless:
+        c.sink(results or (lambda fit: None))
+    return pipeline, c
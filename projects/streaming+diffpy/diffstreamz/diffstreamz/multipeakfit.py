@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+This defines the class MultiGaussianFit for fitting a sum of Gaussian peaks
+to data.  The number of peaks and their starting values are found by peak
+detection unless they are given, and the fit uses scipy.optimize.leastsq with
+the analytic Jacobian of the Gauss functions.
+
+Each peak is fitted over a window of a few sig either side of its center.
+Peaks whose windows overlap are fitted together and the other groups of
+peaks are fitted as independent problems, so the cost grows linearly with
+the number of well separated peaks.
+
+Example usage is:
+
+import numpy as np
+x, y = np.loadtxt('data/two_peaks.txt', delimiter=',', unpack=True)
+mfit = MultiGaussianFit(x, y, np.sqrt(y), npeaks=2)
+mfit.refine()
+print(mfit.x0, mfit.dx0)
+
+x, y, dy are the data to be fitted with Gaussian peaks (dy may be omitted).
+npeaks is the number of peaks to fit; if omitted all the detected peaks are
+fitted.  A, sig, and x0 are initial values with one value for each peak.  If
+omitted the program will estimate their starting values.
+
+"""
+
+from __future__ import print_function
+import warnings
+import numpy as np
+
+from diffstreamz.gaussianbatchfit import gaussian
+
+# The factor between FWHM and sig of a Gauss function
+FWHM_SIG = 2 * np.sqrt(2 * np.log(2))
+
+
+def detect_peaks(x, y, dy=None, npeaks=None, smooth=2.0, threshold=5.0):
+    '''Find peaks in the data and estimate their starting values.
+
+    The data are smoothed with a Gaussian filter and the local maxima with a
+    prominence of at least threshold times the noise are taken as peaks.
+    When npeaks is given and fewer maxima are found, peaks which only show
+    as shoulders are found from the minima of the second derivative of the
+    smoothed data.
+
+    x, y -- the data, with x in ascending order and evenly spaced
+    dy   -- estimated standard deviations for the y-values (may be
+            omitted, in which case the noise is estimated from the data)
+    npeaks -- the maximum number of peaks, the most prominent first
+    smooth -- the width (sigma) of the smoothing filter in points
+    threshold -- the minimum prominence in units of the noise
+
+    Return the arrays of A, sig and x0 of the peaks in order of x0.
+    '''
+    from scipy.ndimage import gaussian_filter1d
+    from scipy.signal import find_peaks, peak_widths
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    step = (x[-1] - x[0]) / (len(x) - 1)
+    if dy is None:
+        noise = 1.4826 * np.median(np.abs(np.diff(y))) / np.sqrt(2)
+    else:
+        noise = np.asarray(dy, dtype=float)
+    # Smoothing with a Gaussian filter of smooth points reduces white noise
+    noise = np.broadcast_to(
+        noise / np.sqrt(2 * np.sqrt(np.pi) * smooth), y.shape)
+    ys = gaussian_filter1d(y, smooth)
+    index, properties = find_peaks(ys, prominence=0)
+    prominence = properties['prominences']
+    significant = prominence >= threshold * noise[index]
+    index, prominence = index[significant], prominence[significant]
+    index = index[np.argsort(prominence)[::-1]][:npeaks]
+    fwhm = peak_widths(ys, index, rel_height=0.5)[0]
+
+    # Shoulders are minima of the second derivative, which is at its most
+    # negative at the center of a Gauss function and crosses zero at +-sig.
+    # The second derivative is smoothed on the scale of the peaks found.
+    if npeaks is not None and len(index) < npeaks:
+        width = smooth
+        if len(index) > 0:
+            width = max(smooth, np.median(fwhm) / FWHM_SIG / 4)
+        curvature = -gaussian_filter1d(y, width, order=2)
+        extra, properties = find_peaks(curvature, prominence=0)
+        extra = extra[np.argsort(properties['prominences'])[::-1]]
+        half = peak_widths(curvature, extra, rel_height=0.5)[0]
+        for i, width in zip(extra, half):
+            if len(index) >= npeaks:
+                break
+            # A shoulder must be more than half a sig from the peaks found.
+            # The second derivative of a Gauss function has a FWHM of 1.25
+            # sig, but that of a shoulder is broadened by its neighbour.
+            distance = np.abs(index - i)
+            if np.all(distance > fwhm / FWHM_SIG / 2):
+                sig = min([width / 1.25] + list(distance))
+                index = np.append(index, i)
+                fwhm = np.append(fwhm, sig * FWHM_SIG)
+
+    # Seed the peaks in the order they were found, the most prominent
+    # first, each from the smoothed data less the peaks seeded before it.
+    # sig is taken from the half widths at half maximum, leaving out a side
+    # that reaches over a peak still to be seeded.  The width of the
+    # detection is used where there is no half maximum.
+    x0 = x[index]
+    sig = np.maximum(fwhm, 1) * step / FWHM_SIG
+    A = np.zeros(len(index))
+    resid = ys.copy()
+    for k, i in enumerate(index):
+        left, right = half_widths(resid, i)
+        later = index[k+1:]
+        if np.any((later < i) & (later > i - left)):
+            left = np.inf
+        if np.any((later > i) & (later < i + right)):
+            right = np.inf
+        hwhm = [w for w in (left, right) if np.isfinite(w)]
+        if hwhm:
+            sig[k] = max(np.mean(hwhm), 0.5) * step / (FWHM_SIG / 2)
+        A[k] = max(resid[i], 0) * np.sqrt(2 * np.pi) * sig[k]
+        resid -= gaussian(x, A[k], sig[k], x0[k])[0]
+    # Seed each peak again from the data less all the other peaks
+    for k, i in enumerate(index):
+        resid += gaussian(x, A[k], sig[k], x0[k])[0]
+        hwhm = [w for w in half_widths(resid, i) if np.isfinite(w)]
+        if hwhm:
+            sig[k] = max(np.mean(hwhm), 0.5) * step / (FWHM_SIG / 2)
+        A[k] = max(resid[i], 0) * np.sqrt(2 * np.pi) * sig[k]
+        resid -= gaussian(x, A[k], sig[k], x0[k])[0]
+
+    order = np.argsort(index)
+    index, x0, sig, A = index[order], x0[order], sig[order], A[order]
+    # Share the height of overlapping peaks between them
+    if len(index) > 1:
+        overlap = np.exp(-0.5 * (x0[:,None] - x0)**2 / sig**2)
+        A = np.linalg.lstsq(overlap / (np.sqrt(2 * np.pi) * sig),
+                            ys[index], rcond=None)[0]
+        A = np.where(A > 0, A, ys[index] * np.sqrt(2 * np.pi) * sig)
+    return A, sig, x0
+
+
+def half_widths(y, i):
+    '''Return the distances in points from y[i] to where y falls to half of
+    y[i] on its left and on its right, interpolated between the points.
+    A side where y does not fall to half of y[i] has a distance of inf.
+    '''
+    half = y[i] / 2
+    left = right = np.inf
+    if half <= 0:
+        return left, right
+    below = np.flatnonzero(y < half)
+    k = below.searchsorted(i)
+    if k > 0:
+        j = below[k-1]
+        left = i - j - (half - y[j]) / (y[j+1] - y[j])
+    if k < len(below):
+        j = below[k]
+        right = j - 1 - i + (y[j-1] - half) / (y[j-1] - y[j])
+    return left, right
+
+
+def group_peaks(sig, x0, window):
+    '''Group the peaks whose windows overlap.
+
+    sig, x0 -- the widths and centers of the peaks in order of x0
+    window -- the half width of the window of each peak in units of sig
+
+    Return a list of arrays of the indices of the peaks in each group.
+    '''
+    if len(x0) == 0:
+        return []
+    lo = x0 - window * np.abs(sig)
+    hi = x0 + window * np.abs(sig)
+    reach = np.maximum.accumulate(hi)
+    start = np.flatnonzero(np.append(True, lo[1:] > reach[:-1]))
+    return np.split(np.arange(len(x0)), start[1:])
+
+
+class MultiGaussianFit(object):
+    '''Least-squares fit of a sum of Gauss functions to the specified data.
+
+    Input and simulated data (read-only):
+
+    x    --  input x values
+    y    --  input y values
+    dy   --  estimated standard deviations for the y-values
+    yg   --  sum of the Gauss functions calculated for the current A, sig,
+             x0
+
+    Parameters of the Gauss functions, one for each peak:
+
+    A    --  integrated area of the fitted peak
+    sig  --  width of curve (parameter sigma in the Gauss distribution
+             function)
+    x0   --  x-position of the peak center
+
+    Fit results:
+
+    dA, dsig, dx0 -- estimated standard deviations of A, sig and x0
+    groups -- the indices of the peaks in each independent fit
+    nfev -- number of residual evaluations in the last refinement
+    '''
+
+    def __init__(self, x, y, dy=None, npeaks=None, A=None, sig=None,
+                 x0=None, window=4.0, **kwargs):
+        '''Create new MultiGaussianFit object
+
+        x, y -- curve to be fitted with Gaussian peaks.
+        dy   -- estimated standard deviations for the y-values
+                (may be omitted).
+        npeaks -- the number of peaks to detect (default all of them).
+        A, sig, x0   -- optional initial parameters for the Gauss
+                functions.  Omitted parameters will be estimated from the
+                input data.
+        window -- the half width of the fitting window of each peak in
+                units of sig.
+        kwargs -- other options for detect_peaks.
+        '''
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        if dy is None:
+            dy = 1.0
+        self.dy = np.broadcast_to(np.asarray(dy, dtype=float), self.y.shape)
+        self.window = window
+        if None in (A, sig, x0):
+            params = list(detect_peaks(
+                self.x, self.y, dy=None if np.ndim(dy) == 0 else self.dy,
+                npeaks=npeaks, **kwargs))
+        else:
+            params = [A, sig, x0]
+        for i, value in enumerate((A, sig, x0)):
+            if value is not None:
+                params[i] = value
+        self.params = np.transpose(np.broadcast_arrays(*params)).astype(float)
+        self.dparams = np.full(self.params.shape, np.nan)
+        self.groups = []
+        self.nfev = 0
+        return
+
+    @property
+    def npeaks(self):
+        return len(self.params)
+
+    @property
+    def A(self):
+        return self.params[:,0]
+
+    @property
+    def sig(self):
+        return self.params[:,1]
+
+    @property
+    def x0(self):
+        return self.params[:,2]
+
+    @property
+    def dA(self):
+        return self.dparams[:,0]
+
+    @property
+    def dsig(self):
+        return self.dparams[:,1]
+
+    @property
+    def dx0(self):
+        return self.dparams[:,2]
+
+    @property
+    def yg(self):
+        return self.evaluate(self.x)
+
+    def evaluate(self, x):
+        '''Compute the sum of the Gauss functions at x.
+        '''
+        A, sig, x0 = (self.params[:,i,None] for i in range(3))
+        return gaussian(x, A, sig, x0)[0].sum(axis=0)
+
+    def refine(self):
+        '''Optimize the parameters with scipy.optimize.leastsq and the
+        analytic Jacobian, fitting each group of overlapping peaks over the
+        points in their windows.
+
+        log A is refined in place of A, so that the areas stay positive.
+        A group with no more points in its windows than parameters is not
+        refined; it keeps its starting values and NaN uncertainties, and a
+        RuntimeWarning is issued.
+        '''
+        from scipy.optimize import leastsq
+        order = np.argsort(self.x0)
+        self.params = self.params[order]
+        self.groups = group_peaks(self.sig, self.x0, self.window)
+        self.nfev = 0
+        for group in self.groups:
+            p = self.params[group]
+            lo = (p[:,2] - self.window * np.abs(p[:,1])).min()
+            hi = (p[:,2] + self.window * np.abs(p[:,1])).max()
+            i0, i1 = np.searchsorted(self.x, [lo, hi])
+            x = self.x[i0:i1]
+            y = self.y[i0:i1]
+            weight = 1 / self.dy[i0:i1]
+            self.dparams[group] = np.nan
+            if len(x) <= 3 * len(group):
+                warnings.warn('peaks %s have %d points in their windows, '
+                              'too few to refine them'
+                              % (group.tolist(), len(x)), RuntimeWarning)
+                continue
+
+            def unpack(p):
+                p = p.reshape(-1, 3)
+                return np.exp(p[:,0,None]), p[:,1,None], p[:,2,None]
+
+            def residual(p):
+                return (gaussian(x, *unpack(p))[0].sum(axis=0) - y) * weight
+
+            def jacobian(p):
+                A = unpack(p)[0]
+                jac = gaussian(x, *unpack(p))[1]
+                jac[...,0] *= A
+                return jac.transpose(1, 0, 2).reshape(len(x), -1) * \
+                    weight[:,None]
+
+            p[:,0] = np.log(np.maximum(p[:,0], np.finfo(float).tiny))
+            p, cov, info, msg, ier = leastsq(
+                residual, p.ravel(), Dfun=jacobian, full_output=True)
+            p = p.reshape(-1, 3)
+            p[:,0] = np.exp(p[:,0])
+            self.params[group] = p
+            if cov is not None:
+                dp = np.sqrt(np.abs(np.diag(cov))).reshape(-1, 3)
+                dp[:,0] *= p[:,0]
+                self.dparams[group] = dp
+            self.nfev += info['nfev'] + info.get('njev', 0)
+        return
+
+    def printValues(self):
+        '''Print out values of Gaussian parameters
+        '''
+        for i, (A, sig, x0) in enumerate(self.params):
+            print('peak', i, 'A =', A, 'sig =', sig, 'x0 =', x0)
+        return
+
+# end of class MultiGaussianFit
@@ -0,0 +1,56 @@
+import numpy as np
+
+from diffstreamz.gaussianbatchfit import BatchGaussianFit
+from diffstreamz.gaussianfitlib import GaussianFit
+
+
+def make_spectra(n, seed=0):
+    rs = np.random.RandomState(seed)
+    x = np.arange(-20, 20, 0.1)
+    # Peaks 1 to 2 high over noise of 0.2
+    sig = rs.uniform(0.5, 3, n)
+    A = rs.uniform(2.5, 5, n) * sig
+    x0 = rs.uniform(-10, 10, n)
+    y = (A[:,None] / np.sqrt(2 * np.pi * sig[:,None]**2) *
+         np.exp(-0.5 * (x - x0[:,None])**2 / sig[:,None]**2))
+    y += 0.2 * rs.randn(n, len(x))
+    return x, y
+
+
+def test_matches_gaussianfit():
+    x, y = make_spectra(20)
+    bfit = BatchGaussianFit(x, y, 0.2)
+    bfit.refine()
+    assert bfit.converged.all()
+    for i in range(len(y)):
+        gfit = GaussianFit(x, y[i], 0.2 * np.ones_like(x))
+        gfit.refine()
+        unc = dict(zip(gfit.results.varnames, gfit.results.varunc))
+        dparams = np.array([unc['A'], unc['sig'], unc['x0']])
+        # Both refinements stop within the leastsq tolerances, which are
+        # far below the uncertainties
+        params = np.array([gfit.A, gfit.sig, gfit.x0])
+        assert np.all(np.abs(bfit.params[i] - params) < 1e-3 * dparams)
+        np.testing.assert_allclose(bfit.dparams[i], dparams, rtol=1e-3)
+        np.testing.assert_allclose(bfit.chi2[i], gfit.results.chi2,
+                                   rtol=1e-6)
+
+
+def test_rows_of_x_and_dy():
+    x, y = make_spectra(5, seed=1)
+    dy = np.full(y.shape, 0.2)
+    shared = BatchGaussianFit(x, y, 0.2)
+    shared.refine()
+    rows = BatchGaussianFit(np.tile(x, (len(y), 1)), y, dy)
+    rows.refine()
+    np.testing.assert_allclose(rows.params, shared.params)
+    np.testing.assert_allclose(rows.dparams, shared.dparams)
+
+
+def test_stalled_fits_are_not_converged():
+    x, y = make_spectra(4, seed=2)
+    # No step can reduce chi2 of a spectrum with a NaN
+    y[1, 10] = np.nan
+    bfit = BatchGaussianFit(x, y, 0.2)
+    bfit.refine()
+    assert bfit.converged.tolist() == [True, False, True, True]
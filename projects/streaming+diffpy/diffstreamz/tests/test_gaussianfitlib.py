@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from diffstreamz.gaussianfitlib import GaussianFitter, FitSnapshot
+
+
+def frame(x0, seed):
+    rs = np.random.RandomState(seed)
+    x = np.arange(-20, 20, 0.1)
+    y = np.exp(-0.5 * (x - x0)**2 / 1.5**2) + 0.2 * rs.randn(len(x))
+    return x, y
+
+
+def test_fits_are_snapshots(capsys):
+    fitter = GaussianFitter()
+    x, y = frame(-2, 0)
+    first = fitter(x, y)
+    x0 = first.x0
+    second = fitter(*frame(3, 1))
+    assert isinstance(first, FitSnapshot)
+    assert first is not second
+    assert first.x0 == x0
+    assert np.array_equal(first.y, y)
+    assert abs(first.x0 + 2) < 0.5 and abs(second.x0 - 3) < 0.5
+    with pytest.raises(ValueError):
+        first.y[0] = 0
+    # The fitter is quiet by default
+    assert capsys.readouterr().out == ''
+
+
+def test_warm_start_reaches_cold_optimum():
+    warm = GaussianFitter(warm_start=True)
+    cold = GaussianFitter()
+    # The peak stays away from x = 0, where leastsq cannot step x0 from
+    # an estimated starting value of exactly 0
+    for i, x0 in enumerate(np.linspace(1, 8, 40)):
+        x, y = frame(x0, i)
+        wfit = warm(x, y)
+        cfit = cold(x, y)
+        for name in ('A', 'sig', 'x0'):
+            diff = getattr(wfit, name) - getattr(cfit, name)
+            assert abs(diff) < 1e-3 * getattr(cfit, 'd' + name)
+        assert abs(wfit.chi2 - cfit.chi2) <= 1e-6 * cfit.chi2
+
+
+def test_keeps_recent_grids():
+    fitter = GaussianFitter(max_grids=2)
+    for step in (0.1, 0.2, 0.1, 0.25, 0.3):
+        x = np.arange(-20, 20, step)
+        fitter(x, np.exp(-0.5 * x**2 / 1.5**2))
+    assert [len(np.frombuffer(key[1])) for key in fitter._fits] == [160, 134]
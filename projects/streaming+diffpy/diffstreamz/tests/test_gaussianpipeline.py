@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+from streamz_ext import Stream
+
+from diffstreamz import gaussianpipeline
+from diffstreamz.gaussianpipeline import caller_buffer, ordered_pool_map
+
+
+def slow_square(x):
+    # Later elements finish first
+    time.sleep(0.02 * (5 - x % 5))
+    return x * x
+
+
+def test_order_and_window():
+    source = Stream()
+    out = []
+    in_flight = []
+    node = ordered_pool_map(source, slow_square, ThreadPoolExecutor(4), 3)
+    node.sink(out.append)
+    for x in range(12):
+        source.emit(x)
+        in_flight.append(len(node._pending))
+    node.close()
+    assert out == [x * x for x in range(12)]
+    assert max(in_flight) < 3
+
+
+def test_emits_without_next_element():
+    source = Stream()
+    emitted = threading.Event()
+    node = ordered_pool_map(source, slow_square, ThreadPoolExecutor(2), 10)
+    node.sink(lambda x: emitted.set())
+    source.emit(4)
+    assert emitted.wait(5)
+    node.close()
+
+
+def test_flush_raises_error():
+    source = Stream()
+    out = []
+    node = ordered_pool_map(source, lambda x: 1 // x, ThreadPoolExecutor(2), 4)
+    node.sink(out.append)
+    for x in (1, 0, 1):
+        source.emit(x)
+    with pytest.raises(ZeroDivisionError):
+        node.close()
+    assert out == [1, 1]
+
+
+def test_caller_buffer_emits_on_caller_thread():
+    source = Stream()
+    threads = []
+    node = ordered_pool_map(source, slow_square, ThreadPoolExecutor(2), 4)
+    buffered = caller_buffer(node)
+    buffered.sink(lambda x: threads.append(threading.current_thread()))
+    for x in range(6):
+        source.emit(x)
+    node.close()
+    assert threads == [threading.current_thread()] * 6
+
+
+def test_parallel_pipeline_plots_on_caller_thread(monkeypatch):
+    threads = {'data': set(), 'fit': set()}
+    monkeypatch.setattr(gaussianpipeline, 'plot_data', lambda dat:
+                        threads['data'].add(threading.current_thread()))
+    monkeypatch.setattr(gaussianpipeline, 'plot_fit', lambda fit:
+                        threads['fit'].add(threading.current_thread()))
+    fits = []
+    source, node = gaussianpipeline.parallel_pipeline(
+        nworkers=2, processes=False, plot_interval=0, results=fits.append)
+    for x0 in range(-3, 4):
+        source.emit(x0)
+    node.close()
+    assert len(fits) == 7
+    assert threads == {'data': {threading.current_thread()},
+                       'fit': {threading.current_thread()}}
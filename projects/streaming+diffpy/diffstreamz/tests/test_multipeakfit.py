@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pytest
+
+from diffstreamz.multipeakfit import MultiGaussianFit
+
+DATA = os.path.join(os.path.dirname(__file__), '..', 'data', 'two_peaks.txt')
+
+
+def load_two_peaks():
+    x, y = np.loadtxt(DATA, delimiter=',', unpack=True)
+    return x, y
+
+
+def test_two_peaks():
+    x, y = load_two_peaks()
+    mfit = MultiGaussianFit(x, y, np.sqrt(y), npeaks=2)
+    mfit.refine()
+    chi2 = np.sum((mfit.yg - y)**2 / y)
+    assert chi2 == pytest.approx(942.1, abs=0.1)
+    assert np.all(mfit.A > 0)
+    np.testing.assert_allclose(mfit.A, [29118, 503], rtol=1e-3)
+    np.testing.assert_allclose(mfit.sig, [29.16, 3.108], rtol=1e-3)
+    np.testing.assert_allclose(mfit.x0, [49.64, 70.97], atol=0.01)
+    assert np.all(np.isfinite(mfit.dparams))
+
+
+def test_too_few_points_warns():
+    x, y = load_two_peaks()
+    mfit = MultiGaussianFit(x, y, np.sqrt(y), npeaks=2, window=0.001)
+    with pytest.warns(RuntimeWarning, match='too few'):
+        mfit.refine()
+    assert np.all(np.isnan(mfit.dparams))
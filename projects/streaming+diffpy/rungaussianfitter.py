@@ -3,8 +3,8 @@ import matplotlib.pyplot as plt
 
 from diffstreamz.gaussianpipeline import pipeline
 
-#Define the pipeline
-pipeline = pipeline()
+#Define the pipeline, generating one frame per second as a detector would
+pipeline = pipeline(frame_interval=1)
 
 #Emit data into pipeline source node
 def main():
@@ -0,0 +1,220 @@
+from __future__ import division
+import csv
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+from random_search import read_votes
+from random_search import filter_tutorials
+from random_search import local_search
+from random_search import random_sampling
+from random_search import branch_and_bound
+from random_search import CostFunction
+from random_search import PairwiseCostFunction
+
+# The default conferences: nparticipants, mchoice, parallel, slots, votes
+DEFAULT_SCALES = [
+  (100, 40, 4, 8, 3),
+  (1000, 200, 6, 30, 5),
+  (5000, 1000, 9, 100, 5),
+  (20000, 2000, 10, 180, 5),
+]
+
+
+def write_conference(filename, n_participants, n_tutorials, n_sessions,
+                     n_slots, n_votes, seed=0):
+  '''
+  Write a synthetic conference in the format of
+  timetable_bigconference_simulated.txt. Each participant votes for n_votes
+  different tutorials, with some tutorials more popular than others.
+
+  '''
+  random_state = np.random.RandomState(seed)
+  weight = 1 / np.arange(1, n_tutorials+1)**0.5
+  weight = random_state.permutation(weight / weight.sum())
+  with open(filename, "w") as outfile:
+    outfile.write(" %d %d %d %d %d   ! nparticipants, mchoice, parallel, "
+                  "slots, votes\n" % (
+                    n_participants, n_tutorials, n_sessions, n_slots, n_votes))
+    for i in range(n_participants):
+      votes = random_state.choice(
+        n_tutorials, size=n_votes, replace=False, p=weight) + 1
+      outfile.write(" xyz" + "".join("%12d" % v for v in votes) + "\n")
+
+
+def peak_memory():
+  '''
+  :returns: The peak resident set size of this process in MB
+
+  '''
+  usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return usage / 1024**2
+  return usage / 1024
+
+
+def _run_optimizer(queue, filename, method, max_time, seed):
+  '''
+  Run one optimizer on one conference in a child process, recording the best
+  cost against time
+
+  '''
+  try:
+    votes = read_votes(filename, check=False)
+    n_slots, n_sessions = votes.n_slots, votes.n_sessions
+    participant_tutorials, tutorial_index = filter_tutorials(
+      votes.participant_tutorials(), None)
+    curve = []
+    proven = None
+    start_time = time.time()
+
+    def progress(num_iter, min_cost, best_schedules):
+      elapsed = time.time() - start_time
+      if len(curve) == 0 or curve[-1][2] != min_cost or elapsed - curve[-1][0] > 0.1:
+        curve.append((elapsed, num_iter, min_cost))
+
+    if method == "exact":
+      conflicts, schedule, proven, num_iter = branch_and_bound(
+        participant_tutorials, n_slots, n_sessions, tutorial_index,
+        max_time=max_time)
+      schedules = [] if schedule is None else [schedule]
+    else:
+      search = local_search if method == "anneal" else random_sampling
+      min_cost, schedules, num_iter = search(
+        participant_tutorials, tutorial_index, n_slots, n_sessions,
+        max_time=max_time, seed=seed, progress=progress)
+    elapsed = time.time() - start_time
+
+    # Score the best schedule with both cost functions
+    cost = conflicts = None
+    if len(schedules) > 0:
+      cost = CostFunction(participant_tutorials)(schedules[0])
+      conflicts = PairwiseCostFunction(participant_tutorials)(schedules[0])
+    if method == "exact":
+      curve.append((elapsed, num_iter, cost))
+    queue.put({
+      'time'        : elapsed,
+      'iterations'  : num_iter,
+      'cost'        : cost,
+      'conflicts'   : conflicts,
+      'proven'      : proven,
+      'peak_memory' : peak_memory(),
+      'curve'       : curve,
+    })
+  except Exception as e:
+    queue.put(e)
+    raise
+
+
+def run_optimizer(filename, method, max_time, seed=0):
+  '''
+  Run an optimizer in a child process so that the peak memory is its own
+
+  :param filename: The conference file
+  :param method: 'random', 'anneal' or 'exact'
+  :param max_time: The time budget in seconds
+  :param seed: The random seed
+  :returns: A dictionary with the time, iterations, cost and conflicts of the
+            best schedule, whether it is proven optimal (exact only), peak
+            memory in MB and the (time, iterations, cost) curve
+
+  '''
+  queue = multiprocessing.Queue()
+  process = multiprocessing.Process(
+    target=_run_optimizer, args=(queue, filename, method, max_time, seed))
+  process.start()
+  result = queue.get()
+  process.join()
+  if isinstance(result, Exception):
+    raise result
+  return result
+
+
+def run_benchmarks(scales, methods, max_time, directory, seed=0):
+  '''
+  Generate a conference at each scale and run each optimizer on it
+
+  :returns: The list of summary rows and the list of curve rows
+
+  '''
+  summary = []
+  curves = []
+  for scale in scales:
+    name = "conference_%d_%d_%d_%d_%d.txt" % scale
+    filename = os.path.join(directory, name)
+    if not os.path.exists(filename):
+      write_conference(filename, *scale, seed=seed)
+    for method in methods:
+      result = run_optimizer(filename, method, max_time, seed)
+      row = list(scale) + [
+        method,
+        max_time,
+        "%.3f" % result['time'],
+        result['iterations'],
+        "%.1f" % (result['iterations'] / max(result['time'], 1e-9)),
+        result['cost'],
+        result['conflicts'],
+        "" if result['proven'] is None else result['proven'],
+        "%.1f" % result['peak_memory'],
+      ]
+      summary.append(row)
+      print " ".join("%12s" % x for x in row)
+      sys.stdout.flush()
+      for elapsed, num_iter, cost in result['curve']:
+        curves.append(list(scale) + [method, "%.3f" % elapsed, num_iter, cost])
+  return summary, curves
+
+
+if __name__ == '__main__':
+  from argparse import ArgumentParser
+
+  parser = ArgumentParser(
+    description="Benchmark the timetable optimizers on synthetic conferences")
+  parser.add_argument("--scales", nargs="+", default=None,
+                      help="The conferences as nparticipants,mchoice,"
+                           "parallel,slots,votes")
+  parser.add_argument("--methods", nargs="+",
+                      default=["random", "anneal", "exact"],
+                      choices=["random", "anneal", "exact"],
+                      help="The optimizers to run")
+  parser.add_argument("--max_time", type=float, default=10,
+                      help="The time budget of each run in seconds")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="The random seed")
+  parser.add_argument("--directory", default=None,
+                      help="The directory for the conference files (default: "
+                           "a temporary directory)")
+  parser.add_argument("--summary", default="benchmark_summary.csv",
+                      help="The CSV file of results for each run")
+  parser.add_argument("--curves", default="benchmark_curves.csv",
+                      help="The CSV file of the best cost against time")
+  args = parser.parse_args()
+
+  scales = DEFAULT_SCALES
+  if args.scales is not None:
+    scales = [tuple(int(x) for x in scale.split(",")) for scale in args.scales]
+  directory = args.directory
+  if directory is None:
+    directory = tempfile.mkdtemp(prefix="timetable_benchmark_")
+
+  header = ["participants", "tutorials", "sessions", "slots", "votes"]
+  summary_header = header + [
+    "method", "max_time", "time", "iterations", "iterations_per_second",
+    "cost", "conflicts", "proven", "peak_memory_mb"]
+  print " ".join("%12s" % x[:12] for x in summary_header)
+  summary, curves = run_benchmarks(
+    scales, args.methods, args.max_time, directory, args.seed)
+
+  with open(args.summary, "wb") as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(summary_header)
+    writer.writerows(summary)
+  with open(args.curves, "wb") as outfile:
+    writer = csv.writer(outfile)
+    writer.writerow(header + ["method", "time", "iterations", "cost"])
+    writer.writerows(curves)
+  print ""
+  print "Wrote %s and %s" % (args.summary, args.curves)
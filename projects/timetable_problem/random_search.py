@@ -1,18 +1,204 @@
-from random import shuffle
+from random import shuffle, Random
+from math import exp
+import bisect
+import multiprocessing
+import Queue
+import sys
+import time
 import numpy as np
 from collections import defaultdict
 
 
+# The value used to pad the vote matrix where a participant has fewer votes
+NO_VOTE = -1
+
+
+class TutorialVotes(object):
+  '''
+  The tutorials chosen by each participant as a contiguous participant x vote
+  matrix padded with NO_VOTE, the number of votes for each tutorial and, for
+  files in the timetable.f90 format, the numbers in the header line.
+
+  '''
+
+  def __init__(self,
+               votes,
+               names=None,
+               n_tutorials=None,
+               n_sessions=None,
+               n_slots=None):
+    '''
+    :param votes: The participant x vote matrix
+    :param names: The name of each participant
+    :param n_tutorials: The number of tutorials (mchoice)
+    :param n_sessions: The number of parallel sessions (parallel)
+    :param n_slots: The number of slots (slots)
+
+    '''
+    self.votes = np.ascontiguousarray(votes, dtype=np.int64)
+    if self.votes.ndim != 2:
+      self.votes = self.votes.reshape(len(self.votes), -1)
+    self.names = names
+    self.n_tutorials = n_tutorials
+    self.n_sessions = n_sessions
+    self.n_slots = n_slots
+    valid = (self.votes != NO_VOTE) & (self.votes >= 0)
+    self.popularity = np.bincount(
+      self.votes[valid], minlength=(n_tutorials or 0)+1)
+
+  def __len__(self):
+    return len(self.votes)
+
+  def participant_tutorials(self):
+    '''
+    :returns: The list of tutorials chosen by each participant
+
+    '''
+    return [row[row != NO_VOTE].tolist() for row in self.votes]
+
+  def tutorial_index(self):
+    '''
+    :returns: The sorted list of tutorials with at least one vote
+
+    '''
+    return np.nonzero(self.popularity)[0].tolist()
+
+  def validate(self):
+    '''
+    Check all the votes at once for values out of range (less than 1 or
+    greater than the number of tutorials) and for participants voting for
+    the same tutorial more than once, as timetable.f90 does
+
+    :returns: The indices of the participants with invalid votes and of those
+              with duplicate votes
+
+    '''
+    valid = self.votes != NO_VOTE
+    invalid = valid & (self.votes < 1)
+    if self.n_tutorials is not None:
+      invalid |= valid & (self.votes > self.n_tutorials)
+    ordered = np.sort(self.votes, axis=1)
+    duplicate = (ordered[:,1:] == ordered[:,:-1]) & (ordered[:,1:] != NO_VOTE)
+    return (np.nonzero(invalid.any(axis=1))[0],
+            np.nonzero(duplicate.any(axis=1))[0])
+
+
+def read_votes(filename, check=True):
+  '''
+  Read the tutorials chosen by each participant.
+
+  Two formats are read. In the format of timetable_selection.txt each line is
+  a name followed by any number of votes, and lines which are not votes (such
+  as column headings) are skipped. In the format of timetable.f90 the first
+  line is "nparticipants mchoice parallel slots votes" followed by a line of a
+  name and exactly that number of votes for each participant. Anything after
+  a '!' is a comment.
+
+  :param filename: The file name
+  :param check: Print a warning for each participant with invalid or
+                duplicate votes
+  :returns: A TutorialVotes object
+
+  '''
+  with open(filename) as infile:
+    lines = [line.split("!")[0].split() for line in infile]
+  lines = [tokens for tokens in lines if len(tokens) > 0]
+
+  # The timetable.f90 header is a line of five numbers and no name
+  header = None
+  if len(lines) > 0 and len(lines[0]) == 5:
+    try:
+      header = [int(x) for x in lines[0]]
+      lines = lines[1:]
+    except ValueError:
+      pass
+
+  names = []
+  rows = []
+  for tokens in lines:
+    try:
+      rows.append([int(x) for x in tokens[1:]])
+    except ValueError:
+      continue
+    names.append(tokens[0])
+
+  if header is not None:
+    n_participants, n_tutorials, n_sessions, n_slots, n_votes = header
+    if len(rows) != n_participants:
+      print "%s: expected %d participants, read %d" % (
+        filename, n_participants, len(rows))
+  else:
+    n_tutorials = n_sessions = n_slots = None
+    n_votes = max([len(row) for row in rows] + [0])
+
+  # Pad the rows to the same number of votes
+  votes = np.full((len(rows), n_votes), NO_VOTE, dtype=np.int64)
+  lengths = np.array([len(row) for row in rows], dtype=np.int64)
+  if len(rows) > 0 and (lengths == n_votes).all():
+    votes[:] = rows
+  else:
+    for i, row in enumerate(rows):
+      votes[i,:len(row)] = row[:n_votes]
+  result = TutorialVotes(
+    votes,
+    names=names,
+    n_tutorials=n_tutorials,
+    n_sessions=n_sessions,
+    n_slots=n_slots)
+
+  if check:
+    invalid, duplicate = result.validate()
+    for i in invalid:
+      print "invalid", names[i], votes[i][votes[i] != NO_VOTE].tolist()
+    for i in duplicate:
+      print "duplicate", names[i], votes[i][votes[i] != NO_VOTE].tolist()
+  return result
+
+def vote_matrix(participant_tutorials):
+  '''
+  :param participant_tutorials: A TutorialVotes object, a participant x vote
+                                matrix or a list of the tutorials chosen by
+                                each participant
+  :returns: The participant x vote matrix padded with NO_VOTE
+
+  '''
+  if isinstance(participant_tutorials, TutorialVotes):
+    return participant_tutorials.votes
+  if isinstance(participant_tutorials, np.ndarray):
+    return participant_tutorials.reshape(len(participant_tutorials), -1)
+  rows = [list(participant) for participant in participant_tutorials]
+  votes = np.full(
+    (len(rows), max([len(row) for row in rows] + [0])), NO_VOTE,
+    dtype=np.int64)
+  for i, row in enumerate(rows):
+    votes[i,:len(row)] = row
+  return votes
+
 def read_tutorial_file(filename):
-  participant_tutorials = []
+  return read_votes(filename).participant_tutorials()
+
+def read_tutorial_list(filename):
+  '''
+  Read the length of each tutorial from a file in the format of
+  timetable_list.txt: a line of the tutorial number, the name of the tutor and
+  the length in minutes for each tutorial. Lines which are not tutorials (such
+  as column headings) are skipped.
+
+  :param filename: The file name
+  :returns: A dictionary of the length of each tutorial
+
+  '''
+  lengths = {}
   with open(filename) as infile:
-    for line in infile.readlines():
+    for line in infile:
+      tokens = line.split("!")[0].split()
+      if len(tokens) < 3:
+        continue
       try:
-        tutorials = map(int, line.split()[1:])
-      except Exception:
+        lengths[int(tokens[0])] = int(tokens[-1])
+      except ValueError:
         continue
-      participant_tutorials.append(tutorials)
-  return participant_tutorials
+  return lengths
 
 def tutorial_count(x):
   count = defaultdict(int)
@@ -35,18 +221,316 @@ def filter_tutorials(x, n):
   assert len(set(tutorial_index)) == len(tutorial_index)
   return result, tutorial_index
 
-def gen_random_schedule(indices, nslots, nsessions):
-  shuffle(indices)
+def gen_random_schedule(indices, nslots, nsessions, rng=None, constraints=None):
+  if constraints is not None and constraints.slot_lengths is not None:
+    return _gen_random_fitting_schedule(
+      indices, nslots, nsessions, rng or Random(), constraints)
+  if rng is None:
+    shuffle(indices)
+  else:
+    rng.shuffle(indices)
   indices = indices[:(nslots*nsessions)]
   indices = np.array(indices, np.int)
   indices = indices.reshape((nslots, nsessions))
   return indices 
 
+def _gen_random_fitting_schedule(indices, nslots, nsessions, rng, constraints):
+  '''
+  Generate a random schedule in which tutorials are only put in slots that
+  are long enough for them.
+
+  The tutorials are taken in a random order and each goes in the shortest
+  slot with a free session that fits it, so that the long slots are kept for
+  the long tutorials. Sessions that are still free at the end are filled with
+  the tutorials that did not fit anywhere.
+
+  '''
+  rng.shuffle(indices)
+  slot_lengths = constraints.slot_lengths.tolist()
+  free = [nsessions] * nslots
+  schedule = np.zeros((nslots, nsessions), np.int)
+  leftover = []
+  remaining = nslots * nsessions
+  for tutorial in indices:
+    if remaining == 0:
+      break
+    length = constraints.length(tutorial)
+    fits = [j for j in range(nslots) if free[j] > 0 and slot_lengths[j] >= length]
+    if len(fits) == 0:
+      leftover.append(tutorial)
+      continue
+    shortest = min(slot_lengths[j] for j in fits)
+    j = rng.choice([j for j in fits if slot_lengths[j] == shortest])
+    schedule[j, nsessions - free[j]] = tutorial
+    free[j] -= 1
+    remaining -= 1
+  for j in range(nslots):
+    while free[j] > 0:
+      schedule[j, nsessions - free[j]] = leftover.pop()
+      free[j] -= 1
+  return schedule
+
+def _gen_random_fitting_schedules(indices, nslots, nsessions, k, random_state,
+                                  constraints):
+  '''
+  Generate a stack of k random schedules in which tutorials are only put in
+  slots that are long enough for them, vectorized over the schedules.
+
+  In each schedule the tutorials are taken in a random order and each is
+  accepted if the accepted tutorials can still all be put in slots that fit
+  them: since a tutorial that fits a slot fits every longer slot, that is if
+  for each slot length there are no more accepted tutorials needing at least
+  that length than sessions in slots at least that long. The accepted
+  tutorials then go longest first in the sessions of the longest slots, with
+  ties broken at random, and the sessions that are still free are filled with
+  the tutorials that did not fit.
+
+  '''
+  indices = np.asarray(indices)
+  n = nslots * nsessions
+  slot_lengths = constraints.slot_lengths
+  levels = np.unique(slot_lengths)
+  capacity = nsessions * (slot_lengths[None,:] >= levels[:,None]).sum(axis=1)
+  length = np.array([constraints.length(t) for t in indices], dtype=np.int64)
+  need = np.searchsorted(levels, length)
+
+  # Accept the tutorials in a random order, one column at a time for all the
+  # schedules. count holds the accepted tutorials needing each level or more
+  order = np.argsort(random_state.rand(k, len(indices)), axis=1)
+  need = need[order]
+  count = np.zeros((k, len(levels)), dtype=np.int64)
+  accepted = np.zeros(order.shape, dtype=bool)
+  level = np.arange(len(levels))
+  for c in range(order.shape[1]):
+    needed = level[None,:] <= need[:,c,None]
+    accepted[:,c] = (need[:,c] < len(levels)) & (
+      (count < capacity) | ~needed).all(axis=1)
+    count += needed & accepted[:,c,None]
+
+  # The accepted tutorials longest first, then the others in random order,
+  # go in the sessions ordered from the longest slot to the shortest
+  ranked = np.lexsort(
+    (np.arange(order.shape[1])[None,:].repeat(k, axis=0),
+     -np.where(accepted, length[order], 0),
+     ~accepted), axis=1)[:,:n]
+  tutorials = indices[order[np.arange(k)[:,None], ranked]]
+  slot = np.repeat(np.arange(nslots), nsessions)
+  position = np.lexsort(
+    (random_state.rand(k, n), -np.broadcast_to(slot_lengths[slot], (k, n))),
+    axis=1)
+  schedules = np.zeros((k, n), np.int)
+  schedules[np.arange(k)[:,None], position] = tutorials
+  return schedules.reshape((k, nslots, nsessions))
+
+def gen_random_schedules(indices, nslots, nsessions, k, random_state=None,
+                         constraints=None):
+  '''
+  Generate a stack of k random schedules at once. With slot lengths in the
+  constraints, the tutorials are put in slots that fit them where possible.
+
+  :returns: The (k, nslots, nsessions) array of schedules
+
+  '''
+  if random_state is None:
+    random_state = np.random
+  if constraints is not None and constraints.slot_lengths is not None:
+    return _gen_random_fitting_schedules(
+      indices, nslots, nsessions, k, random_state, constraints)
+  indices = np.asarray(indices)
+  order = np.argsort(random_state.rand(k, len(indices)), axis=1)
+  order = order[:,:(nslots*nsessions)]
+  return indices[order].reshape((k, nslots, nsessions))
+
+
+class ScheduleConstraints(object):
+  '''
+  Penalties for tutorials that do not fit their slot or their room, added to
+  the cost of a schedule.
+
+  A tutorial longer than its slot costs duration_weight for each minute over.
+  The rooms are the parallel sessions; in each slot the most popular tutorial
+  goes in the biggest room and so on, and a tutorial with more votes (as
+  counted by tutorial_count) than the capacity of its room costs
+  capacity_weight for each participant over. Both penalties are sums over
+  the slots, so swapping two tutorials only changes the penalty of their
+  two slots.
+
+  '''
+
+  def __init__(self,
+               participant_tutorials,
+               n_slots,
+               n_sessions,
+               lengths=None,
+               slot_lengths=None,
+               capacities=None,
+               duration_weight=1,
+               capacity_weight=1):
+    '''
+    :param participant_tutorials: The list of tutorials chosen by each
+                                  participant, or the vote matrix
+    :param n_slots: The number of slots
+    :param n_sessions: The number of parallel sessions
+    :param lengths: A dictionary of the length of each tutorial in minutes;
+                    tutorials not in it have no length
+    :param slot_lengths: The length of each slot, or one length for all the
+                         slots, or None for no duration penalty
+    :param capacities: The capacity of the room of each parallel session, or
+                       one capacity for all the rooms, or None for no
+                       capacity penalty
+    :param duration_weight: The penalty for each minute over
+    :param capacity_weight: The penalty for each participant over
+
+    '''
+    votes = vote_matrix(participant_tutorials)
+    self._popularity = dict(
+      tutorial_count(row[row != NO_VOTE].tolist() for row in votes))
+    self._lengths = dict(lengths or {})
+    self.slot_lengths = None
+    if slot_lengths is not None:
+      self.slot_lengths = np.broadcast_to(
+        np.asarray(slot_lengths, dtype=np.int64), (n_slots,)).copy()
+    self.capacities = None
+    if capacities is not None:
+      self.capacities = np.sort(np.broadcast_to(
+        np.asarray(capacities, dtype=np.int64), (n_sessions,)))
+    self.duration_weight = duration_weight
+    self.capacity_weight = capacity_weight
+
+    # Lists for the scalar code path used on every swap
+    self._slot_lengths = (
+      None if self.slot_lengths is None else self.slot_lengths.tolist())
+    self._capacities = (
+      None if self.capacities is None else self.capacities.tolist())
+
+  def length(self, tutorial):
+    '''
+    :returns: The length of a tutorial
+
+    '''
+    return self._lengths.get(tutorial, 0)
+
+  def popularity(self, tutorial):
+    '''
+    :returns: The number of votes for a tutorial
+
+    '''
+    return self._popularity.get(tutorial, 0)
+
+  def duration_penalty(self, tutorial, slot):
+    '''
+    :returns: The duration penalty of a tutorial in a slot
+
+    '''
+    if self._slot_lengths is None:
+      return 0
+    overrun = self._lengths.get(tutorial, 0) - self._slot_lengths[slot]
+    if overrun > 0:
+      return self.duration_weight * overrun
+    return 0
+
+  def capacity_penalty(self, popularity):
+    '''
+    :param popularity: The number of votes for each tutorial in a slot in
+                       ascending order
+    :returns: The capacity penalty of the slot
+
+    '''
+    if self._capacities is None:
+      return 0
+    penalty = 0
+    for votes, capacity in zip(popularity, self._capacities):
+      if votes > capacity:
+        penalty += votes - capacity
+    return self.capacity_weight * penalty
+
+  def _lookup(self, values, schedules):
+    '''
+    Look up a value for each tutorial in an array of schedules; 0 for
+    tutorials without a value
+
+    '''
+    keys = np.array(list(values.keys()) + [0], dtype=np.int64)
+    table = np.zeros(max(keys.max(), schedules.max(), 0) + 1, dtype=np.int64)
+    table[keys[:-1]] = list(values.values())
+    return table[np.clip(schedules, 0, len(table)-1)]
+
+  def _zeros(self, schedules):
+    '''
+    :returns: 0 for a schedule, or an array of zeros for a stack of schedules
+
+    '''
+    if schedules.ndim == 2:
+      return 0
+    return np.zeros(len(schedules), dtype=np.int64)
+
+  def overruns(self, schedules):
+    '''
+    :param schedules: A schedule or a stack of schedules
+    :returns: The total minutes over the slot lengths of each schedule
+
+    '''
+    schedules = np.asarray(schedules)
+    if self.slot_lengths is None:
+      return self._zeros(schedules)
+    overrun = self._lookup(self._lengths, schedules) - self.slot_lengths[:,None]
+    return np.maximum(overrun, 0).sum(axis=(-2, -1))
+
+  def overflows(self, schedules):
+    '''
+    :param schedules: A schedule or a stack of schedules
+    :returns: The total participants over the room capacities of each
+              schedule
+
+    '''
+    schedules = np.asarray(schedules)
+    if self.capacities is None:
+      return self._zeros(schedules)
+    popularity = np.sort(self._lookup(self._popularity, schedules), axis=-1)
+    return np.maximum(popularity - self.capacities, 0).sum(axis=(-2, -1))
+
+  def penalty(self, schedules):
+    '''
+    :param schedules: A schedule or a stack of schedules
+    :returns: The penalty of each schedule
+
+    '''
+    return (self.duration_weight * self.overruns(schedules) +
+            self.capacity_weight * self.overflows(schedules))
+
+  def assign_rooms(self, schedule):
+    '''
+    :returns: A copy of the schedule with the tutorials in each slot ordered
+              by room, from the biggest room to the smallest
+
+    '''
+    schedule = np.asarray(schedule)
+    order = np.argsort(
+      -self._lookup(self._popularity, schedule), axis=1, kind='mergesort')
+    return schedule[np.arange(len(schedule))[:,None], order]
+
 
 class CostFunction(object):
 
-  def __init__(self, participant_tutorials):
-    self._participant_tutorials = participant_tutorials
+  def __init__(self, participant_tutorials, constraints=None):
+    votes = vote_matrix(participant_tutorials)
+    valid = votes != NO_VOTE
+    self._participant_tutorials = [row[row != NO_VOTE].tolist() for row in votes]
+
+    # A lookup table from tutorial to its number 0 to n-1; tutorials nobody
+    # chose go to n+1 so that scheduling them does not change the padding
+    self._tutorials = np.unique(votes[valid])
+    n = len(self._tutorials)
+    self._lookup = np.full(
+      max(self._tutorials.max() + 2 if n > 0 else 1, 1), n+1, dtype=np.int64)
+    self._lookup[self._tutorials] = np.arange(n)
+
+    # The participant x choice matrix of tutorial numbers, padded with n
+    # where a participant has fewer choices
+    self._choices = np.full(votes.shape, n, dtype=np.int64)
+    self._choices[valid] = self._lookup[votes[valid]]
+    self._length = valid.sum(axis=1)
+    self._constraints = constraints
 
   def __call__(self, schedule):
     session_slot_lookup = {}
@@ -63,8 +547,508 @@ class CostFunction(object):
           if slot is not None:
             slots.append(slot)
       cost += (len(set(slots)) - len(participant))**2
+    if self._constraints is not None:
+      cost += self._constraints.penalty(schedule)
+    return cost
+
+  # The number of participants whose choices are compared at a time in batch,
+  # so that the temporary arrays stay in the cache
+  participant_block = 256
+
+  def batch(self, schedules):
+    '''
+    Compute the cost of a stack of schedules in one vectorized pass
+
+    The slots are kept tutorial by schedule, so that gathering the slots of
+    the choices of a participant copies whole rows, and the participants are
+    taken a block at a time with the temporary arrays reused.
+
+    :param schedules: The (K, n_slots, n_sessions) array of schedules
+    :returns: The array of K costs
+
+    '''
+    schedules = np.asarray(schedules)
+    k, n_slots, n_sessions = schedules.shape
+
+    # Scatter the slot of each tutorial in each schedule; -1 if unscheduled
+    dtype = np.int16 if n_slots < 2**15 else np.int64
+    slot = np.full((len(self._tutorials)+2, k), -1, dtype=dtype)
+    tutorial = np.clip(schedules.reshape(k, -1), 0, len(self._lookup)-1)
+    slot[self._lookup[tutorial], np.arange(k)[:,None]] = np.repeat(
+      np.arange(n_slots, dtype=dtype), n_sessions)
+
+    # Count the choices each participant misses: those unscheduled or in the
+    # same slot as an earlier choice. The counts are squared in place, so
+    # they are kept in int32 rather than the smallest type that holds them
+    cost = np.zeros(k, dtype=np.int64)
+    length = self._length.astype(np.int32)
+    n_choices = self._choices.shape[1]
+    for p0 in range(0, len(length), self.participant_block):
+      choices = self._choices[p0:p0+self.participant_block]
+      slots = [slot[choices[:,j]] for j in range(n_choices)]
+      missed = np.repeat(length[p0:p0+len(choices),None], k, axis=1)
+      new = np.empty(missed.shape, dtype=bool)
+      other = np.empty(missed.shape, dtype=bool)
+      for j, slot_j in enumerate(slots):
+        np.greater_equal(slot_j, 0, out=new)
+        for slot_i in slots[:j]:
+          np.not_equal(slot_j, slot_i, out=other)
+          new &= other
+        missed -= new
+      missed *= missed
+      cost += missed.sum(axis=0, dtype=np.int64)
+    if self._constraints is not None:
+      cost = cost + self._constraints.penalty(schedules)
     return cost
 
+
+class IncrementalCostFunction(object):
+  '''
+  Compute the same cost as CostFunction for a schedule that is changed by
+  swapping two tutorials at a time.
+
+  An inverted index gives the participants who chose each tutorial, and the
+  number of tutorials each participant has in each slot is kept up to date,
+  so the cost change of a swap only depends on the audiences of the two
+  tutorials and not on the number of participants. For the penalty of
+  ScheduleConstraints the sorted popularities of the tutorials in each slot
+  are kept, so a swap only changes the penalties of two slots.
+
+  '''
+
+  def __init__(self,
+               participant_tutorials,
+               schedule,
+               tutorial_index=None,
+               constraints=None):
+    '''
+    :param participant_tutorials: The list of tutorials chosen by each
+                                  participant, or the vote matrix
+    :param schedule: The (n_slots, n_sessions) array of tutorials
+    :param tutorial_index: All the tutorials that can be scheduled. Those not
+                           in the schedule are unscheduled and can be swapped
+                           with a scheduled tutorial.
+    :param constraints: The ScheduleConstraints, or None for no penalty
+
+    '''
+    schedule = np.array(schedule)
+    self._n_slots = schedule.shape[0]
+    self._schedule = schedule
+
+    # The slot of each tutorial; -1 for unscheduled tutorials, which are
+    # counted in the last column of the occupancy counts
+    self._slot = {}
+    self._position = {}
+    if tutorial_index is not None:
+      for tutorial in tutorial_index:
+        self._slot[tutorial] = -1
+    for j in range(schedule.shape[0]):
+      for i in range(schedule.shape[1]):
+        self._slot[schedule[j,i]] = j
+        self._position[schedule[j,i]] = (j, i)
+
+    # The participants who chose each tutorial and how many times they did
+    votes = vote_matrix(participant_tutorials)
+    n_participants = len(votes)
+    participant, choice = np.nonzero(votes != NO_VOTE)
+    key, multiplicity = np.unique(
+      votes[participant, choice] * n_participants + participant,
+      return_counts=True)
+    tutorials, start = np.unique(key // n_participants, return_index=True)
+    end = np.append(start[1:], len(key))
+    self._audience = {}
+    for tutorial, i0, i1 in zip(tutorials.tolist(), start, end):
+      self._audience[tutorial] = (
+        key[i0:i1] % n_participants, multiplicity[i0:i1])
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    for tutorial in self._slot:
+      self._audience.setdefault(tutorial, empty)
+
+    # The number of tutorials each participant has in each slot
+    self._count = np.zeros(
+      (n_participants, self._n_slots+1), dtype=np.int64)
+    for tutorial, (ids, multiplicity) in self._audience.iteritems():
+      self._count[ids, self._slot.get(tutorial, -1)] += multiplicity
+    self._length = self._count.sum(axis=1)
+    self._missed = self._length - (self._count[:,:-1] > 0).sum(axis=1)
+    self._cost = int((self._missed**2).sum())
+
+    # The sorted popularities and the capacity penalty of each slot
+    self._constraints = constraints
+    if constraints is not None:
+      self._popularity = [
+        sorted(constraints.popularity(t) for t in row)
+        for row in self._schedule.tolist()]
+      self._capacity_penalty = [
+        constraints.capacity_penalty(p) for p in self._popularity]
+      self._cost += sum(self._capacity_penalty)
+      for j, row in enumerate(self._schedule.tolist()):
+        for t in row:
+          self._cost += constraints.duration_penalty(t, j)
+
+  def cost(self):
+    '''
+    :returns: The cost of the current schedule
+
+    '''
+    return self._cost
+
+  def schedule(self):
+    '''
+    :returns: A copy of the current schedule
+
+    '''
+    return self._schedule.copy()
+
+  def slot(self, tutorial):
+    '''
+    :returns: The slot of a tutorial or -1 if it is not scheduled
+
+    '''
+    return self._slot[tutorial]
+
+  def _change(self, t1, t2):
+    '''
+    Compute the participants affected by swapping two tutorials, the net
+    number of their tutorials moved from the slot of t1 to the slot of t2
+    and the change in the number of tutorials they miss
+
+    '''
+    s1, s2 = self._slot[t1], self._slot[t2]
+    ids1, multiplicity1 = self._audience[t1]
+    ids2, multiplicity2 = self._audience[t2]
+    ids, inverse = np.unique(
+      np.concatenate((ids1, ids2)), return_inverse=True)
+    moved = np.bincount(
+      inverse,
+      weights=np.concatenate((multiplicity1, -multiplicity2)),
+      minlength=len(ids)).astype(np.int64)
+    selection = moved != 0
+    ids, moved = ids[selection], moved[selection]
+    c1 = self._count[ids, s1]
+    c2 = self._count[ids, s2]
+    missed = np.zeros(len(ids), dtype=np.int64)
+    if s1 >= 0:
+      missed += (c1 > 0).astype(np.int64) - (c1 - moved > 0)
+    if s2 >= 0:
+      missed += (c2 > 0).astype(np.int64) - (c2 + moved > 0)
+    return ids, moved, missed
+
+  def _penalty_change(self, t1, t2):
+    '''
+    Compute the change in penalty of swapping two tutorials
+
+    :returns: The change in penalty and a list of (slot, sorted popularities,
+              capacity penalty) for the slots whose capacity penalty changes
+
+    '''
+    constraints = self._constraints
+    change = 0
+    slots = []
+    p1, p2 = constraints.popularity(t1), constraints.popularity(t2)
+    for t, other, old, new in ((t1, t2, p1, p2), (t2, t1, p2, p1)):
+      j = self._slot[t]
+      if j < 0:
+        continue
+      change += (constraints.duration_penalty(other, j) -
+                 constraints.duration_penalty(t, j))
+      if old != new:
+        popularity = list(self._popularity[j])
+        popularity.remove(old)
+        bisect.insort(popularity, new)
+        penalty = constraints.capacity_penalty(popularity)
+        change += penalty - self._capacity_penalty[j]
+        slots.append((j, popularity, penalty))
+    return change, slots
+
+  def delta(self, t1, t2):
+    '''
+    :returns: The change in cost if two tutorials are swapped
+
+    '''
+    if self._slot[t1] == self._slot[t2]:
+      return 0
+    ids, moved, missed = self._change(t1, t2)
+    old = self._missed[ids]
+    delta = int(((old + missed)**2 - old**2).sum())
+    if self._constraints is not None:
+      delta += self._penalty_change(t1, t2)[0]
+    return delta
+
+  def swap(self, t1, t2):
+    '''
+    Swap two tutorials
+
+    :returns: The cost of the new schedule
+
+    '''
+    s1, s2 = self._slot[t1], self._slot[t2]
+    if s1 == s2:
+      return self._cost
+    ids, moved, missed = self._change(t1, t2)
+    old = self._missed[ids]
+    self._cost += int(((old + missed)**2 - old**2).sum())
+    if self._constraints is not None:
+      change, slots = self._penalty_change(t1, t2)
+      self._cost += change
+      for j, popularity, penalty in slots:
+        self._popularity[j] = popularity
+        self._capacity_penalty[j] = penalty
+    self._missed[ids] += missed
+    self._count[ids, s1] -= moved
+    self._count[ids, s2] += moved
+    self._slot[t1], self._slot[t2] = s2, s1
+    p1, p2 = self._position.pop(t1, None), self._position.pop(t2, None)
+    if p2 is not None:
+      self._schedule[p2] = t1
+      self._position[t1] = p2
+    if p1 is not None:
+      self._schedule[p1] = t2
+      self._position[t2] = p1
+    return self._cost
+
+
+def count_conflicts(participant_tutorials, schedule):
+  '''
+  Count the conflicts in a schedule as countconflicts in timetable.f90 does:
+  one for each vote for an unscheduled tutorial plus one for each pair of
+  votes of a participant for tutorials in the same slot
+
+  '''
+  votes = vote_matrix(participant_tutorials)
+  schedule = np.asarray(schedule)
+  slot = np.full(max(votes.max(), schedule.max()) + 2, -1, dtype=np.int64)
+  slot[schedule] = np.arange(schedule.shape[0])[:,None]
+  slots = np.where(votes != NO_VOTE, slot[votes], NO_VOTE)
+  conflicts = ((votes != NO_VOTE) & (slots == -1)).sum()
+  for j in range(votes.shape[1]):
+    for k in range(j+1, votes.shape[1]):
+      conflicts += ((slots[:,j] >= 0) & (slots[:,j] == slots[:,k])).sum()
+  return int(conflicts)
+
+def covote_matrix(participant_tutorials, tutorials):
+  '''
+  Compute the number of participants who voted for each pair of tutorials
+
+  :param participant_tutorials: The votes of each participant
+  :param tutorials: The list of tutorials
+  :returns: The tutorial x tutorial matrix of the number of pairs of votes for
+            both tutorials (on the diagonal, the number of duplicate pairs of
+            votes for the same tutorial) and the number of votes for each
+            tutorial
+
+  '''
+  votes = vote_matrix(participant_tutorials)
+  tutorials = np.asarray(tutorials, dtype=np.int64)
+  lookup = np.full(
+    max(votes.max(), tutorials.max()) + 2, -1, dtype=np.int64)
+  lookup[tutorials] = np.arange(len(tutorials))
+  index = np.where(votes != NO_VOTE, lookup[votes], -1)
+  n = len(tutorials)
+
+  # Count each pair of votes of each participant
+  covotes = np.zeros(n * n, dtype=np.int64)
+  for j in range(index.shape[1]):
+    for k in range(j+1, index.shape[1]):
+      selection = (index[:,j] >= 0) & (index[:,k] >= 0)
+      a, b = index[selection,j], index[selection,k]
+      covotes += np.bincount(a * n + b, minlength=n * n)
+      covotes += np.bincount((b * n + a)[a != b], minlength=n * n)
+  popularity = np.bincount(index[index >= 0], minlength=n)
+  return covotes.reshape(n, n), popularity
+
+
+class PairwiseCostFunction(object):
+  '''
+  Count the conflicts in a schedule as count_conflicts does, from the co-vote
+  matrix rather than the votes.
+
+  The conflicts are the votes for the unscheduled tutorials plus, for each
+  slot, the co-votes of each pair of tutorials in the slot, so the time taken
+  does not depend on the number of participants. The matrix is stored with
+  the smallest integer type that holds the counts.
+
+  '''
+
+  def __init__(self, participant_tutorials, tutorial_index=None):
+    '''
+    :param participant_tutorials: The votes of each participant
+    :param tutorial_index: The tutorials that can be scheduled; by default
+                           every tutorial with a vote. Votes for any other
+                           tutorial are always conflicts.
+
+    '''
+    votes = vote_matrix(participant_tutorials)
+    if tutorial_index is None:
+      tutorial_index = np.unique(votes[votes != NO_VOTE])
+    self._tutorials = np.array(tutorial_index, dtype=np.int64)
+    covotes, popularity = covote_matrix(votes, self._tutorials)
+    self._total = int((votes != NO_VOTE).sum())
+
+    # Add a row of zeros for tutorials which are not in the index and look up
+    # the row of each tutorial
+    n = len(self._tutorials)
+    dtype = np.int32 if covotes.max() < 2**31 else np.int64
+    self._covotes = np.zeros((n+1, n+1), dtype=dtype)
+    self._covotes[:n,:n] = covotes
+    self._self_covotes = np.append(np.diag(covotes), 0)
+    np.fill_diagonal(self._covotes, 0)
+    self._popularity = np.append(popularity, 0)
+    self._lookup = np.full(
+      max(self._tutorials.max() + 2 if n > 0 else 1, 1), n, dtype=np.int64)
+    self._lookup[self._tutorials] = np.arange(n)
+
+  def __call__(self, schedule):
+    '''
+    :param schedule: The (n_slots, n_sessions) array of tutorials
+    :returns: The number of conflicts
+
+    '''
+    return int(self.batch(np.asarray(schedule)[None,:,:])[0])
+
+  def batch(self, schedules):
+    '''
+    :param schedules: The (K, n_slots, n_sessions) array of schedules
+    :returns: The array of K numbers of conflicts
+
+    '''
+    schedules = np.asarray(schedules)
+    k = len(schedules)
+    index = self._lookup[np.clip(schedules, 0, len(self._lookup)-1)]
+    pairs = self._covotes[index[:,:,:,None], index[:,:,None,:]]
+    pairs = pairs.reshape(k, -1).sum(axis=1) // 2
+    scheduled = self._popularity[index].reshape(k, -1).sum(axis=1)
+    duplicates = self._self_covotes[index].reshape(k, -1).sum(axis=1)
+    return self._total - scheduled + pairs + duplicates
+
+
+class _Timeout(Exception):
+  pass
+
+def branch_and_bound(participant_tutorials,
+                     n_slots,
+                     n_sessions,
+                     tutorial_index=None,
+                     upper_bound=None,
+                     max_time=None):
+  '''
+  Find a schedule with the fewest conflicts, as counted by count_conflicts,
+  and prove that it is optimal by branch and bound.
+
+  The tutorials are assigned to a slot or left unscheduled one at a time, most
+  popular first. Empty slots are interchangeable, so a tutorial only goes in
+  the first empty one, and each slot is a set, which gives the same canonical
+  form as sort_schedule. A branch is pruned if its cost plus a lower bound for
+  the remaining tutorials is no better than the best schedule so far. The
+  bound is the cheapest place for each remaining tutorial given the tutorials
+  already in each slot, from the co-vote matrix, where the right number of
+  them must be left unscheduled at the cost of their votes.
+
+  :param participant_tutorials: The votes of each participant
+  :param n_slots: The number of slots
+  :param n_sessions: The number of parallel sessions
+  :param tutorial_index: The tutorials to schedule; by default every
+                         tutorial with a vote
+  :param upper_bound: Only look for schedules with fewer conflicts than this
+  :param max_time: The maximum time in seconds
+  :returns: The minimum number of conflicts, a schedule with that many, True
+            if it is proven optimal (False if the time ran out) and the number
+            of nodes searched. The schedule is None if none was found.
+
+  '''
+  votes = vote_matrix(participant_tutorials)
+  if tutorial_index is None:
+    tutorial_index = np.unique(votes[votes != NO_VOTE])
+  tutorials = np.array(tutorial_index, dtype=np.int64)
+  n_tutorials = len(tutorials)
+  if n_tutorials < n_slots * n_sessions:
+    raise ValueError("Not enough tutorials to fill %d slots of %d sessions" % (
+      n_slots, n_sessions))
+  covotes, popularity = covote_matrix(votes, tutorials)
+
+  # Votes for tutorials which cannot be scheduled are always conflicts
+  constant = int((votes != NO_VOTE).sum() - popularity.sum())
+
+  # Assign the most popular tutorials first
+  order = np.argsort(-popularity, kind='mergesort')
+  tutorials = tutorials[order]
+  popularity = popularity[order]
+  covotes = covotes[order][:,order]
+  self_cost = np.diag(covotes).copy()
+  np.fill_diagonal(covotes, 0)
+
+  # The cost of adding each tutorial to each slot, and the slot contents
+  marginal = np.zeros((n_tutorials, n_slots), dtype=np.int64)
+  slots = [[] for s in range(n_slots)]
+  state = {
+    'cost'     : float("inf") if upper_bound is None else upper_bound - constant,
+    'schedule' : None,
+    'nodes'    : 0,
+  }
+  start_time = time.time()
+
+  def lower_bound(k, n_unscheduled):
+    open_slots = [s for s in range(n_slots) if len(slots[s]) < n_sessions]
+    if len(open_slots) == 0:
+      return popularity[k:].sum()
+    scheduled = marginal[k:][:,open_slots].min(axis=1) + self_cost[k:]
+    difference = popularity[k:] - scheduled
+    if n_unscheduled > 0:
+      difference = np.partition(difference, n_unscheduled-1)[:n_unscheduled]
+      return scheduled.sum() + difference.sum()
+    return scheduled.sum()
+
+  def search(k, cost, n_unscheduled):
+    state['nodes'] += 1
+    if max_time is not None and time.time() - start_time > max_time:
+      raise _Timeout()
+    if k == n_tutorials:
+      state['cost'] = cost
+      state['schedule'] = [list(tutorials[slot]) for slot in slots]
+      return
+    if cost + lower_bound(k, n_unscheduled) >= state['cost']:
+      return
+
+    # Try the slots with space, only the first of the empty slots, and leaving
+    # the tutorial unscheduled, cheapest first
+    options = []
+    empty = False
+    for s in range(n_slots):
+      if len(slots[s]) == n_sessions or (len(slots[s]) == 0 and empty):
+        continue
+      empty = empty or len(slots[s]) == 0
+      options.append((marginal[k,s] + self_cost[k], s))
+    if n_unscheduled > 0:
+      options.append((popularity[k], None))
+    options.sort()
+    for delta, s in options:
+      if cost + delta >= state['cost']:
+        break
+      if s is None:
+        search(k+1, cost + delta, n_unscheduled-1)
+      else:
+        slots[s].append(k)
+        marginal[:,s] += covotes[:,k]
+        search(k+1, cost + delta, n_unscheduled)
+        marginal[:,s] -= covotes[:,k]
+        slots[s].pop()
+
+  proven = True
+  recursion_limit = sys.getrecursionlimit()
+  sys.setrecursionlimit(max(recursion_limit, n_tutorials + 100))
+  try:
+    search(0, 0, n_tutorials - n_slots * n_sessions)
+  except _Timeout:
+    proven = False
+  finally:
+    sys.setrecursionlimit(recursion_limit)
+  schedule = state['schedule']
+  if schedule is None:
+    return None, None, proven, state['nodes']
+  schedule = sort_schedule(np.array(schedule, dtype=np.int64))
+  return int(state['cost']) + constant, schedule, proven, state['nodes']
+
+
 def sort_schedule(schedule):
   schedule.sort(axis=1)
   v = [schedule[j,0] for j in range(schedule.shape[0])]
@@ -76,39 +1060,499 @@ def sort_schedule(schedule):
       result[j,i] = schedule[k,i] 
   return result
 
+def schedule_key(schedule, sort_slots=True):
+  '''
+  :param sort_slots: Sort the slots as well as the tutorials in each slot;
+                     False when the slots are not interchangeable because
+                     they have different lengths
+  :returns: A hashable key which is the same for equivalent schedules; the
+            rows of the schedule as sorted by sort_schedule
+
+  '''
+  schedule = np.sort(schedule, axis=1)
+  if sort_slots:
+    schedule = schedule[np.argsort(schedule[:,0], kind='mergesort')]
+  return tuple(map(tuple, schedule.tolist()))
+
+def _sort_slots(constraints):
+  '''
+  :returns: True if the slots of a schedule are interchangeable
+
+  '''
+  return constraints is None or constraints.slot_lengths is None
+
+def local_search(participant_tutorials,
+                 tutorial_index,
+                 n_slots,
+                 n_sessions,
+                 t_start=1.0,
+                 t_end=0.01,
+                 iterations_per_restart=100000,
+                 max_restarts=None,
+                 max_iterations=None,
+                 max_time=None,
+                 max_schedules=1000,
+                 seed=None,
+                 stop=None,
+                 progress=None,
+                 constraints=None):
+  '''
+  Search for the best schedules by simulated annealing with swap moves.
+
+  Each restart begins from a random schedule. Two tutorials in different
+  slots (or one scheduled and one not) are swapped and the swap is kept if the
+  cost does not increase, as in timetable.f90, or otherwise with probability
+  exp(-delta / T). The temperature falls geometrically from t_start to t_end
+  over each restart; t_start=0 gives the hill climb with sideways moves of
+  timetable.f90.
+
+  :param participant_tutorials: The list of tutorials chosen by each
+                                participant
+  :param tutorial_index: The tutorials that can be scheduled
+  :param n_slots: The number of slots
+  :param n_sessions: The number of parallel sessions
+  :param t_start: The temperature at the start of each restart
+  :param t_end: The temperature at the end of each restart
+  :param iterations_per_restart: The number of swaps tried in each restart
+  :param max_restarts: The maximum number of restarts
+  :param max_iterations: The maximum total number of swaps tried
+  :param max_time: The maximum time in seconds
+  :param max_schedules: The maximum number of best schedules to keep
+  :param seed: The random seed
+  :param stop: A function checked every 1000 swaps which returns True to
+               stop the search
+  :param progress: A function called every 1000 swaps with the number of
+                   swaps tried, the minimum cost and the set of best schedules
+  :param constraints: The ScheduleConstraints whose penalty is added to the
+                      cost, or None
+  :returns: The minimum cost, the list of distinct schedules with that cost
+            (sorted with schedule_key) and the number of swaps tried
+
+  '''
+  if max_restarts is None and max_iterations is None and max_time is None:
+    max_restarts = 1
+  rng = Random(seed)
+  tutorial_index = list(tutorial_index)
+  sort_slots = _sort_slots(constraints)
+  start_time = time.time()
+  if t_start > 0:
+    cooling = (t_end / t_start)**(1.0 / max(1, iterations_per_restart))
+  min_cost = None
+  best_schedules = set()
+  num_iter = 0
+  num_restarts = 0
+  finished = False
+  while not finished:
+    if max_restarts is not None and num_restarts >= max_restarts:
+      break
+    num_restarts += 1
+    schedule = gen_random_schedule(
+      tutorial_index, n_slots, n_sessions, rng, constraints)
+    compute_cost = IncrementalCostFunction(
+      participant_tutorials, schedule, tutorial_index, constraints)
+    cost = compute_cost.cost()
+    temperature = t_start
+    for k in range(iterations_per_restart + 1):
+
+      # Keep the schedule if it is as good as the best so far
+      if k == 0 or accepted:
+        if min_cost is None or cost < min_cost:
+          min_cost = cost
+          best_schedules = set()
+        if cost == min_cost and len(best_schedules) < max_schedules:
+          best_schedules.add(
+            schedule_key(compute_cost.schedule(), sort_slots))
+      if k == iterations_per_restart:
+        break
+
+      # Stop when the budget is used up
+      if max_iterations is not None and num_iter >= max_iterations:
+        finished = True
+        break
+      if k % 1000 == 0:
+        if progress is not None:
+          progress(num_iter, min_cost, best_schedules)
+        if ((stop is not None and stop()) or
+            (max_time is not None and time.time() - start_time > max_time)):
+          finished = True
+          break
+
+      # Swap two random tutorials in different slots. Keep the swap if the
+      # cost does not increase or with the Metropolis probability otherwise
+      num_iter += 1
+      if t_start > 0:
+        temperature *= cooling
+      accepted = False
+      t1, t2 = rng.sample(tutorial_index, 2)
+      if compute_cost.slot(t1) == compute_cost.slot(t2):
+        continue
+      delta = compute_cost.delta(t1, t2)
+      if delta > 0:
+        if temperature <= 0 or rng.random() >= exp(-delta / temperature):
+          continue
+      cost = compute_cost.swap(t1, t2)
+      accepted = True
+  if progress is not None:
+    progress(num_iter, min_cost, best_schedules)
+  best_schedules = [np.array(s) for s in sorted(best_schedules)]
+  return min_cost, best_schedules, num_iter
+
+def random_sampling(participant_tutorials,
+                    tutorial_index,
+                    n_slots,
+                    n_sessions,
+                    block_size=1000,
+                    max_iterations=None,
+                    max_time=None,
+                    max_schedules=1000,
+                    seed=None,
+                    stop=None,
+                    progress=None,
+                    constraints=None):
+  '''
+  Search for the best schedules by scoring blocks of random schedules with
+  CostFunction.batch.
+
+  The parameters and the result are the same as for local_search, except that
+  stop and progress are called after each block of block_size schedules.
+
+  '''
+  if max_iterations is None and max_time is None:
+    max_iterations = 1000000
+  compute_cost = CostFunction(participant_tutorials, constraints)
+  random_state = np.random.RandomState(seed)
+  sort_slots = _sort_slots(constraints)
+  start_time = time.time()
+  min_cost = None
+  best_schedules = set()
+  num_iter = 0
+  while max_iterations is None or num_iter < max_iterations:
+    k = block_size
+    if max_iterations is not None:
+      k = min(k, max_iterations - num_iter)
+    schedules = gen_random_schedules(
+      tutorial_index, n_slots, n_sessions, k, random_state, constraints)
+    cost = compute_cost.batch(schedules)
+    num_iter += k
+    if min_cost is None or cost.min() < min_cost:
+      min_cost = cost.min().item()
+      best_schedules = set()
+    for schedule in schedules[cost == min_cost]:
+      if len(best_schedules) >= max_schedules:
+        break
+      best_schedules.add(schedule_key(schedule, sort_slots))
+    if progress is not None:
+      progress(num_iter, min_cost, best_schedules)
+    if ((stop is not None and stop()) or
+        (max_time is not None and time.time() - start_time > max_time)):
+      break
+  best_schedules = [np.array(s) for s in sorted(best_schedules)]
+  return min_cost, best_schedules, num_iter
+
+
+class ProgressReport(object):
+  '''
+  Print the progress of a search at most once per interval rather than on
+  every iteration
+
+  '''
+
+  def __init__(self, interval=1.0, stream=None):
+    self._interval = interval
+    self._stream = stream if stream is not None else sys.stdout
+    self._start_time = time.time()
+    self._last_time = None
+
+  def __call__(self, num_iter, min_cost, best_schedules, force=False):
+    now = time.time()
+    if (not force and self._last_time is not None and
+        now - self._last_time < self._interval):
+      return
+    self._last_time = now
+    elapsed = now - self._start_time
+    self._stream.write(
+      "%8.1f s %12d iterations %10.0f / s  cost: %s  schedules: %d\n" % (
+        elapsed, num_iter, num_iter / max(elapsed, 1e-9), min_cost,
+        len(best_schedules)))
+    self._stream.flush()
+
+def _search_worker(queue, stop, best_cost, worker, method, args, kwargs,
+                   publish_interval):
+  '''
+  Run a search in a worker process, publishing the best cost and schedules to
+  the coordinator at most once per interval and stopping when the stop event
+  is set. Finding a schedule with zero cost sets the stop event.
+
+  '''
+  state = {'time' : None, 'sent' : None}
+
+  def publish(num_iter, min_cost, best_schedules, done=False):
+    now = time.time()
+    if (not done and min_cost != 0 and state['time'] is not None and
+        now - state['time'] < publish_interval):
+      return
+    state['time'] = now
+
+    # Only send the schedules if they could be among the best overall
+    schedules = None
+    if min_cost is not None and min_cost <= best_cost.value:
+      if state['sent'] != (min_cost, len(best_schedules)):
+        schedules = list(best_schedules)
+        state['sent'] = (min_cost, len(best_schedules))
+      with best_cost.get_lock():
+        if min_cost < best_cost.value:
+          best_cost.value = min_cost
+    queue.put((worker, done, num_iter, min_cost, schedules))
+    if min_cost == 0:
+      stop.set()
+
+  search = local_search if method == "anneal" else random_sampling
+  sort_slots = _sort_slots(kwargs.get('constraints'))
+  try:
+    min_cost, best_schedules, num_iter = search(
+      *args, stop=stop.is_set, progress=publish, **kwargs)
+    publish(num_iter, min_cost,
+            set(schedule_key(s, sort_slots) for s in best_schedules),
+            done=True)
+  except KeyboardInterrupt:
+    queue.put((worker, True, 0, None, None))
+
+def parallel_search(participant_tutorials,
+                    tutorial_index,
+                    n_slots,
+                    n_sessions,
+                    method="anneal",
+                    nproc=None,
+                    seed=None,
+                    max_time=None,
+                    max_schedules=1000,
+                    publish_interval=0.5,
+                    report_interval=1.0,
+                    **kwargs):
+  '''
+  Run independent searches with different seeds in several processes.
+
+  The workers publish their best cost and schedules to this process, which
+  keeps the best overall. All the workers stop when one of them finds a
+  schedule with zero cost or when the time runs out.
+
+  :param method: 'anneal' for local_search or 'random' for random_sampling
+  :param nproc: The number of processes; by default the number of CPUs
+  :param seed: The random seed of the first worker; the others use seed+1,
+               seed+2, ...
+  :param max_time: The maximum time in seconds
+  :param max_schedules: The maximum number of best schedules to keep
+  :param publish_interval: The time between updates from each worker
+  :param report_interval: The time between progress reports, or None for no
+                          progress reports
+  :param kwargs: The other parameters of local_search or random_sampling,
+                 which apply to each worker
+  :returns: The minimum cost, the list of distinct schedules with that cost
+            and the total number of iterations
+
+  '''
+  if nproc is None:
+    nproc = multiprocessing.cpu_count()
+  if seed is None:
+    seed = Random().randrange(2**30)
+  queue = multiprocessing.Queue()
+  stop = multiprocessing.Event()
+  best_cost = multiprocessing.Value('d', float("inf"))
+  args = (participant_tutorials, tutorial_index, n_slots, n_sessions)
+  kwargs = dict(kwargs, max_time=max_time, max_schedules=max_schedules)
+  workers = []
+  for worker in range(nproc):
+    workers.append(multiprocessing.Process(
+      target=_search_worker,
+      args=(queue, stop, best_cost, worker, method, args,
+            dict(kwargs, seed=seed+worker), publish_interval)))
+  for process in workers:
+    process.start()
+
+  report = None
+  if report_interval is not None:
+    report = ProgressReport(report_interval)
+  start_time = time.time()
+  min_cost = None
+  best_schedules = set()
+  num_iter = [0] * nproc
+  running = nproc
+  try:
+    while running > 0:
+      try:
+        worker, done, n, cost, schedules = queue.get(timeout=0.1)
+      except Queue.Empty:
+        if not any(process.is_alive() for process in workers):
+          break
+      else:
+        num_iter[worker] = max(num_iter[worker], n)
+        running -= done
+        if schedules is not None:
+          if min_cost is None or cost < min_cost:
+            min_cost = cost
+            best_schedules = set()
+          if cost == min_cost:
+            for schedule in schedules:
+              if len(best_schedules) >= max_schedules:
+                break
+              best_schedules.add(schedule)
+      if max_time is not None and time.time() - start_time > max_time:
+        stop.set()
+      if report is not None:
+        report(sum(num_iter), min_cost, best_schedules)
+  finally:
+    stop.set()
+    while any(process.is_alive() for process in workers):
+      try:
+        queue.get(timeout=0.1)
+      except Queue.Empty:
+        pass
+    for process in workers:
+      process.join()
+  if report is not None:
+    report(sum(num_iter), min_cost, best_schedules, force=True)
+  best_schedules = [np.array(s) for s in sorted(best_schedules)]
+  return min_cost, best_schedules, sum(num_iter)
+
 if __name__ == '__main__':
+  from argparse import ArgumentParser
+
+  parser = ArgumentParser(description="Search for the best timetable")
+  parser.add_argument("filename", nargs="?",
+                      default="data/timetable_selection.txt",
+                      help="The file of tutorials chosen by each participant")
+  parser.add_argument("--slots", type=int, default=None,
+                      help="The number of slots (default: from the file "
+                           "header or 5)")
+  parser.add_argument("--sessions", type=int, default=None,
+                      help="The number of parallel sessions (default: from "
+                           "the file header or 3)")
+  parser.add_argument("--method", default="random",
+                      choices=["random", "anneal", "exact"],
+                      help="Random sampling, simulated annealing or an "
+                           "exact branch and bound for the timetable.f90 "
+                           "conflict count")
+  parser.add_argument("--max_iterations", type=int, default=None,
+                      help="The maximum number of iterations")
+  parser.add_argument("--max_time", type=float, default=None,
+                      help="The maximum time in seconds")
+  parser.add_argument("--restarts", type=int, default=None,
+                      help="The number of annealing restarts")
+  parser.add_argument("--iterations_per_restart", type=int, default=100000,
+                      help="The number of swaps tried in each restart")
+  parser.add_argument("--t_start", type=float, default=1.0,
+                      help="The annealing start temperature; 0 for a hill "
+                           "climb with sideways moves")
+  parser.add_argument("--t_end", type=float, default=0.01,
+                      help="The annealing end temperature")
+  parser.add_argument("--seed", type=int, default=None,
+                      help="The random seed")
+  parser.add_argument("--block_size", type=int, default=1000,
+                      help="The number of random schedules generated and "
+                           "scored at once")
+  parser.add_argument("--nproc", type=int, default=1,
+                      help="The number of processes running independent "
+                           "searches")
+  parser.add_argument("--report_interval", type=float, default=1.0,
+                      help="The time in seconds between progress reports")
+  parser.add_argument("--tutorial_list", default=None,
+                      help="The file of the length of each tutorial, such "
+                           "as data/timetable_list.txt")
+  parser.add_argument("--slot_lengths", type=int, nargs="+", default=None,
+                      help="The length of each slot in minutes, or one "
+                           "length for all the slots")
+  parser.add_argument("--capacities", type=int, nargs="+", default=None,
+                      help="The capacity of the room of each parallel "
+                           "session, or one capacity for all the rooms")
+  parser.add_argument("--duration_weight", type=float, default=1,
+                      help="The penalty for each minute a tutorial is "
+                           "longer than its slot")
+  parser.add_argument("--capacity_weight", type=float, default=1,
+                      help="The penalty for each participant over the "
+                           "capacity of a room")
+  args = parser.parse_args()
+
+  votes = read_votes(args.filename)
+  n_sessions = args.sessions or votes.n_sessions or 3
+  n_slots = args.slots or votes.n_slots or 5
   
-  n_tutorials = 15
-  n_sessions = 3
-  n_slots = 5
-  
-  participant_tutorials = read_tutorial_file("data/timetable_selection.txt")
+  participant_tutorials = votes.participant_tutorials()
   participant_tutorials, tutorial_index = filter_tutorials(participant_tutorials, 15)
   n_participants = len(participant_tutorials)
 
-  compute_cost = CostFunction(participant_tutorials)
+  constraints = None
+  if args.slot_lengths is not None or args.capacities is not None:
+    lengths = None
+    if args.tutorial_list is not None:
+      lengths = read_tutorial_list(args.tutorial_list)
+    constraints = ScheduleConstraints(
+      participant_tutorials,
+      n_slots,
+      n_sessions,
+      lengths=lengths,
+      slot_lengths=args.slot_lengths,
+      capacities=args.capacities,
+      duration_weight=args.duration_weight,
+      capacity_weight=args.capacity_weight)
 
-  min_cost = 1e10
-  best_schedule = []
-  try:
-    for num_iter in range(1000000):
-      schedule = gen_random_schedule(tutorial_index, n_slots, n_sessions)
-      cost = compute_cost(schedule)
-      if cost < min_cost:
-        min_cost = cost
-        best_schedule = [schedule]
-      elif cost == min_cost:
-        min_cost = cost
-        best_schedule.append(schedule)
-      print num_iter, min_cost, len(best_schedule)
-      # if cost == 0:
-      #   break
-  except KeyboardInterrupt:
-    print ""
+  compute_cost = CostFunction(participant_tutorials, constraints)
+  compute_conflicts = PairwiseCostFunction(participant_tutorials)
+
+  options = {
+    'max_iterations' : args.max_iterations,
+    'max_time'       : args.max_time,
+    'seed'           : args.seed,
+    'constraints'    : constraints,
+  }
+  if args.method == "anneal":
+    search = local_search
+    options.update({
+      't_start'                : args.t_start,
+      't_end'                  : args.t_end,
+      'iterations_per_restart' : args.iterations_per_restart,
+      'max_restarts'           : args.restarts,
+    })
+  else:
+    search = random_sampling
+    options['block_size'] = args.block_size
+
+  if args.method == "exact":
+    if constraints is not None:
+      print "The exact search ignores the slot lengths and room capacities"
+    start_time = time.time()
+    conflicts, schedule, proven, num_iter = branch_and_bound(
+      participant_tutorials,
+      n_slots,
+      n_sessions,
+      tutorial_index,
+      max_time=args.max_time)
+    print "Conflicts: ", conflicts
+    print "Proven optimal: ", proven
+    print "Time: %.3f s" % (time.time() - start_time)
+    best_schedule = [] if schedule is None else [schedule]
+  elif args.nproc > 1:
+    min_cost, best_schedule, num_iter = parallel_search(
+      participant_tutorials,
+      tutorial_index,
+      n_slots,
+      n_sessions,
+      method=args.method,
+      nproc=args.nproc,
+      report_interval=args.report_interval,
+      **options)
+  else:
+    report = ProgressReport(args.report_interval)
+    min_cost, best_schedule, num_iter = search(
+      participant_tutorials,
+      tutorial_index,
+      n_slots,
+      n_sessions,
+      progress=report,
+      **options)
 
 
-  best_schedule = list(np.array(t) for t in set([tuple(map(tuple, sort_schedule(s))) for s in
-                            best_schedule]))
+  best_schedule = list(np.array(t) for t in set([
+    schedule_key(s, _sort_slots(constraints)) for s in best_schedule]))
   print ""
   print "Num iterations: ", num_iter
   print "Num schedules: ", len(best_schedule)
@@ -116,8 +1560,14 @@ if __name__ == '__main__':
   for schedule in best_schedule:
     print "----------"
     print ""
+    if constraints is not None:
+      schedule = constraints.assign_rooms(schedule)
     print schedule
     print "Cost: ", compute_cost(schedule)
+    print "Conflicts (timetable.f90): ", compute_conflicts(schedule)
+    if constraints is not None:
+      print "Minutes over slot lengths: ", constraints.overruns(schedule)
+      print "Participants over room capacities: ", constraints.overflows(schedule)
 
     # print "People per tutorial:"
     # count = tutorial_count(participant_tutorials)
@@ -0,0 +1,27 @@
+import unittest
+import numpy as np
+from random_search import CostFunction
+
+
+class CostFunctionBatchTest(unittest.TestCase):
+
+  def test_many_missed_choices(self):
+    # The first participant chose 20 tutorials, more than fit in the slots,
+    # so they miss at least 16 and their squared count overflows int8
+    participant_tutorials = [
+      list(range(1, 21)),
+      [1, 2, 3],
+      [4, 5, 21, 22],
+    ]
+    cost_function = CostFunction(participant_tutorials)
+    random_state = np.random.RandomState(0)
+    schedules = np.array([
+      random_state.permutation(np.arange(1, 23))[:8].reshape(4, 2)
+      for i in range(10)])
+    expected = [cost_function(schedule) for schedule in schedules]
+    self.assertEqual(cost_function.batch(schedules).tolist(), expected)
+    self.assertTrue(min(expected) >= 16**2)
+
+
+if __name__ == '__main__':
+  unittest.main()